@@ -1,241 +1,287 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+from flask.cli import AppGroup
+import click
 from flask_cors import CORS
-import sqlite3
-import requests
+import csv
 from datetime import datetime
 import os
 import json # Import json for handling JSON strings
 
+from db import CHECKPOINT_MODES, ConnectionPool, checkpoint, get_db, get_reader, init_app as init_pool
+from push import PushDispatcher
+from directory import UserDirectory
+from events import EventBroker, TooManyStreams
+from metrics import Metrics
+from idempotency import IdempotencyStore
+from writer import WriteQueue
+import archive
+import bulk
+import columnar
+import ledger
+import migrations
+import qr
+import reconcile
+import request_batch
+import search
+import settle
+import splits
+import statements
+
 app = Flask(__name__)
 CORS(app)
 
-# Expo push endpoint
-EXPO_PUSH_URL = 'https://exp.host/--/api/v2/push/send'
-
-DB_PATH = 'payments.db'
-
-def db_connect():
-    return sqlite3.connect(DB_PATH)
-
-# Utility function to send push notifications
-def send_push(token, title, body):
-    if not token:
-        print("No push token available for user.")
-        return
-
-    message = {
-        'to': token,
-        'title': title,
-        'body': body,
-        '_displayInForeground': True,
-    }
-
+# Expo push endpoint (override to point at a local stub, see expo_stub.py)
+EXPO_PUSH_URL = os.environ.get('EXPO_PUSH_URL', 'https://exp.host/--/api/v2/push/send')
+
+DB_PATH = os.environ.get('DB_PATH', 'payments.db')
+
+# Per-month archive files of old transactions (see archive.py and `flask --app app db archive`)
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'archive'))
+
+# Request, SQL and push timings for /metrics; a sampled fraction of SQL statements is timed, on every thread
+metrics = Metrics(
+    enabled=os.environ.get('METRICS_ENABLED', '1') != '0',
+    sample_rate=float(os.environ.get('METRICS_SAMPLE_RATE', 0.1)),
+    slow_query_ms=float(os.environ.get('METRICS_SLOW_QUERY_MS', 100)),
+)
+metrics.init_app(app)
+
+# Shared connection pool; each request borrows one connection for its app context
+# DB_WAL_AUTOCHECKPOINT=0 hands WAL checkpoints to a db.Checkpointer (see gunicorn.conf.py)
+pool = ConnectionPool(DB_PATH, max_connections=int(os.environ.get('DB_POOL_SIZE', 16)),
+                      factory=metrics.connection_factory(),
+                      wal_autocheckpoint=os.environ.get('DB_WAL_AUTOCHECKPOINT'))
+# Read-only connections for queries; writes go through `writes` (or `pool`)
+readers = ConnectionPool(DB_PATH, max_connections=int(os.environ.get('DB_READERS_POOL_SIZE', pool.max_connections)),
+                         factory=metrics.connection_factory(), readonly=True)
+init_pool(app, pool, readers)
+
+# Write routes hand their writes to one writer thread, which commits them in batches (see writer.py)
+# WRITE_QUEUE=0 applies each one inline on the request's connection instead
+writes = WriteQueue(
+    pool,
+    max_batch=int(os.environ.get('WRITE_BATCH_SIZE', 64)),
+    max_delay=float(os.environ.get('WRITE_BATCH_DELAY_MS', 0)) / 1000,
+    enabled=os.environ.get('WRITE_QUEUE', '1') != '0',
+)
+
+# Push notifications are written to an outbox and delivered off the request path
+dispatcher = PushDispatcher(pool, EXPO_PUSH_URL, metrics=metrics)
+
+# Serialized /users payload, rebuilt only after users or balances change
+user_directory = UserDirectory(ttl=float(os.environ.get('USERS_CACHE_TTL', 5)))
+
+# Change notifications for connected clients (/events), published after each commit.
+# Every open stream occupies a server thread; EVENTS_MAX_STREAMS caps them (see gunicorn.conf.py)
+broker = EventBroker(
+    max_streams=int(os.environ['EVENTS_MAX_STREAMS']) if os.environ.get('EVENTS_MAX_STREAMS') else None,
+)
+if os.environ.get('EVENTS_RELAY_DIR'):
+    # Several worker processes: each one's /events clients also get the others' events
+    broker.enable_relay(os.environ['EVENTS_RELAY_DIR'])
+
+# Responses to money-moving requests, replayed when a client retries with the same Idempotency-Key
+idempotency = IdempotencyStore(
+    writes,
+    capacity=int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('IDEMPOTENCY_TTL', 86400)),
+)
+
+# Signed payment-request QR codes; every worker must share QR_SECRET
+qr_tokens = qr.QrTokens(
+    secret=os.environ.get('QR_SECRET'),
+    ttl=int(os.environ.get('QR_TTL', 30)),
+    nonce_capacity=int(os.environ.get('QR_NONCE_CACHE_SIZE', 100000)),
+)
+
+# --- Schema management ---
+# Migrations and seeding run once from the CLI, not in every worker:
+#   flask --app app db upgrade
+#   flask --app app db seed
+db_cli = AppGroup('db', help='Database schema and demo data.')
+
+@db_cli.command('upgrade')
+def db_upgrade():
+    """Apply pending schema migrations."""
+    conn = pool.acquire()
     try:
-        response = requests.post(
-            EXPO_PUSH_URL,
-            json=message,
-            headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate', 'Content-Type': 'application/json'},
-            timeout=5
-        )
-        response.raise_for_status()
-        print(f"Push notification sent successfully to {token}. Status: {response.status_code}")
-        # print("Response body:", response.json()) # Verbose logging removed
-    except requests.exceptions.RequestException as e:
-        print(f"Error sending push notification: {e}")
-
-# Utility to get push token
-def get_user_token(user_id):
-    conn = db_connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT push_token FROM push_tokens WHERE user_id = ?', (user_id,))
-    token = cursor.fetchone()
-    conn.close()
-    return token[0] if token else None
-
-# Initialize SQLite DB with sample data and handle migration to integer-cents
-def init_db():
-    needs_seed = False
-    first_time = not os.path.exists(DB_PATH)
-    conn = db_connect()
-    cursor = conn.cursor()
-
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            email TEXT NOT NULL UNIQUE,
-            phone TEXT NOT NULL,
-            iban TEXT NOT NULL UNIQUE
-        )
-    ''')
-
-    # Bank balances (in integer cents)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS bank_balances (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            iban TEXT UNIQUE,
-            balance_cents INTEGER DEFAULT 0,
-            FOREIGN KEY (iban) REFERENCES users (iban)
-        )
-    ''')
-
-    # Push tokens
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS push_tokens (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE,
-            push_token TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-
-    # Pending requests (amount in cents)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS pending_requests (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            requester_id INTEGER NOT NULL,
-            payer_id INTEGER NOT NULL,
-            amount_cents INTEGER NOT NULL,
-            status TEXT DEFAULT 'pending', -- 'pending', 'approved', 'denied'
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (requester_id) REFERENCES users (id),
-            FOREIGN KEY (payer_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # --- NEW: Groups Table ---
-    # Members will be stored as a JSON array of user IDs
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS groups (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            creator_id INTEGER NOT NULL,
-            member_ids TEXT NOT NULL, -- Stored as JSON string: [id1, id2, ...]
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (creator_id) REFERENCES users (id)
-        )
-    ''')
-
-    # --- NEW: Transactions Table ---
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS transactions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            type TEXT NOT NULL,
-            initiator_id INTEGER NOT NULL,
-            target_id INTEGER,
-            amount_cents INTEGER,
-            status TEXT DEFAULT 'pending',
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            memo TEXT,
-            request_ref INTEGER,
-            FOREIGN KEY (initiator_id) REFERENCES users (id),
-            FOREIGN KEY (target_id) REFERENCES users (id),
-            FOREIGN KEY (request_ref) REFERENCES pending_requests (id)
-        )
-    ''')
-
-    # Seed data if DB is new
-    if first_time:
-        print("Seeding new database...")
-        needs_seed = True
-        
-    # Check if we need to seed users (robust way)
-    cursor.execute('SELECT COUNT(*) FROM users')
-    if cursor.fetchone()[0] == 0:
-        needs_seed = True
-
-    if needs_seed:
-        users = [
-            ("Ana Novak", "ana.novak@gmail.com", "+386 40 123 456", "SI56123456780000123"),
-            ("Marko Kovač", "marko.kovac@yahoo.com", "+386 31 987 654", "SI56123456780000234"),
-            ("Petra Zupan", "petra.zupan@outlook.com", "+386 41 555 111", "SI56123456780000345"),
-            ("Tomaž Horvat", "tomaz.horvat@gmail.com", "+386 40 222 333", "SI56123456780000456"),
-            ("Nina Mlakar", "nina.mlakar@hotmail.com", "+386 31 444 555", "SI56123456780000567"),
-            ("Luka Kralj", "luka.kralj@gmail.com", "+386 40 666 777", "SI56123456780000678"),
-            ("Maja Rozman", "maja.rozman@yahoo.com", "+386 41 888 999", "SI56123456780000789"),
-            ("Jan Potočnik", "jan.potocnik@gmail.com", "+386 31 123 789", "SI56123456780000890"),
-            ("Sara Bizjak", "sara.bizjak@gmail.com", "+386 40 234 567", "SI56123456780000901"),
-            ("Žan Kastelic", "zan.kastelic@outlook.com", "+386 41 345 678", "SI56123456780001012"),
-            ("Katarina Koren", "katarina.koren@gmail.com", "+386 31 456 789", "SI56123456780001123"),
-            ("Miha Medved", "miha.medved@yahoo.com", "+386 40 567 890", "SI56123456780001234"),
-            ("Tjaša Vidmar", "tjasa.vidmar@gmail.com", "+386 31 678 901", "SI56123456780001345"),
-            ("Rok Zajc", "rok.zajc@gmail.com", "+386 41 789 012", "SI56123456780001456"),
-            ("Eva Kos", "eva.kos@hotmail.com", "+386 40 890 123", "SI56123456780001567"),
-            ("Nejc Kosi", "nejc.kosi@gmail.com", "+386 31 901 234", "SI56123456780001678"),
-            ("Tina Lesjak", "tina.lesjak@yahoo.com", "+386 40 012 345", "SI56123456780001789"),
-            ("Gregor Hrovat", "gregor.hrovat@gmail.com", "+386 41 111 222", "SI56123456780001890"),
-            ("Barbara Turk", "barbara.turk@outlook.com", "+386 31 222 333", "SI56123456780001901"),
-            ("David Dolinar", "david.dolinar@gmail.com", "+386 40 333 444", "SI56123456780002012"),
-        ]
-        
-        for name, email, phone, iban in users:
-            cursor.execute('''
-                INSERT INTO users (name, email, phone, iban) VALUES (?, ?, ?, ?)
-            ''', (name, email, phone, iban))
-            
-            # Initial balance 100 EUR = 10000 cents
-            cursor.execute('''
-                INSERT INTO bank_balances (iban, balance_cents) VALUES (?, ?)
-            ''', (iban, 10000))
-
-        # Seed a split request for testing (Alice owes Bob 5.00)
-        # Assuming Alice is user 1, Bob is user 2
-        cursor.execute('''
-            INSERT INTO pending_requests (requester_id, payer_id, amount_cents, status) 
-            VALUES (?, ?, ?, ?)
-        ''', (2, 1, 500, 'pending'))
-        
-        # Seed transaction rows for the seeded pending request
-        # request_sent: from requester (Bob id=2) to payer (Alice id=1)
-        cursor.execute('''
-            INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, request_ref)
-            VALUES ('request_sent', ?, ?, ?, 'pending', last_insert_rowid())
-        ''', (2, 1, 500))
-        
-        # --- NEW: Seed a Group ---
-        # Assuming users 1 (Alice) and 2 (Bob) and 3 (Charlie) exist
-        # Alice creates a group "Dinner Crew" with Bob and Charlie (IDs 2 and 3). Creator is 1.
-        member_ids = json.dumps([2, 3]) # Storing as a JSON array string
-        cursor.execute('''
-            INSERT INTO groups (name, creator_id, member_ids) 
-            VALUES (?, ?, ?)
-        ''', ("Dinner Crew", 1, member_ids))
-        
-        conn.commit()
-
-    conn.close()
-
-# Ensure DB is initialized
-init_db()
+        applied = migrations.upgrade(conn)
+        print(f"Schema at version {migrations.current_version(conn)} ({len(applied)} applied).")
+    finally:
+        pool.release(conn)
+
+@db_cli.command('seed')
+def db_seed():
+    """Insert demo users, balances, a request and a group (idempotent)."""
+    conn = pool.acquire()
+    try:
+        migrations.check(conn)
+        migrations.seed(conn)
+    finally:
+        pool.release(conn)
+
+@db_cli.command('version')
+def db_version():
+    """Show the current and expected schema versions."""
+    conn = pool.acquire()
+    try:
+        print(f"current={migrations.current_version(conn)} expected={migrations.SCHEMA_VERSION}")
+    finally:
+        pool.release(conn)
+
+@db_cli.command('checkpoint')
+@click.option('--mode', type=click.Choice(CHECKPOINT_MODES), default='TRUNCATE', show_default=True)
+def db_checkpoint(mode):
+    """Copy the WAL back into the database file."""
+    conn = pool.acquire()
+    try:
+        busy, wal_frames, checkpointed = checkpoint(conn, mode)
+        print(f"busy={busy} wal_frames={wal_frames} checkpointed={checkpointed}")
+    finally:
+        pool.release(conn)
+
+@db_cli.command('backfill-statements')
+@click.option('--since', help='Only rebuild months from this one on (YYYY-MM).')
+def db_backfill_statements(since):
+    """Recompute monthly statements from the transactions table."""
+    conn = pool.acquire()
+    try:
+        migrations.check(conn)
+        if since:
+            since = statements.parse_month(since)
+        rows = ledger.run_immediate(conn, lambda cursor: statements.backfill(cursor, since))
+        print(f"Rebuilt {rows} statement rows{f' from {since}' if since else ''}.")
+    finally:
+        pool.release(conn)
+
+@db_cli.command('archive')
+@click.option('--min-age-days', type=int, default=int(os.environ.get('ARCHIVE_MIN_AGE_DAYS', 90)), show_default=True,
+              help='Archive months that ended at least this long ago.')
+@click.option('--batch-size', type=int, default=500, show_default=True, help='Rows moved per transaction.')
+@click.option('--pause-ms', type=float, default=50, show_default=True, help='Sleep between batches.')
+@click.option('--max-batches', type=int, help='Stop after this many batches.')
+def db_archive(min_age_days, batch_size, pause_ms, max_batches):
+    """Move old completed, rejected and settled transactions into per-month archive files (safe while serving)."""
+    conn = pool.acquire()
+    try:
+        migrations.check(conn)
+        archiver = archive.Archiver(conn, ARCHIVE_DIR, min_age_days=min_age_days, batch_size=batch_size,
+                                    pause=pause_ms / 1000)
+        try:
+            rows = archiver.run(max_batches=max_batches)
+        finally:
+            archiver.close()
+        stats = archiver.stats()
+        print(f"Archived {rows} rows before {archiver.cutoff()} in {stats['batches']} batches "
+              f"into {ARCHIVE_DIR} (months: {', '.join(stats['months']) or 'none'}).")
+    finally:
+        pool.release(conn)
+
+@db_cli.command('reconcile')
+@click.option('--full', is_flag=True, help='Ignore the stored checkpoint and read the whole history.')
+@click.option('--after-id', type=int, default=0, show_default=True,
+              help='On a first or --full run, skip transactions up to this id (already in the opening amounts).')
+@click.option('--chunk-rows', type=int, default=reconcile.CHUNK_ROWS, show_default=True)
+@click.option('--no-numpy', is_flag=True, help='Sum in plain Python (slower), for a host without numpy.')
+@click.option('--report', type=click.Path(dir_okay=False),
+              help='CSV of mismatched accounts (default: reconcile-<time>.csv next to the database, if any).')
+def db_reconcile(full, after_id, chunk_rows, no_numpy, report):
+    """Check every balance against opening amount + completed transactions; exits 1 on mismatches."""
+    conn = pool.acquire()
+    try:
+        migrations.check(conn)
+        if no_numpy:
+            print("Summing in plain Python (--no-numpy).")
+        reconciler = reconcile.Reconciler(conn, ARCHIVE_DIR, chunk_rows=chunk_rows, vectorized=not no_numpy)
+        mismatches = reconciler.run(full=full, after_id=after_id)
+        stats = reconciler.stats()
+        print(f"Read {stats['rows']} rows in {stats['chunks']} chunks in {stats['seconds']}s ({stats['engine']}), "
+              f"through id {stats['through_id']}, {stats['open']} still pending; {len(mismatches)} mismatches.")
+        if mismatches or report:
+            report = report or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)),
+                                             f"reconcile-{datetime.now():%Y%m%d-%H%M%S}.csv")
+            reconciler.write_report(report)
+            print(f"Report written to {report}.")
+    finally:
+        pool.release(conn)
+    if mismatches:
+        raise SystemExit(1)
+
+app.cli.add_command(db_cli)
+
+def shutdown():
+    """Graceful stop for a worker: end /events streams, commit queued writes, deliver queued pushes, close connections."""
+    broker.close()
+    writes.stop()
+    dispatcher.stop(drain=True)
+    pool.close_all()
+    readers.close_all()
+
+# Workers only compare PRAGMA user_version at startup; serving is refused until it matches
+schema_ready = False
+
+def check_schema():
+    global schema_ready
+    conn = pool.acquire()
+    try:
+        migrations.check(conn)
+        schema_ready = True
+    except migrations.SchemaOutOfDate as e:
+        print(f"Warning: {e}")
+    finally:
+        pool.release(conn)
+    return schema_ready
+
+@app.before_request
+def require_schema():
+    # Re-check cheaply until someone runs the upgrade, then never again
+    if not schema_ready and not check_schema():
+        return jsonify({'error': 'Database schema out of date; run `flask db upgrade`'}), 503
+    # Started lazily so the threads live in the process that serves requests (no-op once running)
+    dispatcher.start()
+    writes.start()
+
+check_schema()
 
 # --- Utility Functions --- (Defined above, kept for context in original app.py)
 
+def columnar_response(sql, params, fields, convert=None, trailer=None):
+    # ?format=columnar: rows go out in fetchmany() batches as they are read (see columnar.py).
+    # The request's own connection is back in the pool before the body is sent, so borrow one.
+    # `sql` may instead be a function of that connection returning a cursor.
+    def generate():
+        conn = readers.acquire()
+        try:
+            cursor = sql(conn) if callable(sql) else conn.execute(sql, params)
+            yield from columnar.encode(cursor, fields, convert, trailer)
+        finally:
+            readers.release(conn)
+    return Response(generate(), mimetype='application/json')
+
 # --- Routes ---
 
 @app.route('/users', methods=['GET'])
 def get_users():
-    conn = db_connect()
-    cursor = conn.cursor()
-    cursor.execute('SELECT id, name, email, phone, iban FROM users')
-    users_data = cursor.fetchall()
-    
-    # Fetch balances
-    users_list = []
-    for id, name, email, phone, iban in users_data:
-        cursor.execute('SELECT balance_cents FROM bank_balances WHERE iban = ?', (iban,))
-        balance_cents = cursor.fetchone()[0] if cursor.rowcount > 0 else 0
-        users_list.append({
-            'id': id,
-            'name': name,
-            'email': email,
-            'phone': phone,
-            'iban': iban,
-            'balance': balance_cents / 100.0
-        })
+    body, etag = user_directory.get(get_reader(), 'columnar' if columnar.requested(request) else 'rows')
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # Clients must revalidate, which is a cheap 304
+    return response.make_conditional(request)
+
+# Contact pickers search here instead of filtering the whole /users list on the client
+@app.route('/users/search', methods=['GET'])
+def search_users():
+    try:
+        query = request.args.get('q', '')
+        limit = request.args.get('limit', 20, type=int)
+        limit = max(1, min(limit, search.SEARCH_MAX_LIMIT))
+        # Optional: the searching user, whose recent contacts are ranked first
+        user_id = request.args.get('user_id', type=int)
 
-    conn.close()
-    return jsonify(users_list)
+        return jsonify(search.search(get_reader().cursor(), query, user_id, limit))
+    except Exception as e:
+        print(f"User search error: {e}")
+        return jsonify({'error': str(e)}), 500
 
 # Route for login and updating push token
 @app.route('/login/<int:user_id>', methods=['POST'])
@@ -244,25 +290,21 @@ def login(user_id):
         data = request.get_json()
         push_token = data.get('pushToken')
         
-        conn = db_connect()
-        cursor = conn.cursor()
+        cursor = get_reader().cursor()
         
         # Check if user exists
         cursor.execute('SELECT id FROM users WHERE id = ?', (user_id,))
         if cursor.fetchone() is None:
-            conn.close()
             return jsonify({'error': 'User not found'}), 404
         
         if push_token:
             # Insert or update the push token
-            cursor.execute('''
+            writes.run(lambda cursor: cursor.execute('''
                 INSERT OR REPLACE INTO push_tokens (user_id, push_token) 
                 VALUES (?, ?)
-            ''', (user_id, push_token))
-            conn.commit()
+            ''', (user_id, push_token)))
             print(f"Token updated for user {user_id}")
             
-        conn.close()
         return jsonify({'message': 'Login successful and token updated (if provided)'})
     except Exception as e:
         print(f"Login error: {e}")
@@ -272,18 +314,15 @@ def login(user_id):
 @app.route('/logout/<int:user_id>', methods=['POST'])
 def logout(user_id):
     try:
-        conn = db_connect()
-        cursor = conn.cursor()
         # Remove the token
-        cursor.execute('DELETE FROM push_tokens WHERE user_id = ?', (user_id,))
-        conn.commit()
-        conn.close()
+        writes.run(lambda cursor: cursor.execute('DELETE FROM push_tokens WHERE user_id = ?', (user_id,)))
         return jsonify({'message': 'Logout successful'})
     except Exception as e:
         print(f"Logout error: {e}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/request_money', methods=['POST'])
+@idempotency.idempotent
 def request_money():
     try:
         data = request.get_json()
@@ -295,49 +334,54 @@ def request_money():
         if amount_cents <= 0:
             return jsonify({'error': 'Amount must be positive'}), 400
 
-        conn = db_connect()
-        cursor = conn.cursor()
+        cursor = get_reader().cursor()
 
         # Get IDs
         cursor.execute('SELECT id FROM users WHERE iban = ?', (requester_iban,))
-        requester_id = cursor.fetchone()[0]
+        requester_data = cursor.fetchone()
+        if not requester_data:
+            return jsonify({'error': 'Requester not found'}), 404
+        requester_id = requester_data[0]
         cursor.execute('SELECT id, name FROM users WHERE iban = ?', (payer_iban,))
         payer_data = cursor.fetchone()
         if not payer_data:
-            conn.close()
             return jsonify({'error': 'Payer not found'}), 404
         payer_id, payer_name = payer_data
 
-        # Check for existing request to prevent duplicates
-        cursor.execute('''
-            SELECT id FROM pending_requests 
-            WHERE requester_id = ? AND payer_id = ? AND amount_cents = ? AND status = 'pending'
-        ''', (requester_id, payer_id, amount_cents))
-        if cursor.fetchone():
-            conn.close()
-            return jsonify({'error': 'Duplicate pending request exists'}), 409
+        def apply_request(cursor):
+            # Check for existing request to prevent duplicates
+            cursor.execute('''
+                SELECT id FROM pending_requests 
+                WHERE requester_id = ? AND payer_id = ? AND amount_cents = ? AND status = 'pending'
+            ''', (requester_id, payer_id, amount_cents))
+            if cursor.fetchone():
+                return None
 
-        # Insert pending request
-        cursor.execute('''
-            INSERT INTO pending_requests (requester_id, payer_id, amount_cents) 
-            VALUES (?, ?, ?)
-        ''', (requester_id, payer_id, amount_cents))
-        request_id = cursor.lastrowid
+            # Insert pending request
+            cursor.execute('''
+                INSERT INTO pending_requests (requester_id, payer_id, amount_cents) 
+                VALUES (?, ?, ?)
+            ''', (requester_id, payer_id, amount_cents))
+            request_id = cursor.lastrowid
 
-        # Insert transaction logs
-        # request_sent from requester's perspective
-        cursor.execute('''
-            INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, memo, request_ref)
-            VALUES ('request_sent', ?, ?, ?, 'pending', ?, ?)
-        ''', (requester_id, payer_id, amount_cents, memo, request_id))
+            # Insert transaction logs
+            # request_sent from requester's perspective
+            cursor.execute('''
+                INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, memo, request_ref)
+                VALUES ('request_sent', ?, ?, ?, 'pending', ?, ?)
+            ''', (requester_id, payer_id, amount_cents, memo, request_id))
 
-        conn.commit()
+            # Notify payer
+            dispatcher.enqueue(cursor, payer_id, 'Money Request', f'{data.get("requester_name", "Someone")} requests €{amount_cents/100:.2f} from you.')
+            return request_id
 
-        # Notify payer
-        token = get_user_token(payer_id)
-        send_push(token, 'Money Request', f'{data.get("requester_name", "Someone")} requests €{amount_cents/100:.2f} from you.')
+        request_id = writes.run(apply_request)
+        if request_id is None:
+            return jsonify({'error': 'Duplicate pending request exists'}), 409
+        dispatcher.wake()
+        broker.publish([payer_id], 'pending_requests', {'request_id': request_id})
+        broker.publish([requester_id, payer_id], 'transactions')
 
-        conn.close()
         return jsonify({'message': 'Request sent', 'request_id': request_id, 'amount_cents': amount_cents})
     except Exception as e:
         print(f"Request error: {e}")
@@ -345,6 +389,7 @@ def request_money():
 
 
 @app.route('/transfer_money', methods=['POST'])
+@idempotency.idempotent
 def transfer_money():
     try:
         data = request.get_json()
@@ -352,75 +397,276 @@ def transfer_money():
         receiver_iban = data['receiver_iban']
         amount_cents = int(data['amount_cents'])
         memo = data.get('memo', '')
+        # A transfer between members of a group counts towards its settle-up (see settle.py)
+        group_id = data.get('group_id')
 
         if amount_cents <= 0:
             return jsonify({'error': 'Amount must be positive'}), 400
 
-        conn = db_connect()
-        cursor = conn.cursor()
+        cursor = get_reader().cursor()
 
         # Get IDs and names
         cursor.execute('SELECT id, name FROM users WHERE iban = ?', (sender_iban,))
         sender_data = cursor.fetchone()
         if not sender_data:
-            conn.close()
             return jsonify({'error': 'Sender not found'}), 404
         sender_id, sender_name = sender_data
 
         cursor.execute('SELECT id, name FROM users WHERE iban = ?', (receiver_iban,))
         receiver_data = cursor.fetchone()
         if not receiver_data:
-            conn.close()
             return jsonify({'error': 'Receiver not found'}), 404
         receiver_id, receiver_name = receiver_data
 
-        # Check sender balance
-        cursor.execute('SELECT balance_cents FROM bank_balances WHERE iban = ?', (sender_iban,))
-        balance = cursor.fetchone()[0]
-        if balance < amount_cents:
-            conn.close()
-            return jsonify({'error': 'Insufficient balance'}), 400
+        if group_id is not None and not {sender_id, receiver_id} <= settle.members(cursor, group_id).keys():
+            return jsonify({'error': 'Sender and receiver must both be members of the group'}), 400
 
-        # Transfer funds
-        cursor.execute('UPDATE bank_balances SET balance_cents = balance_cents - ? WHERE iban = ?', (amount_cents, sender_iban))
-        cursor.execute('UPDATE bank_balances SET balance_cents = balance_cents + ? WHERE iban = ?', (amount_cents, receiver_iban))
+        def apply_transfer(cursor):
+            # Insert transaction logs (sent from sender, received from receiver)
+            cursor.execute('''
+                INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, memo, group_id)
+                VALUES ('transfer', ?, ?, ?, 'completed', ?, ?)
+            ''', (sender_id, receiver_id, amount_cents, memo, group_id))
 
-        # Insert transaction logs (sent from sender, received from receiver)
-        cursor.execute('''
-            INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, memo)
-            VALUES ('transfer', ?, ?, ?, 'completed', ?)
-        ''', (sender_id, receiver_id, amount_cents, memo))
-        
-        conn.commit()
+            # Guarded debit + credit with matching ledger entries
+            ledger.move_funds(cursor, sender_iban, receiver_iban, amount_cents, cursor.lastrowid, 'transfer')
 
-        # Notify receiver
-        token = get_user_token(receiver_id)
-        send_push(token, 'Money Received', f'{sender_name} sent you €{amount_cents/100:.2f}.')
+            # Notify receiver
+            dispatcher.enqueue(cursor, receiver_id, 'Money Received', f'{sender_name} sent you €{amount_cents/100:.2f}.')
+
+        try:
+            writes.run(apply_transfer)
+        except ledger.InsufficientFunds:
+            return jsonify({'error': 'Insufficient balance'}), 400
+
+        dispatcher.wake()
+        user_directory.invalidate()
+        broker.publish([sender_id, receiver_id], 'transactions')
 
-        conn.close()
         return jsonify({'message': 'Transfer successful', 'amount_cents': amount_cents})
     except Exception as e:
         print(f"Transfer error: {e}")
         return jsonify({'error': str(e)}), 500
     
+# --- QR payment requests ---
+# The requester shows a code for an amount; whoever scans it pays that amount through /qr/redeem
+@app.route('/qr/create', methods=['POST'])
+def create_qr():
+    try:
+        data = request.get_json()
+        # {'user_id': requester, 'amount_cents': N, 'ttl': seconds (optional, capped at qr_tokens.max_ttl)}
+        try:
+            user_id = int(data['user_id'])
+            amount_cents = int(data['amount_cents'])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'error': 'user_id and amount_cents are required'}), 400
+        if amount_cents <= 0:
+            return jsonify({'error': 'Amount must be positive'}), 400
+
+        cursor = get_reader().cursor()
+        cursor.execute('SELECT 1 FROM users WHERE id = ?', (user_id,))
+        if not cursor.fetchone():
+            return jsonify({'error': 'User not found'}), 404
+
+        try:
+            token, expires_at = qr_tokens.issue(user_id, amount_cents, data.get('ttl'))
+        except qr.InvalidToken as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'token': token, 'amount_cents': amount_cents, 'expires_at': expires_at,
+                        'ttl': expires_at - int(datetime.now().timestamp())})
+    except Exception as e:
+        print(f"QR create error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/qr/redeem', methods=['POST'])
+@idempotency.idempotent
+def redeem_qr():
+    try:
+        data = request.get_json()
+        # {'token': scanned code, 'payer_iban': IBAN paying it}
+        payer_iban = data.get('payer_iban')
+        if not payer_iban:
+            return jsonify({'error': 'payer_iban is required'}), 400
+
+        # Signature, expiry and replays are checked before any database work
+        try:
+            payment = qr_tokens.verify(data.get('token'))
+            qr_tokens.claim(payment)
+        except (qr.InvalidToken, qr.ExpiredToken) as e:
+            return jsonify({'error': str(e)}), 400 if isinstance(e, qr.InvalidToken) else 410
+        except qr.ReplayedToken as e:
+            return jsonify({'error': str(e)}), 409
+        except qr.NonceCacheFull as e:
+            return jsonify({'error': str(e)}), 503
+
+        redeemed = False
+        try:
+            cursor = get_reader().cursor()
+            cursor.execute('SELECT id, name FROM users WHERE iban = ?', (payer_iban,))
+            payer_data = cursor.fetchone()
+            if not payer_data:
+                return jsonify({'error': 'Payer not found'}), 404
+            payer_id, payer_name = payer_data
+
+            cursor.execute('SELECT name, iban FROM users WHERE id = ?', (payment.requester_id,))
+            requester_data = cursor.fetchone()
+            if not requester_data:
+                return jsonify({'error': 'Requester not found'}), 404
+            requester_name, requester_iban = requester_data
+            if payer_id == payment.requester_id:
+                return jsonify({'error': "You can't pay your own QR code"}), 400
+
+            def apply_redemption(cursor):
+                cursor.execute('''
+                    INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, memo)
+                    VALUES ('transfer', ?, ?, ?, 'completed', 'QR')
+                ''', (payer_id, payment.requester_id, payment.amount_cents))
+                transaction_id = cursor.lastrowid
+                ledger.move_funds(cursor, payer_iban, requester_iban, payment.amount_cents, transaction_id, 'transfer')
+                qr_tokens.record(cursor, payment, payer_id, transaction_id)
+                dispatcher.enqueue(cursor, payment.requester_id, 'Money Received',
+                                   f'{payer_name} paid your QR code: €{payment.amount_cents/100:.2f}.')
+                return transaction_id
+
+            try:
+                transaction_id = writes.run(apply_redemption)
+            except ledger.InsufficientFunds:
+                return jsonify({'error': 'Insufficient balance'}), 400
+            except qr.ReplayedToken as e:
+                # Redeemed by another worker; the nonce stays claimed here too
+                redeemed = True
+                return jsonify({'error': str(e)}), 409
+            redeemed = True
+        finally:
+            if not redeemed:
+                qr_tokens.release(payment)
+
+        dispatcher.wake()
+        user_directory.invalidate()
+        broker.publish([payer_id, payment.requester_id], 'transactions')
+
+        return jsonify({'message': 'Payment successful', 'amount_cents': payment.amount_cents,
+                        'requester_id': payment.requester_id, 'requester_name': requester_name,
+                        'transaction_id': transaction_id})
+    except Exception as e:
+        print(f"QR redeem error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/transfers/bulk', methods=['POST'])
+def bulk_transfer():
+    try:
+        # Body is NDJSON ({"receiver_iban", "amount_cents", "memo"} per line) or CSV with a header row
+        sender_iban = request.args.get('sender_iban')
+        if not sender_iban:
+            return jsonify({'error': 'sender_iban is required'}), 400
+
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT u.id, u.name, b.balance_cents FROM users u
+            JOIN bank_balances b ON b.iban = u.iban
+            WHERE u.iban = ?
+        ''', (sender_iban,))
+        sender_data = cursor.fetchone()
+        if not sender_data:
+            return jsonify({'error': 'Sender not found'}), 404
+        sender_id, sender_name, balance_cents = sender_data
+
+        # The whole upload is read and resolved before anything is written (its total is checked
+        # once), a chunk at a time into a spooled Plan, then applied chunk by chunk from there
+        try:
+            transfers = bulk.plan(cursor, sender_id, bulk.read_lines(request.stream, request.mimetype))
+        except bulk.TooManyLines as e:
+            return jsonify({'error': f'Upload too large: {e}'}), 413
+        except (bulk.BulkError, UnicodeDecodeError, csv.Error) as e:
+            return jsonify({'error': f'Invalid upload: {e}'}), 400
+
+        # One up-front check for the whole file; each chunk's debit is still guarded at write time
+        if transfers.total_cents > balance_cents:
+            transfers.close()
+            return jsonify({
+                'error': 'Insufficient balance',
+                'total_cents': transfers.total_cents,
+                'balance_cents': balance_cents,
+                'transfers': transfers.transfers,
+            }), 400
+
+        def generate():
+            # Results stream back as each chunk commits; every result carries its input line number.
+            # The request's connection is released on teardown before the body is sent, so the
+            # generator borrows its own.
+            summary = {'ok': 0, 'failed': transfers.failures, 'transferred_cents': 0}
+            conn = pool.acquire()
+            try:
+                yield from transfers.failure_lines()
+                for chunk in transfers.transfer_chunks():
+                    credited = {}
+                    for _, receiver_id, _, amount_cents, _ in chunk:
+                        credited[receiver_id] = credited.get(receiver_id, 0) + amount_cents
+
+                    def apply_chunk(cursor):
+                        transaction_ids = bulk.apply_chunk(cursor, sender_id, sender_iban, chunk)
+                        dispatcher.enqueue_many(cursor, [
+                            (receiver_id, 'Money Received', f'{sender_name} sent you €{amount_cents/100:.2f}.')
+                            for receiver_id, amount_cents in credited.items()
+                        ])
+                        return transaction_ids
+
+                    try:
+                        transaction_ids = ledger.run_immediate(conn, apply_chunk)
+                    except ledger.InsufficientFunds:
+                        # Balance dropped since the up-front check (a concurrent spend); later chunks may still fit
+                        summary['failed'] += len(chunk)
+                        for line_no, _, _, _, _ in chunk:
+                            yield json.dumps({'line': line_no, 'status': 'error', 'error': 'Insufficient balance'}) + '\n'
+                        continue
+
+                    dispatcher.wake()
+                    user_directory.invalidate()
+                    broker.publish([sender_id, *credited], 'transactions')
+                    summary['ok'] += len(chunk)
+                    summary['transferred_cents'] += sum(credited.values())
+                    for (line_no, _, _, _, _), transaction_id in zip(chunk, transaction_ids):
+                        yield json.dumps({'line': line_no, 'status': 'ok', 'transaction_id': transaction_id}) + '\n'
+            except Exception as e:
+                print(f"Bulk transfer error: {e}")
+                summary['error'] = str(e)
+            finally:
+                pool.release(conn)
+                transfers.close()
+
+            yield json.dumps({'summary': summary}) + '\n'
+
+        return Response(generate(), mimetype='application/x-ndjson')
+    except Exception as e:
+        print(f"Bulk transfer error: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/pending_requests', methods=['GET'])
 def pending_requests():
     try:
         user_id = request.args.get('user_id', type=int)
         if not user_id:
             return jsonify({'error': 'user_id required'}), 400
+        # Only requests newer than the last one the client already has
+        since_id = request.args.get('since_id', 0, type=int)
 
-        conn = db_connect()
-        cursor = conn.cursor()
-        cursor.execute('''
+        # Walks the partial (payer_id, id) index over pending rows only; ids grow with created_at
+        sql = '''
             SELECT pr.id, pr.requester_id, u.name as requester_name, 
                    u.phone as requester_phone, pr.amount_cents, 
                    pr.status, pr.created_at
             FROM pending_requests pr
             JOIN users u ON pr.requester_id = u.id
-            WHERE pr.payer_id = ? AND pr.status = 'pending'
-            ORDER BY pr.created_at DESC
-        ''', (user_id,))
+            WHERE pr.payer_id = ? AND pr.status = 'pending' AND pr.id > ?
+            ORDER BY pr.id DESC
+        '''
+        if columnar.requested(request):
+            return columnar_response(sql, (user_id, since_id), (
+                'id', 'requester_id', 'requester_name', 'requester_phone', 'amount_cents', 'status', 'created_at'))
+
+        cursor = get_reader().cursor()
+        cursor.execute(sql, (user_id, since_id))
         requests_data = cursor.fetchall()
 
         requests_list = []
@@ -434,56 +680,91 @@ def pending_requests():
                 'status': status,
                 'created_at': created_at
             })
-        print(f"Debug - Request data: {requests_list}")  # Add this debug line
-
-
-        conn.close()
         return jsonify(requests_list)
     except Exception as e:
         print(f"Pending requests error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/pending_requests/summary', methods=['GET'])
+def pending_requests_summary():
+    try:
+        user_id = request.args.get('user_id', type=int)
+        if not user_id:
+            return jsonify({'error': 'user_id required'}), 400
+
+        # One primary-key lookup in the trigger-maintained pending_summary table
+        row = get_reader().execute('''
+            SELECT pending_count, pending_total_cents, last_request_id FROM pending_summary WHERE user_id = ?
+        ''', (user_id,)).fetchone()
+        pending_count, pending_total_cents, last_request_id = row or (0, 0, 0)
+
+        response = jsonify({
+            'user_id': user_id,
+            'pending_count': pending_count,
+            'pending_total_cents': pending_total_cents,
+            'pending_total': pending_total_cents / 100.0,
+            'last_request_id': last_request_id,
+        })
+        response.set_etag(f'{pending_count}-{pending_total_cents}-{last_request_id}')
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    except Exception as e:
+        print(f"Pending summary error: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/approve_request/<int:request_id>', methods=['POST'])
+@idempotency.idempotent
 def approve_request(request_id):
     try:
-        conn = db_connect()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT requester_id, payer_id, amount_cents FROM pending_requests WHERE id = ? AND status = 'pending'
-        ''', (request_id,))
-        req = cursor.fetchone()
-        if not req:
-            conn.close()
-            return jsonify({'error': 'Request not found or already processed'}), 404
-        requester_id, payer_id, amount_cents = req
+        def apply_approval(cursor):
+            # Read the request inside the write transaction so two approvals can't both win
+            cursor.execute('''
+                SELECT pr.requester_id, pr.payer_id, pr.amount_cents,
+                       payer.name, payer.iban, requester.name, requester.iban
+                FROM pending_requests pr
+                JOIN users payer ON payer.id = pr.payer_id
+                JOIN users requester ON requester.id = pr.requester_id
+                WHERE pr.id = ? AND pr.status = 'pending'
+            ''', (request_id,))
+            req = cursor.fetchone()
+            if not req:
+                return None
+            requester_id, payer_id, amount_cents, payer_name, payer_iban, requester_name, requester_iban = req
+
+            # Update request status
+            cursor.execute('UPDATE pending_requests SET status = "approved" WHERE id = ?', (request_id,))
 
-        # Fetch names
-        cursor.execute('SELECT name FROM users WHERE id = ?', (payer_id,))
-        payer_name_data = cursor.fetchone()
-        payer_name = payer_name_data[0] if payer_name_data else "Unknown"
-        cursor.execute('SELECT name FROM users WHERE id = ?', (requester_id,))
-        requester_name_data = cursor.fetchone()
-        requester_name = requester_name_data[0] if requester_name_data else "Unknown"
-
-        # Update request status
-        cursor.execute('UPDATE pending_requests SET status = "approved" WHERE id = ?', (request_id,))
-        
-        # Transfer funds (debit payer, credit requester)
-        cursor.execute('UPDATE bank_balances SET balance_cents = balance_cents - ? WHERE iban = (SELECT iban FROM users WHERE id = ?)', (amount_cents, payer_id))
-        cursor.execute('UPDATE bank_balances SET balance_cents = balance_cents + ? WHERE iban = (SELECT iban FROM users WHERE id = ?)', (amount_cents, requester_id))
+            cursor.execute('''
+                SELECT id FROM transactions WHERE request_ref = ? AND status = 'pending' ORDER BY id LIMIT 1
+            ''', (request_id,))
+            transaction_row = cursor.fetchone()
 
-        # Update the original request transaction logs status
-        cursor.execute('''
-            UPDATE transactions SET status = 'completed' WHERE request_ref = ? AND status = 'pending'
-        ''', (request_id,))
+            # Transfer funds (debit payer, credit requester); fails if the payer can't cover it
+            ledger.move_funds(cursor, payer_iban, requester_iban, amount_cents,
+                              transaction_row[0] if transaction_row else None, 'request')
 
-        conn.commit()
-        
-        # Notify Requester
-        token = get_user_token(requester_id)
-        send_push(token, 'Request Approved', f'{payer_name} approved your request for €{amount_cents/100:.2f}.')
+            # Update the original request transaction logs status
+            cursor.execute('''
+                UPDATE transactions SET status = 'completed' WHERE request_ref = ? AND status = 'pending'
+            ''', (request_id,))
+
+            # Notify Requester
+            dispatcher.enqueue(cursor, requester_id, 'Request Approved', f'{payer_name} approved your request for €{amount_cents/100:.2f}.')
+            return requester_id, payer_id, amount_cents
+
+        try:
+            approved = writes.run(apply_approval)
+        except ledger.InsufficientFunds:
+            return jsonify({'error': 'Insufficient balance'}), 400
+        if not approved:
+            return jsonify({'error': 'Request not found or already processed'}), 404
+        requester_id, payer_id, amount_cents = approved
+
+        dispatcher.wake()
+        user_directory.invalidate()
+        broker.publish([payer_id], 'pending_requests', {'request_id': request_id})
+        broker.publish([requester_id, payer_id], 'transactions')
 
-        conn.close()
         return jsonify({'message': 'Request approved and transferred', 'amount_cents': amount_cents})
     except Exception as e:
         print(f"Approve error: {e}")
@@ -492,118 +773,164 @@ def approve_request(request_id):
 @app.route('/deny_request/<int:request_id>', methods=['POST'])
 def deny_request(request_id):
     try:
-        conn = db_connect()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT requester_id, payer_id, amount_cents FROM pending_requests WHERE id = ? AND status = 'pending'
-        ''', (request_id,))
-        req = cursor.fetchone()
-        if not req:
-            conn.close()
-            return jsonify({'error': 'Request not found or already processed'}), 404
-        requester_id, payer_id, amount_cents = req
-
-        # Fetch payer name
-        cursor.execute('SELECT name FROM users WHERE id = ?', (payer_id,))
-        # Check if the fetch was successful before accessing index 0
-        payer_name_data = cursor.fetchone()
-        payer_name = payer_name_data[0] if payer_name_data else "Unknown"
-
-        # Update request status
-        cursor.execute('UPDATE pending_requests SET status = "denied" WHERE id = ?', (request_id,))
+        def apply_denial(cursor):
+            cursor.execute('''
+                SELECT requester_id, payer_id, amount_cents FROM pending_requests WHERE id = ? AND status = 'pending'
+            ''', (request_id,))
+            req = cursor.fetchone()
+            if not req:
+                return None
+            requester_id, payer_id, amount_cents = req
+
+            # Fetch payer name
+            cursor.execute('SELECT name FROM users WHERE id = ?', (payer_id,))
+            # Check if the fetch was successful before accessing index 0
+            payer_name_data = cursor.fetchone()
+            payer_name = payer_name_data[0] if payer_name_data else "Unknown"
+
+            # Update request status
+            cursor.execute('UPDATE pending_requests SET status = "denied" WHERE id = ?', (request_id,))
+
+            # Update the original request transaction logs status
+            cursor.execute('''
+                UPDATE transactions SET status = 'rejected' WHERE request_ref = ? AND status = 'pending'
+            ''', (request_id,))
+            
+            dispatcher.enqueue(cursor, requester_id, 'Request Denied', f'Your request from {payer_name} for €{amount_cents/100:.2f} denied.')
+            return requester_id, payer_id
 
-        # Update the original request transaction logs status
-        cursor.execute('''
-            UPDATE transactions SET status = 'rejected' WHERE request_ref = ? AND status = 'pending'
-        ''', (request_id,))
-        
-        conn.commit()
+        denied = writes.run(apply_denial)
+        if not denied:
+            return jsonify({'error': 'Request not found or already processed'}), 404
+        requester_id, payer_id = denied
 
-        token = get_user_token(requester_id)
-        send_push(token, 'Request Denied', f'Your request from {payer_name} for €{amount_cents/100:.2f} denied.')
+        dispatcher.wake()
+        broker.publish([payer_id], 'pending_requests', {'request_id': request_id})
+        broker.publish([requester_id, payer_id], 'transactions')
 
-        conn.close()
         return jsonify({'message': 'Request denied'})
     except Exception as e:
         print(f"Deny error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/requests/batch', methods=['POST'])
+def batch_requests():
+    try:
+        data = request.get_json()
+        # {'user_id': payer, 'items': [{'request_id': 1, 'action': 'approve' | 'deny'}, ...]}
+        try:
+            payer_id = int(data['user_id'])
+            items = request_batch.parse_items(data)
+        except (request_batch.BatchError, KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid batch: {e}'}), 400
+
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT name FROM users WHERE id = ?', (payer_id,))
+        payer_data = cursor.fetchone()
+        if not payer_data:
+            return jsonify({'error': 'User not found'}), 404
+        payer_name = payer_data[0]
+
+        def apply_batch(cursor):
+            results, per_requester = request_batch.apply_batch(cursor, payer_id, items)
+            # One notification per requester, however many of their requests were handled
+            dispatcher.enqueue_many(cursor, [
+                (requester_id, *request_batch.notification_text(payer_name, outcome))
+                for requester_id, outcome in per_requester.items()
+            ])
+            return results, per_requester
+
+        results, per_requester = ledger.run_immediate(conn, apply_batch)
+
+        counts = {'approved': 0, 'denied': 0}
+        for result in results:
+            if result['status'] in counts:
+                counts[result['status']] += 1
+        if per_requester:
+            dispatcher.wake()
+            broker.publish([payer_id], 'pending_requests')
+            broker.publish([payer_id, *per_requester], 'transactions')
+        if counts['approved']:
+            user_directory.invalidate()
+
+        return jsonify({
+            'results': results,
+            'approved': counts['approved'],
+            'denied': counts['denied'],
+            'failed': len(results) - counts['approved'] - counts['denied'],
+        })
+    except Exception as e:
+        print(f"Batch request error: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/split_request', methods=['POST'])
+@idempotency.idempotent
 def split_request():
     try:
         data = request.get_json()
         payer_iban = data['payer_iban']
-        recipients = data['recipients'] # [{'iban': '...', 'amount_cents': 1000}, ...]
         total_cents = int(data['total_cents'])
         
         if total_cents <= 0:
             return jsonify({'error': 'Total amount must be positive'}), 400
 
-        conn = db_connect()
-        cursor = conn.cursor()
+        # [{'iban': '...', 'amount_cents': 1000}, ...] or equal/weighted modes, see splits.compute_shares
+        try:
+            shares, payer_share_cents = splits.compute_shares(data, total_cents)
+        except (splits.SplitError, KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': f'Invalid split: {e}'}), 400
+
+        cursor = get_reader().cursor()
         
         # Get Payer ID and name (The one creating the requests)
         cursor.execute('SELECT id, name FROM users WHERE iban = ?', (payer_iban,))
-        payer_id, payer_name = cursor.fetchone()
-        
-        # Insert split_sent transaction log
-        memo = f"Razdeli račun {total_cents / 100:.2f}€"
-        cursor.execute('''
-            INSERT INTO transactions (type, initiator_id, amount_cents, status, memo)
-            VALUES ('split_sent', ?, ?, 'completed', ?)
-        ''', (payer_id, total_cents, memo))
-
-        split_sent_id = cursor.lastrowid
-
-        # Store requests and notify payers (recipients in the split)
-        new_request_count = 0
-        for recipient in recipients:
-            recipient_iban = recipient['iban']
-            amount_cents = int(recipient['amount_cents'])
-            
-            # Find the recipient's user ID (they are the Payer in this request)
-            cursor.execute('SELECT id, name FROM users WHERE iban = ?', (recipient_iban,))
-            recipient_user_data = cursor.fetchone()
-            if not recipient_user_data: continue # Skip if user not found
-            recipient_id, recipient_name = recipient_user_data
-            
-            # Check for existing request to prevent duplicates (same as request_money)
-            cursor.execute('''
-                SELECT id FROM pending_requests 
-                WHERE requester_id = ? AND payer_id = ? AND amount_cents = ? AND status = 'pending'
-            ''', (payer_id, recipient_id, amount_cents))
-            if cursor.fetchone():
-                print(f"Skipping duplicate pending request for {recipient_name}")
-                continue
-
-            # Insert pending request
-            cursor.execute('''
-                INSERT INTO pending_requests (requester_id, payer_id, amount_cents) 
-                VALUES (?, ?, ?)
-            ''', (payer_id, recipient_id, amount_cents))
-            request_id = cursor.lastrowid
-            new_request_count += 1
-            
-            # Insert transaction logs for this sub-request
-            memo = data.get('memo', '')  # Shared memo for split
-            # request_sent
-            cursor.execute('''
-                INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, memo, request_ref)
-                VALUES ('request_sent', ?, ?, ?, 'pending', ?, ?)
-            ''', (payer_id, recipient_id, amount_cents, memo, request_id))
-
-            
-            # Send notification to the recipient/payer
-            token = get_user_token(recipient_id)
-            send_push(token, 'Bill Split Request', f'{payer_name} requested €{amount_cents/100:.2f} from you to split a bill.')
-
-        conn.commit()
-        conn.close()
-        
-        if new_request_count == 0:
-            return jsonify({'message': 'No new split requests were created (possible duplicates).', 'total_cents': total_cents})
+        payer_data = cursor.fetchone()
+        if not payer_data:
+            return jsonify({'error': 'Payer not found'}), 404
+        payer_id, payer_name = payer_data
 
-        return jsonify({'message': f'Split request created: {new_request_count} payment requests sent.', 'total_cents': total_cents})
+        # Splitting within a group tags the requests so /groups/<id>/settle can net them
+        group_id = data.get('group_id')
+        if group_id is not None:
+            member_ibans = {iban for _, iban in settle.members(cursor, group_id).values()}
+            if payer_iban not in member_ibans or any(iban not in member_ibans for iban, _ in shares):
+                return jsonify({'error': 'Payer and recipients must all be members of the group'}), 400
+
+        split_memo = f"Razdeli račun {total_cents / 100:.2f}€"
+        memo = data.get('memo', '')  # Shared memo for split
+
+        def apply_split(cursor):
+            created, duplicates, unknown = splits.create_split(cursor, payer_id, total_cents, shares, memo, split_memo,
+                                                               group_id)
+            # Send notification to the recipients/payers, delivered once the commit lands
+            dispatcher.enqueue_many(cursor, [
+                (recipient_id, 'Bill Split Request', f'{payer_name} requested €{amount_cents/100:.2f} from you to split a bill.')
+                for recipient_id, _, amount_cents in created
+            ])
+            return created, duplicates, unknown
+
+        created, duplicates, unknown = writes.run(apply_split)
+        for recipient_name in duplicates:
+            print(f"Skipping duplicate pending request for {recipient_name}")
+
+        notified_ids = [recipient_id for recipient_id, _, _ in created]
+        dispatcher.wake()
+        broker.publish(notified_ids, 'pending_requests')
+        broker.publish([payer_id] + notified_ids, 'transactions')
+
+        result = {
+            'total_cents': total_cents,
+            'payer_share_cents': payer_share_cents,
+            'created': len(created),
+            'skipped_duplicates': len(duplicates),
+            'unknown_ibans': unknown,
+        }
+        if not created:
+            result['message'] = 'No new split requests were created (possible duplicates).'
+        else:
+            result['message'] = f'Split request created: {len(created)} payment requests sent.'
+        return jsonify(result)
     except Exception as e:
         print(f"Split request error: {e}")
         return jsonify({'error': str(e)}), 500
@@ -618,53 +945,32 @@ def get_groups():
         if not user_id:
             return jsonify({'error': 'user_id is required'}), 400
 
-        conn = db_connect()
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            f'''
-            SELECT 
-                g.id, 
-                g.name, 
-                g.creator_id, 
-                g.member_ids,
-                g.created_at  -- *** ADDED ***
-            FROM groups g
-            WHERE g.creator_id = ? 
-            
-            UNION 
-            
-            SELECT 
-                g.id, 
-                g.name, 
-                g.creator_id, 
-                g.member_ids,
-                g.created_at  -- *** ADDED ***
-            FROM groups g, json_each(g.member_ids)
-            WHERE json_each.value = ? 
-            
-            ORDER BY created_at DESC; -- This now correctly refers to the selected column
-            ''', (user_id, user_id)
-        )
+        # `mine` is an index lookup on group_members(user_id); members are gathered per group
+        sql = '''
+            SELECT g.id, g.name, g.creator_id, group_concat(m.user_id)
+            FROM group_members mine
+            JOIN groups g ON g.id = mine.group_id
+            JOIN group_members m ON m.group_id = g.id
+            WHERE mine.user_id = ?
+            GROUP BY g.id
+            ORDER BY g.created_at DESC, g.id DESC
+        '''
+        if columnar.requested(request):
+            return columnar_response(sql, (user_id,), ('id', 'name', 'creator_id', 'member_ids'), convert=lambda row: (
+                *row[:3], [int(member_id) for member_id in row[3].split(',')]))
+
+        cursor = get_reader().cursor()
+        cursor.execute(sql, (user_id,))
         
         groups_list = []
-        for id, name, creator_id, member_ids_json, _ in cursor.fetchall(): 
-            try:
-                member_ids = json.loads(member_ids_json)
-            except json.JSONDecodeError:
-                member_ids = []
-            
-            if creator_id is not None and creator_id not in member_ids:
-                member_ids.append(creator_id)
-            
+        for id, name, creator_id, member_ids_csv in cursor.fetchall(): 
             groups_list.append({
                 'id': id,
                 'name': name,
                 'creator_id': creator_id,
-                'member_ids': member_ids
+                'member_ids': [int(member_id) for member_id in member_ids_csv.split(',')]
             })
             
-        conn.close()
         return jsonify(groups_list)
     except Exception as e:
         print(f"Fetch groups error: {e}")
@@ -689,16 +995,22 @@ def create_group():
         # Serialize the list of member IDs to a JSON string for storage
         member_ids_json = json.dumps(member_ids_list)
 
-        conn = db_connect()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO groups (name, creator_id, member_ids) 
-            VALUES (?, ?, ?)
-        ''', (name, creator_id, member_ids_json))
-        group_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        def apply_group(cursor):
+            cursor.execute('''
+                INSERT INTO groups (name, creator_id, member_ids) 
+                VALUES (?, ?, ?)
+            ''', (name, creator_id, member_ids_json))
+            group_id = cursor.lastrowid
+
+            # The creator is a member too, so /groups finds the group with one index lookup
+            members = set(member_ids_list)
+            members.add(creator_id)
+            cursor.executemany('''
+                INSERT INTO group_members (group_id, user_id) VALUES (?, ?)
+            ''', [(group_id, member_id) for member_id in members])
+            return group_id
+
+        group_id = writes.run(apply_group)
         
         return jsonify({
             'message': 'Group created successfully', 
@@ -711,7 +1023,150 @@ def create_group():
         print(f"Create group error: {e}")
         return jsonify({'error': str(e)}), 500
 
+# --- Group settle-up: net what members owe each other into as few transfers as possible ---
+
+@app.route('/groups/<int:group_id>/settle', methods=['GET'])
+def preview_settlement(group_id):
+    try:
+        user_id = request.args.get('user_id', type=int)
+        if not user_id:
+            return jsonify({'error': 'user_id is required'}), 400
+
+        try:
+            settlement = settle.plan(get_reader().cursor(), group_id, user_id)
+        except settle.NotAMember as e:
+            return jsonify({'error': str(e)}), 403
+        except settle.SettleError as e:
+            # The group's debts can't be settled as they stand (e.g. they involve ex-members)
+            return jsonify({'error': str(e)}), 409
+        if settlement is None:
+            return jsonify({'error': 'Group not found'}), 404
+        return jsonify(settlement)
+    except Exception as e:
+        print(f"Settle preview error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/groups/<int:group_id>/settle', methods=['POST'])
+@idempotency.idempotent
+def execute_settlement(group_id):
+    try:
+        data = request.get_json()
+        # {'user_id': member, 'fingerprint': '...' from the preview (optional, rejects a stale plan)}
+        try:
+            user_id = int(data['user_id'])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'error': 'user_id is required'}), 400
+        fingerprint = data.get('fingerprint')
+
+        conn = get_db()
+
+        def apply_settlement(cursor):
+            settlement = settle.execute(cursor, group_id, user_id, fingerprint)
+            if settlement and settlement['transfers']:
+                # Each member hears about their own part of the plan once the commit lands
+                notes = {}
+                for t in settlement['transfers']:
+                    notes.setdefault(t['from_id'], []).append(f"€{t['amount_cents']/100:.2f} to {t['to_name']}")
+                    notes.setdefault(t['to_id'], []).append(f"€{t['amount_cents']/100:.2f} from {t['from_name']}")
+                dispatcher.enqueue_many(cursor, [
+                    (member_id, 'Group Settled', f"{settlement['name']}: " + ', '.join(parts) + '.')
+                    for member_id, parts in notes.items()
+                ])
+            return settlement
+
+        try:
+            settlement = ledger.run_immediate(conn, apply_settlement)
+        except settle.NotAMember as e:
+            return jsonify({'error': str(e)}), 403
+        except settle.PlanChanged as e:
+            return jsonify({'error': str(e)}), 409
+        except settle.SettleError as e:
+            return jsonify({'error': str(e)}), 409
+        except ledger.InsufficientFunds:
+            return jsonify({'error': "Insufficient balance: a member can't cover their part of the settlement"}), 400
+        if settlement is None:
+            return jsonify({'error': 'Group not found'}), 404
+
+        affected = [member['user_id'] for member in settlement['balances']]
+        if affected:
+            dispatcher.wake()
+            user_directory.invalidate()
+            broker.publish(affected, 'pending_requests')
+            broker.publish(affected, 'transactions')
+        return jsonify(settlement)
+    except Exception as e:
+        print(f"Settle error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# --- Pool Stats Endpoint ---
+@app.route('/db_stats', methods=['GET'])
+def db_stats():
+    return jsonify({**pool.stats(), 'readers': readers.stats()})
+
+# --- Prometheus metrics ---
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not metrics.enabled:
+        return jsonify({'error': 'Metrics are disabled (METRICS_ENABLED=0)'}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# --- Server-Sent Events: tells clients when to refetch instead of polling ---
+@app.route('/events', methods=['GET'])
+def events():
+    user_id = request.args.get('user_id', type=int)
+    if not user_id:
+        return jsonify({'error': 'user_id is required'}), 400
+
+    # EventSource resends the last id it saw when it reconnects
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        stream = broker.stream(user_id, last_event_id)
+    except TooManyStreams:
+        # The client falls back to refetching and tries again later
+        response = jsonify({'error': 'Too many open event streams on this server, try again later'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    return Response(
+        stream,
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+@app.route('/events/stats', methods=['GET'])
+def events_stats():
+    return jsonify(broker.stats())
+
+@app.route('/push_stats', methods=['GET'])
+def push_stats():
+    return jsonify(dispatcher.stats())
+
+@app.route('/write_stats', methods=['GET'])
+def write_stats():
+    return jsonify(writes.stats())
+
+@app.route('/idempotency_stats', methods=['GET'])
+def idempotency_stats():
+    return jsonify(idempotency.stats())
+
+@app.route('/qr_stats', methods=['GET'])
+def qr_stats():
+    return jsonify(qr_tokens.stats())
+
 # --- NEW: Transactions Endpoint ---
+TRANSACTIONS_PAGE_SIZE = 50
+TRANSACTIONS_MAX_PAGE_SIZE = 200
+# Columnar pages are streamed, so they can be much longer (e.g. a full-history export)
+TRANSACTIONS_MAX_COLUMNAR_PAGE_SIZE = 100000
+TRANSACTIONS_COLUMNAR_FIELDS = ('id', 'type', 'initiator_id', 'target_id', 'amount_cents', 'status', 'timestamp',
+                                'memo', 'request_ref', 'initiator_name', 'target_name')
+
+def parse_transactions_cursor(value):
+    # Cursor is "<timestamp>|<id>" of the last row on the previous page
+    timestamp, _, row_id = value.rpartition('|')
+    if not timestamp or not row_id.isdigit():
+        raise ValueError('Invalid cursor')
+    return timestamp, int(row_id)
+
 @app.route('/transactions', methods=['GET'])
 def get_transactions():
     try:
@@ -719,19 +1174,67 @@ def get_transactions():
         if not user_id:
             return jsonify({'error': 'user_id is required'}), 400
 
-        conn = db_connect()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT 
-                t.id, t.type, t.initiator_id, t.target_id, t.amount_cents, 
-                t.status, t.timestamp, t.memo, t.request_ref,
-                u1.name as initiator_name, u2.name as target_name
-            FROM transactions t
-            LEFT JOIN users u1 ON t.initiator_id = u1.id
-            LEFT JOIN users u2 ON t.target_id = u2.id
-            WHERE t.initiator_id = ? OR t.target_id = ?
-            ORDER BY t.timestamp DESC
-        ''', (user_id, user_id))
+        as_columns = columnar.requested(request)
+        limit = request.args.get('limit', TRANSACTIONS_PAGE_SIZE, type=int)
+        limit = max(1, min(limit, TRANSACTIONS_MAX_COLUMNAR_PAGE_SIZE if as_columns else TRANSACTIONS_MAX_PAGE_SIZE))
+
+        # Optional filters, applied in both branches of the UNION below
+        filters = ''
+        params = {'user_id': user_id, 'limit': limit}
+        before = request.args.get('before')
+        if before:
+            try:
+                params['before_ts'], params['before_id'] = parse_transactions_cursor(before)
+            except ValueError:
+                return jsonify({'error': 'Invalid before cursor'}), 400
+            filters += ' AND (t.timestamp < :before_ts OR (t.timestamp = :before_ts AND t.id < :before_id))'
+        if request.args.get('type'):
+            params['type'] = request.args['type']
+            filters += ' AND t.type = :type'
+        if request.args.get('status'):
+            params['status'] = request.args['status']
+            filters += ' AND t.status = :status'
+
+        # Each branch walks its own (user, timestamp) index newest-first, and SQLite merges
+        # the two already-ordered branches (MERGE UNION ALL) instead of sorting the page.
+        # Rows come out one at a time and the scan stops at `limit`, so neither a page nor a
+        # streamed columnar export ever materializes the user's history. The second branch
+        # skips rows where the user is also the initiator so nothing is returned twice.
+        # Archived months (archive.py) are the same query against an attached file, merged
+        # in only once the page reaches back to them.
+        def sql_for(table):
+            branch = f'''
+                SELECT
+                    t.id, t.type, t.initiator_id, t.target_id, t.amount_cents,
+                    t.status, t.timestamp, t.memo, t.request_ref,
+                    u1.name as initiator_name, u2.name as target_name
+                FROM {table} t
+                LEFT JOIN users u1 ON t.initiator_id = u1.id
+                LEFT JOIN users u2 ON t.target_id = u2.id
+            '''
+            return f'''
+                {branch} WHERE t.initiator_id = :user_id{filters}
+                UNION ALL
+                {branch} WHERE t.target_id = :user_id AND t.initiator_id != :user_id{filters}
+                ORDER BY 7 DESC, 1 DESC
+                LIMIT :limit
+            '''
+
+        def history(conn):
+            return archive.history(conn, ARCHIVE_DIR, sql_for, params, limit, key=lambda row: (row[6], row[0]),
+                                   before=params.get('before_ts'))
+
+        if as_columns:
+            opened = []
+            def open_history(conn):
+                opened.append(history(conn))
+                return opened[0]
+            def next_page(last_row, count):
+                more = count == limit or opened[0].truncated
+                return {'next_before': f'{last_row[6]}|{last_row[0]}' if more and last_row else None}
+            return columnar_response(open_history, params, TRANSACTIONS_COLUMNAR_FIELDS, trailer=next_page)
+
+        cursor = history(get_reader())
         
         transactions_list = []
         for row in cursor.fetchall():
@@ -747,12 +1250,40 @@ def get_transactions():
                 'initiator_name': row[9],
                 'target_name': row[10]
             })
+
+        next_before = None
+        if transactions_list and (len(transactions_list) == limit or cursor.truncated):
+            last = transactions_list[-1]
+            next_before = f"{last['timestamp']}|{last['id']}"
         
-        conn.close()
-        return jsonify(transactions_list)
+        return jsonify({'transactions': transactions_list, 'next_before': next_before})
     except Exception as e:
         print(f"Fetch transactions error: {e}")
         return jsonify({'error': str(e)}), 500
 
+# --- Monthly statements (precomputed, see statements.py) ---
+@app.route('/statements', methods=['GET'])
+def get_statements():
+    try:
+        user_id = request.args.get('user_id', type=int)
+        if not user_id:
+            return jsonify({'error': 'user_id is required'}), 400
+        try:
+            month = statements.parse_month(request.args.get('month') or statements.current_month())
+        except ValueError:
+            return jsonify({'error': 'month must be YYYY-MM'}), 400
+
+        return jsonify(statements.get_statement(get_reader().cursor(), user_id, month))
+    except Exception as e:
+        print(f"Statements error: {e}")
+        return jsonify({'error': str(e)}), 500
+
 if __name__ == '__main__':
+    # Development server only; production runs `gunicorn -c gunicorn.conf.py app:app`
+    # Local development convenience: bring the database up to date before serving
+    conn = pool.acquire()
+    migrations.upgrade(conn)
+    migrations.seed(conn)
+    pool.release(conn)
+    check_schema()
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,285 @@
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+
+import ledger
+import statements
+
+# Hot/cold tiering of `transactions`. Rows in a final status and older than
+# a configurable age move, a small batch at a time, into one SQLite file per
+# month (<archive dir>/transactions-YYYY-MM.db). The hot table keeps recent
+# and still-pending rows, so it stays small and its pages stay cached. A
+# history read ATTACHes a month's file only once a page reaches back that far.
+
+# Months archived so far are listed in the hot database's transaction_archives
+# (migration 12). `oldest` and `newest` bound each file's timestamps, so a
+# reader can tell which months a page reaches.
+
+# Columns copied into archive files; a migration adding a column to transactions must add it here too
+COLUMNS = ('id', 'type', 'initiator_id', 'target_id', 'amount_cents', 'status', 'timestamp', 'memo', 'request_ref',
+           'group_id')
+
+ARCHIVE_TABLE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {schema}.transactions (
+        id INTEGER PRIMARY KEY,
+        type TEXT NOT NULL,
+        initiator_id INTEGER NOT NULL,
+        target_id INTEGER,
+        amount_cents INTEGER,
+        status TEXT,
+        timestamp TIMESTAMP,
+        memo TEXT,
+        request_ref INTEGER,
+        group_id INTEGER
+    )
+'''
+
+# The same history indexes as the hot table, so a page reads an archive the same way
+ARCHIVE_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_transactions_initiator_ts ON transactions (initiator_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS {schema}.idx_transactions_target_ts ON transactions (target_id, timestamp)',
+)
+
+# Statuses a transaction never leaves
+FINAL_STATUSES = ('completed', 'rejected', 'settled')
+
+# SQLite allows 10 attached databases by default; a connection keeps at most this many archives attached
+MAX_ATTACHED = 8
+
+
+def filename(month):
+    return f'transactions-{month}.db'
+
+
+def schema_name(month):
+    # Schema names can't be bound parameters, so only a well-formed month gets this far
+    return 'archive_' + statements.parse_month(month).replace('-', '_')
+
+
+def months(cursor):
+    # (month, filename, oldest, newest) of every archive, newest first
+    cursor.execute('SELECT month, filename, oldest, newest FROM transaction_archives ORDER BY newest DESC')
+    return cursor.fetchall()
+
+
+def _attached(conn):
+    return [row[1] for row in conn.execute('PRAGMA database_list') if row[1].startswith('archive_')]
+
+
+# --- Reading ---
+
+class HistoryCursor:
+    """Rows of the hot table and the archives merged newest first, read like a sqlite3 cursor.
+
+    `sql_for(table)` gives the page query against one table, ordered by
+    `key` descending and limited to the page size. Hot rows are read first.
+    A month's archive is attached and queried only once the merged rows
+    reach its newest timestamp, so recent pages never touch an archive.
+    `truncated` is set if the page stopped early because no more archives
+    could be attached; the rest comes with the next page.
+    """
+
+    def __init__(self, conn, directory, archives, sql_for, params, limit, key, before=None):
+        self.conn = conn
+        self.directory = directory
+        self.sql_for = sql_for
+        self.params = params
+        self.limit = limit
+        self.key = key
+        self.truncated = False
+        # Months wholly newer than the page cursor can't have rows for it
+        self._pending = [a for a in archives if before is None or a[2] <= before]
+        # Nothing runs on the connection yet, so archives no page needs can be detached now
+        wanted = {schema_name(month) for month, _, _, _ in self._pending[:MAX_ATTACHED]}
+        for schema in _attached(conn):
+            if schema not in wanted:
+                try:
+                    conn.execute(f'DETACH DATABASE {schema}')
+                except sqlite3.OperationalError:
+                    pass
+        self._rows = self._merge()
+
+    def _open(self, table):
+        cursor = self.conn.execute(self.sql_for(table), self.params)
+        row = cursor.fetchone()
+        return [row, cursor] if row is not None else None
+
+    def _open_archive(self, month, name):
+        schema = schema_name(month)
+        if schema not in _attached(self.conn):
+            if len(_attached(self.conn)) >= MAX_ATTACHED:
+                return False
+            self.conn.execute(f'ATTACH DATABASE ? AS {schema}', (os.path.join(self.directory, name),))
+        return self._open(f'{schema}.transactions')
+
+    def _merge(self):
+        sources = [source for source in (self._open('transactions'),) if source]
+        count, last_key = 0, None
+        while count < self.limit:
+            head = max(sources, key=lambda source: self.key(source[0]), default=None)
+            if self._pending and (head is None or self._pending[0][3] >= self.key(head[0])[0]):
+                month, name, _, _ = self._pending[0]
+                source = self._open_archive(month, name)
+                if source is False:
+                    self.truncated = True
+                    return
+                self._pending.pop(0)
+                if source:
+                    sources.append(source)
+                continue
+            if head is None:
+                return
+            row, cursor = head
+            # A row caught between an archive copy and its hot delete shows up in both; keep one
+            if self.key(row) != last_key:
+                last_key = self.key(row)
+                count += 1
+                yield row
+            head[0] = cursor.fetchone()
+            if head[0] is None:
+                sources.remove(head)
+
+    def fetchmany(self, size):
+        rows = []
+        for row in self._rows:
+            rows.append(row)
+            if len(rows) == size:
+                break
+        return rows
+
+    def fetchall(self):
+        return list(self._rows)
+
+
+def history(conn, directory, sql_for, params, limit, key, before=None):
+    """A HistoryCursor over `transactions` and its archives; `before` is the page cursor's timestamp."""
+    return HistoryCursor(conn, directory, months(conn.cursor()), sql_for, params, limit, key, before)
+
+
+# --- Archiving ---
+
+class Archiver:
+    """Moves final transactions older than `min_age_days` into per-month archive files.
+
+    Only whole months are archived, so every final row of an archived month
+    is in its file and the statements rollup can leave the month alone.
+    Group transfers a settle-up hasn't covered yet stay hot for settle.py.
+
+    Each batch of up to `batch_size` rows is copied into its month's file in
+    one transaction (which holds no lock on the hot database), then deleted
+    from the hot table with the registry update in a second, short
+    BEGIN IMMEDIATE. Writers wait at most one batch, and `pause` seconds
+    between batches leave them room. The archive commit is made durable
+    before the delete. A crash between the two leaves rows in both places:
+    readers skip the duplicates and the next run finishes the move.
+    """
+
+    def __init__(self, conn, directory, min_age_days=90, batch_size=500, pause=0.05):
+        self.conn = conn
+        self.directory = directory
+        self.min_age_days = min_age_days
+        self.batch_size = batch_size
+        self.pause = pause
+        self.batches = 0
+        self.rows = 0
+        self.months = set()
+        self.copy_seconds = 0.0
+        self.delete_seconds = 0.0
+
+    def cutoff(self, now=None):
+        # First instant of the month the age limit falls in; everything before it can go
+        edge = (now or datetime.now(timezone.utc)) - timedelta(days=self.min_age_days)
+        return edge.strftime('%Y-%m-01 00:00:00')
+
+    def run(self, max_batches=None, log=print):
+        """Archive batches until nothing is left before the cutoff (or `max_batches` ran); returns rows moved."""
+        cutoff = self.cutoff()
+        os.makedirs(self.directory, exist_ok=True)
+        after = 0
+        while max_batches is None or self.batches < max_batches:
+            candidates = self._candidates(cutoff, after)
+            if not candidates:
+                break
+            # Rows before the first candidate aren't archivable, so later scans can start past them
+            after = candidates[0][0] - 1
+            month = candidates[0][1][:7]
+            ids = [row_id for row_id, timestamp in candidates if timestamp[:7] == month]
+            moved = self._move(month, ids)
+            self.batches += 1
+            self.rows += moved
+            self.months.add(month)
+            if log and self.batches % 100 == 0:
+                log(f"Archived {self.rows} rows in {self.batches} batches (now at {month}).")
+            time.sleep(self.pause)
+        return self.rows
+
+    def _candidates(self, cutoff, after):
+        statuses = ','.join('?' * len(FINAL_STATUSES))
+        return self.conn.execute(f'''
+            SELECT t.id, t.timestamp FROM transactions t
+            WHERE t.id > ? AND t.timestamp < ? AND t.status IN ({statuses})
+              AND (t.group_id IS NULL
+                   OR t.id <= (SELECT g.settled_through_tx FROM groups g WHERE g.id = t.group_id))
+            ORDER BY t.id
+            LIMIT ?
+        ''', (after, cutoff, *FINAL_STATUSES, self.batch_size)).fetchall()
+
+    def _move(self, month, ids):
+        schema = schema_name(month)
+        name = filename(month)
+        if schema not in _attached(self.conn):
+            # Batches go through the months in order, so the previous month's file is done with
+            self.close()
+            self.conn.execute(f'ATTACH DATABASE ? AS {schema}', (os.path.join(self.directory, name),))
+            self.conn.execute(f'PRAGMA {schema}.journal_mode = WAL')
+            # The copy must survive a power loss before the hot rows are deleted
+            self.conn.execute(f'PRAGMA {schema}.synchronous = FULL')
+            self.conn.execute(ARCHIVE_TABLE_SCHEMA.format(schema=schema))
+            for index in ARCHIVE_INDEXES:
+                self.conn.execute(index.format(schema=schema))
+        id_list = ','.join('?' * len(ids))
+        columns = ', '.join(COLUMNS)
+
+        started = time.perf_counter()
+        self.conn.execute('BEGIN')
+        try:
+            self.conn.execute(f'''
+                INSERT OR IGNORE INTO {schema}.transactions ({columns})
+                SELECT {columns} FROM main.transactions WHERE id IN ({id_list})
+            ''', ids)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        copied = time.perf_counter()
+
+        def work(cursor):
+            # Registered first, so the statements delete trigger knows these rows are archived
+            cursor.execute(f'''
+                INSERT INTO transaction_archives (month, filename, row_count, oldest, newest)
+                SELECT ?, ?, COUNT(*), MIN(timestamp), MAX(timestamp) FROM main.transactions WHERE id IN ({id_list})
+                ON CONFLICT (month) DO UPDATE SET
+                    row_count = row_count + excluded.row_count,
+                    oldest = MIN(oldest, excluded.oldest),
+                    newest = MAX(newest, excluded.newest)
+            ''', (month, name, *ids))
+            cursor.execute(f'DELETE FROM main.transactions WHERE id IN ({id_list})', ids)
+            return cursor.rowcount
+        moved = ledger.run_immediate(self.conn, work)
+        self.copy_seconds += copied - started
+        self.delete_seconds += time.perf_counter() - copied
+        return moved
+
+    def close(self):
+        for schema in _attached(self.conn):
+            self.conn.execute(f'DETACH DATABASE {schema}')
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'rows': self.rows,
+            'months': sorted(self.months),
+            'copy_ms_total': round(self.copy_seconds * 1000, 1),
+            'delete_ms_total': round(self.delete_seconds * 1000, 1),
+        }
@@ -0,0 +1,328 @@
+"""Latency and throughput benchmark for the payments API.
+
+Builds (or reuses) a synthetic database, copies it to a scratch file, and
+drives the real Flask routes from several threads. Two runners are
+available:
+
+  - test_client: the Flask test client, which measures app and SQLite cost only
+  - wsgi: a threaded Werkzeug server on localhost with keep-alive HTTP clients
+
+Push notifications go to a local Expo stub (expo_stub.py), never to Expo.
+For each endpoint the report gives p50/p95/p99 latency and requests/s.
+Results can be written to a baseline JSON file. Comparing a later run
+against that file shows regressions as diffs:
+
+    python bench/api_bench.py --scale small --save bench/baselines/small.json
+    python bench/api_bench.py --scale small --compare bench/baselines/small.json
+"""
+import argparse
+import http.client
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import expo_stub
+import migrations
+from synthetic_db import SCALES, build, user_iban
+
+# Seeded databases are cached here between runs (gitignored)
+DATA_DIR = os.path.join(BACKEND_DIR, 'bench', 'data')
+
+ENDPOINTS = (
+    'GET /users',
+    'GET /transactions',
+    'GET /pending_requests',
+    'GET /pending_requests/summary',
+    'GET /groups',
+    'POST /transfer_money',
+    'POST /split_request',
+)
+
+
+def make_request(endpoint, rng, users):
+    """(method, path, json_body) for one randomized call to `endpoint`."""
+    user_id = rng.randint(1, users)
+    if endpoint == 'GET /users':
+        return 'GET', '/users', None
+    if endpoint == 'GET /transactions':
+        return 'GET', f'/transactions?user_id={user_id}', None
+    if endpoint == 'GET /pending_requests':
+        return 'GET', f'/pending_requests?user_id={user_id}', None
+    if endpoint == 'GET /pending_requests/summary':
+        return 'GET', f'/pending_requests/summary?user_id={user_id}', None
+    if endpoint == 'GET /groups':
+        return 'GET', f'/groups?user_id={user_id}', None
+    if endpoint == 'POST /transfer_money':
+        receiver = rng.randint(1, users - 1)
+        receiver += receiver >= user_id
+        return 'POST', '/transfer_money', {
+            'sender_iban': user_iban(user_id),
+            'receiver_iban': user_iban(receiver),
+            'amount_cents': rng.randint(1, 500),
+        }
+    if endpoint == 'POST /split_request':
+        recipients = rng.sample(range(1, users + 1), min(users, 4))
+        return 'POST', '/split_request', {
+            'payer_iban': user_iban(user_id),
+            'total_cents': rng.randint(100, 100000),
+            'mode': 'equal',
+            'recipients': [{'iban': user_iban(r)} for r in recipients if r != user_id][:3],
+        }
+    raise ValueError(f'Unknown endpoint: {endpoint}')
+
+
+class TestClientRunner:
+    name = 'test_client'
+
+    def __init__(self, app):
+        self.app = app
+
+    def client(self):
+        client = self.app.test_client()
+
+        def call(method, path, body):
+            return client.open(path, method=method, json=body).status_code
+        return call
+
+    def close(self):
+        pass
+
+
+class WSGIRunner:
+    name = 'wsgi'
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def client(self):
+        host, port = self.server.server_address[:2]
+        connection = http.client.HTTPConnection(host, port)
+
+        def call(method, path, body):
+            nonlocal connection
+            headers = {}
+            data = None
+            if body is not None:
+                data = json.dumps(body)
+                headers['Content-Type'] = 'application/json'
+            try:
+                connection.request(method, path, data, headers)
+                response = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                # Server closed the keep-alive connection; retry once on a new one
+                connection.close()
+                connection = http.client.HTTPConnection(host, port)
+                connection.request(method, path, data, headers)
+                response = connection.getresponse()
+            response.read()
+            return response.status
+        return call
+
+    def close(self):
+        self.server.shutdown()
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile on an already sorted list
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_endpoint(runner, endpoint, users, threads, requests, warmup, seed):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    per_thread = max(1, requests // threads)
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(index):
+        rng = random.Random(f'{seed}-{endpoint}-{index}')
+        call = runner.client()
+        for _ in range(max(1, warmup // threads)):
+            call(*make_request(endpoint, rng, users))
+        local_latencies, local_errors = [], []
+        barrier.wait()
+        for _ in range(per_thread):
+            request = make_request(endpoint, rng, users)
+            started = time.perf_counter()
+            status = call(*request)
+            local_latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                local_errors.append(status)
+        with lock:
+            latencies.extend(local_latencies)
+            errors.extend(local_errors)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ms = [value * 1000 for value in latencies]
+    return {
+        'requests': len(ms),
+        'errors': len(errors),
+        'rps': round(len(ms) / elapsed, 1),
+        'mean_ms': round(sum(ms) / len(ms), 3),
+        'p50_ms': round(percentile(ms, 0.50), 3),
+        'p95_ms': round(percentile(ms, 0.95), 3),
+        'p99_ms': round(percentile(ms, 0.99), 3),
+        'max_ms': round(ms[-1], 3),
+    }
+
+
+def print_results(results):
+    print(f"{'runner':<12} {'endpoint':<30} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for runner_name, endpoints in results.items():
+        for endpoint, stats in endpoints.items():
+            print(f"{runner_name:<12} {endpoint:<30} {stats['rps']:>9.1f} {stats['p50_ms']:>9.2f} "
+                  f"{stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f} {stats['errors']:>7}")
+
+
+# Sub-millisecond p95 moves are scheduler noise, not regressions
+MIN_P95_DELTA_MS = 1.0
+
+
+def compare(results, baseline, tolerance):
+    """Print per-endpoint changes against a baseline; returns the list of regressions."""
+    regressions = []
+    print(f"\n{'runner':<12} {'endpoint':<30} {'req/s':>16} {'p95 ms':>16}")
+    for runner_name, endpoints in results.items():
+        for endpoint, stats in endpoints.items():
+            before = baseline.get('results', {}).get(runner_name, {}).get(endpoint)
+            if not before:
+                continue
+            rps_change = (stats['rps'] - before['rps']) / before['rps'] if before['rps'] else 0.0
+            p95_change = (stats['p95_ms'] - before['p95_ms']) / before['p95_ms'] if before['p95_ms'] else 0.0
+            flag = ''
+            p95_slower = p95_change > tolerance and stats['p95_ms'] - before['p95_ms'] > MIN_P95_DELTA_MS
+            if rps_change < -tolerance or p95_slower:
+                flag = '  REGRESSION'
+                regressions.append((runner_name, endpoint))
+            print(f"{runner_name:<12} {endpoint:<30} {rps_change:>+15.1%} {p95_change:>+15.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--db', help='seeded database to copy (default: bench/data/<scale>.db, built if missing)')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the seeded database first')
+    parser.add_argument('--runner', choices=('test_client', 'wsgi', 'both'), default='both')
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS), metavar='ENDPOINT')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000, help='measured requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=100, help='unmeasured requests per endpoint')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', help='write results to this baseline JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to diff against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed fractional drop in req/s or rise in p95 before --compare fails')
+    args = parser.parse_args()
+
+    seeded = args.db or os.path.join(DATA_DIR, f'{args.scale}.db')
+    if args.rebuild or not os.path.exists(seeded):
+        os.makedirs(os.path.dirname(os.path.abspath(seeded)), exist_ok=True)
+        build(seeded, seed=args.seed, **SCALES[args.scale])
+
+    # Writes during the run go to a scratch copy so every run starts from the same data
+    workdir = tempfile.mkdtemp(prefix='api-bench-')
+    db_path = os.path.join(workdir, 'payments.db')
+    shutil.copyfile(seeded, db_path)
+    conn = sqlite3.connect(db_path)
+    # Cached seeds may predate newer migrations
+    migrations.upgrade(conn, log=lambda message: None)
+    users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    sizes = {
+        'users': users,
+        'transactions': conn.execute('SELECT MAX(id) FROM transactions').fetchone()[0],
+        'groups': conn.execute('SELECT COUNT(*) FROM groups').fetchone()[0],
+        'pending': conn.execute("SELECT COUNT(*) FROM pending_requests WHERE status = 'pending'").fetchone()[0],
+    }
+    conn.close()
+
+    stub = expo_stub.make_server()
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    os.environ['DB_PATH'] = db_path
+    os.environ['EXPO_PUSH_URL'] = expo_stub.push_url(stub)
+
+    import app as payments
+
+    runners = [TestClientRunner, WSGIRunner]
+    if args.runner != 'both':
+        runners = [r for r in runners if r.name == args.runner]
+
+    results = {}
+    try:
+        for runner_class in runners:
+            runner = runner_class(payments.app)
+            try:
+                for endpoint in args.endpoints:
+                    results.setdefault(runner.name, {})[endpoint] = run_endpoint(
+                        runner, endpoint, users, args.threads, args.requests, args.warmup, args.seed)
+            finally:
+                runner.close()
+    finally:
+        payments.dispatcher.stop(drain=True)
+        stub.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print()
+    print_results(results)
+    print(f"\npushes delivered to stub: {len(stub.received)}")
+
+    report = {
+        'meta': {
+            'scale': args.scale,
+            'sizes': sizes,
+            'threads': args.threads,
+            'requests': args.requests,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"saved {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""Hot/cold tiering of transactions (archive.py): what archiving costs and what it buys.
+
+Works on a scratch copy of a synthetic database (see synthetic_db.py),
+whose history covers 2025. The run reports:
+
+  request_ref   the pending request_sent lookup that approve/deny run, with
+                the partial request_ref index and with a full scan (NOT INDEXED),
+                the way every approve and deny ran before
+  archive       rows/s moved by Archiver.run() while --threads threads keep
+                making transfers, and those transfers' p50/p99/max latency
+                compared with the same load without archiving
+  pages         /transactions latency for the first page and for a page
+                --depth pages back, before archiving (all hot) and after (the
+                synthetic history is all past the cutoff, so both read attached
+                archives); the page must return the same rows either way
+
+    python bench/archive_bench.py --scale medium --threads 4
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import expo_stub
+from api_bench import percentile
+from synthetic_db import SCALES, build, user_iban
+
+DATA_DIR = os.path.join(BACKEND_DIR, 'bench', 'data')
+
+
+def time_calls(call, count):
+    latencies = []
+    for _ in range(count):
+        started = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return sorted(latencies)
+
+
+def transfer_load(payments, users, threads, stop, seed):
+    # Transfers from `threads` threads until `stop` is set; returns their latencies in ms
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(f'{seed}-{index}')
+        client = payments.app.test_client()
+        local = []
+        while not stop.is_set():
+            sender, receiver = rng.sample(range(1, users + 1), 2)
+            started = time.perf_counter()
+            client.post('/transfer_money', json={
+                'sender_iban': user_iban(sender), 'receiver_iban': user_iban(receiver), 'amount_cents': 1})
+            local.append((time.perf_counter() - started) * 1000)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    return workers, latencies
+
+
+def page_ids(client, user_id, limit, depth):
+    # Ids on the first page and on the page `depth` pages back, and the cursor to that page
+    before, first, deep_cursor = None, None, None
+    for page in range(depth + 1):
+        path = f'/transactions?user_id={user_id}&limit={limit}' + (f'&before={before}' if before else '')
+        body = client.get(path).get_json()
+        if page == 0:
+            first = [t['id'] for t in body['transactions']]
+        if page == depth - 1:
+            deep_cursor = body['next_before']
+        before = body['next_before']
+        if not before:
+            break
+    return first, deep_cursor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--threads', type=int, default=4, help='transfer threads during archiving')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause-ms', type=float, default=5)
+    parser.add_argument('--pages', type=int, default=300, help='page reads timed per case')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--depth', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    seeded = os.path.join(DATA_DIR, f'{args.scale}.db')
+    if not os.path.exists(seeded):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        build(seeded, seed=args.seed, **SCALES[args.scale])
+    workdir = tempfile.mkdtemp(prefix='archive-bench-')
+    db_path = os.path.join(workdir, 'payments.db')
+    shutil.copyfile(seeded, db_path)
+
+    stub = expo_stub.make_server()
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    os.environ['DB_PATH'] = db_path
+    os.environ['ARCHIVE_DIR'] = os.path.join(workdir, 'archive')
+    os.environ['EXPO_PUSH_URL'] = expo_stub.push_url(stub)
+    os.environ['METRICS_ENABLED'] = '0'
+    import app as payments
+    import archive
+    import ledger
+    import migrations
+    conn = payments.pool.acquire()
+    migrations.upgrade(conn, log=lambda message: None)
+    users = SCALES[args.scale]['users']
+    rng = random.Random(args.seed)
+    client = payments.app.test_client()
+
+    refs = [row[0] for row in conn.execute("SELECT id FROM pending_requests WHERE status = 'pending' LIMIT 200")]
+    for hint in ('INDEXED BY idx_transactions_request_ref_pending', 'NOT INDEXED'):
+        sql = f"SELECT id FROM transactions {hint} WHERE request_ref = ? AND status = 'pending' ORDER BY id LIMIT 1"
+        latencies = time_calls(lambda: conn.execute(sql, (rng.choice(refs),)).fetchall(), 50)
+        print(f"request_ref {hint.split()[0].lower():<11} p50 {percentile(latencies, 0.5):8.3f} ms")
+
+    # Users with enough history that `depth` pages back is still full
+    sample = [rng.randint(1, users) for _ in range(20)]
+    before = {}
+    for user_id in sample:
+        first, deep_cursor = page_ids(client, user_id, args.limit, args.depth)
+        if deep_cursor:
+            deep = [t['id'] for t in client.get(
+                f'/transactions?user_id={user_id}&limit={args.limit}&before={deep_cursor}').get_json()['transactions']]
+            before[user_id] = (first, deep_cursor, deep)
+    sample = list(before)
+
+    def time_pages():
+        first = time_calls(lambda: client.get(f'/transactions?user_id={rng.choice(sample)}&limit={args.limit}'),
+                           args.pages)
+
+        def deep_page():
+            user_id = rng.choice(sample)
+            client.get(f'/transactions?user_id={user_id}&limit={args.limit}&before={before[user_id][1]}')
+        return first, time_calls(deep_page, args.pages)
+
+    pages_hot = time_pages()
+
+    duration = 3.0
+    stop = threading.Event()
+    workers, baseline = transfer_load(payments, users, args.threads, stop, args.seed)
+    time.sleep(duration)
+    stop.set()
+    for thread in workers:
+        thread.join()
+    baseline = sorted(baseline)
+
+    hot_rows = conn.execute('SELECT COUNT(*) FROM transactions').fetchone()[0]
+    archiver = archive.Archiver(conn, os.environ['ARCHIVE_DIR'], batch_size=args.batch_size,
+                                pause=args.pause_ms / 1000)
+    stop = threading.Event()
+    workers, during = transfer_load(payments, users, args.threads, stop, args.seed + 1)
+    started = time.perf_counter()
+    moved = archiver.run(log=None)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for thread in workers:
+        thread.join()
+    archiver.close()
+    during = sorted(during)
+    stats = archiver.stats()
+    print(f"archive     {moved:,} of {hot_rows:,} rows in {elapsed:.1f}s ({moved / elapsed:,.0f} rows/s, "
+          f"{stats['batches']} batches, {len(stats['months'])} months; "
+          f"per batch copy {stats['copy_ms_total'] / max(stats['batches'], 1):.1f} ms, "
+          f"delete {stats['delete_ms_total'] / max(stats['batches'], 1):.1f} ms)")
+    for label, latencies in (('alone', baseline), ('archiving', during)):
+        print(f"transfers   {label:<10} {len(latencies) / (duration if label == 'alone' else elapsed):7,.0f}/s "
+              f"p50 {percentile(latencies, 0.5):7.2f} ms  p99 {percentile(latencies, 0.99):7.2f} ms  "
+              f"max {latencies[-1]:7.2f} ms")
+
+    mismatched_pages = 0
+    for user_id, (first, deep_cursor, deep) in before.items():
+        # Transfers made during the run are newer than anything archived; compare the archived page only
+        after = [t['id'] for t in client.get(
+            f'/transactions?user_id={user_id}&limit={args.limit}&before={deep_cursor}').get_json()['transactions']]
+        mismatched_pages += after != deep
+    pages_cold = time_pages()
+    for label, (first, deep) in (('hot', pages_hot), ('archived', pages_cold)):
+        print(f"pages       {label:<10} first p50 {percentile(first, 0.5):7.3f} ms  "
+              f"{args.depth} back p50 {percentile(deep, 0.5):7.3f} ms  p99 {percentile(deep, 0.99):7.3f} ms")
+
+    mismatches = ledger.audit(conn)
+    payments.pool.release(conn)
+    print(f"users sampled={len(sample)} page mismatches={mismatched_pages} ledger mismatches={len(mismatches)}")
+    payments.writes.stop()
+    payments.dispatcher.stop(drain=True)
+    stub.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if mismatches or mismatched_pages else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Transfers/second for /transfers/bulk against one /transfer_money call per payment.
+
+Works on a scratch copy of a synthetic database (see synthetic_db.py).
+It uploads an N-line NDJSON file and the same payments as CSV, checks
+every line came back ok and the ledger still balances, and then times
+the same number of individual /transfer_money calls.
+
+    python bench/bulk_bench.py --lines 10000
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import expo_stub
+import migrations
+from synthetic_db import SCALES, build, user_iban
+
+DATA_DIR = os.path.join(BACKEND_DIR, 'bench', 'data')
+
+
+def payroll(lines, users, sender_id):
+    # Receivers cycle through every other user, like a payroll run
+    receivers = [user_id for user_id in range(1, users + 1) if user_id != sender_id]
+    return [(user_iban(receivers[i % len(receivers)]), 100 + i % 900, f'Payroll line {i + 1}') for i in range(lines)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--lines', type=int, default=10000)
+    parser.add_argument('--single', type=int, default=None, help='individual /transfer_money calls to time (default: --lines)')
+    args = parser.parse_args()
+
+    seeded = os.path.join(DATA_DIR, f'{args.scale}.db')
+    if not os.path.exists(seeded):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        build(seeded, **SCALES[args.scale])
+    workdir = tempfile.mkdtemp(prefix='bulk-bench-')
+    db_path = os.path.join(workdir, 'payments.db')
+    shutil.copyfile(seeded, db_path)
+    conn = sqlite3.connect(db_path)
+    migrations.upgrade(conn, log=lambda message: None)
+    users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    # The sender needs enough money for every run below
+    conn.execute('UPDATE bank_balances SET balance_cents = balance_cents + ? WHERE iban = ?', (10 ** 12, user_iban(1)))
+    conn.execute('''
+        INSERT INTO ledger_entries (transaction_id, iban, amount_cents, entry_type) VALUES (NULL, ?, ?, 'opening')
+    ''', (user_iban(1), 10 ** 12))
+    conn.commit()
+    conn.close()
+
+    stub = expo_stub.make_server()
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    os.environ['DB_PATH'] = db_path
+    os.environ['EXPO_PUSH_URL'] = expo_stub.push_url(stub)
+
+    import app as payments
+    import ledger
+    client = payments.app.test_client()
+    rows = payroll(args.lines, users, 1)
+
+    ndjson = ''.join(json.dumps({'receiver_iban': iban, 'amount_cents': amount, 'memo': memo}) + '\n'
+                     for iban, amount, memo in rows)
+    csv_body = 'receiver_iban,amount_cents,memo\n' + ''.join(f'{iban},{amount},{memo}\n' for iban, amount, memo in rows)
+
+    for label, body, content_type in (('ndjson', ndjson, 'application/x-ndjson'), ('csv', csv_body, 'text/csv')):
+        started = time.perf_counter()
+        response = client.post(f'/transfers/bulk?sender_iban={user_iban(1)}', data=body.encode(), content_type=content_type)
+        results = [json.loads(line) for line in io.StringIO(response.get_data(as_text=True))]
+        elapsed = time.perf_counter() - started
+        summary = results[-1].get('summary', {})
+        print(f"bulk {label:<7} {args.lines} lines in {elapsed:.2f}s = {args.lines / elapsed:,.0f} transfers/s "
+              f"(ok={summary.get('ok')} failed={summary.get('failed')})")
+
+    single = args.single or args.lines
+    started = time.perf_counter()
+    for iban, amount, memo in rows[:single]:
+        client.post('/transfer_money', json={'sender_iban': user_iban(1), 'receiver_iban': iban,
+                                             'amount_cents': amount, 'memo': memo})
+    elapsed = time.perf_counter() - started
+    print(f"single  {single} calls in {elapsed:.2f}s = {single / elapsed:,.0f} transfers/s")
+
+    conn = payments.pool.acquire()
+    mismatches = ledger.audit(conn)
+    payments.pool.release(conn)
+    payments.dispatcher.stop(drain=True)
+    stub.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+    print(f"ledger mismatches={len(mismatches)}")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
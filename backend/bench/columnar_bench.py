@@ -0,0 +1,187 @@
+"""Peak RSS and serialization time of /transactions, row JSON against ?format=columnar.
+
+Works on a scratch copy of a synthetic database (see synthetic_db.py).
+It gives one user a --history-row transaction history and then reads it
+back in four ways, each in a fresh process so that ru_maxrss measures
+that read alone:
+
+  rows          one page holding the whole history, in the row format
+                (the page-size cap is lifted for the run)
+  columnar      one streamed columnar page holding the whole history
+  rows-paged    the whole history in pages of TRANSACTIONS_MAX_PAGE_SIZE
+  columnar-paged  the whole history in streamed pages of --page rows
+
+Each report gives wall time, response bytes and the RSS high-water mark
+above the process's level before the first request. A row-format body
+arrives whole, so its mark is taken before the client parses it. A
+columnar body is decoded chunk by chunk as it streams in. Database pages
+read through mmap (db.PRAGMAS, up to 256 MB) count towards RSS as well.
+The run also checks that every method returns the same ids in the same
+order.
+
+    python bench/columnar_bench.py --history 1000000
+"""
+import argparse
+import hashlib
+import json
+import os
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import migrations
+from synthetic_db import CHUNK_SIZE, SCALES, build
+
+DATA_DIR = os.path.join(BACKEND_DIR, 'bench', 'data')
+
+METHODS = ('rows', 'columnar', 'rows-paged', 'columnar-paged')
+
+
+def add_history(db_path, user_id, rows):
+    conn = sqlite3.connect(db_path)
+    migrations.upgrade(conn, log=lambda message: None)
+    users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    start = datetime(2020, 1, 1)
+    batch = []
+    for i in range(rows):
+        other = 1 + (user_id + i) % users
+        if other == user_id:
+            other = 1 + other % users
+        initiator, target = (user_id, other) if i % 2 else (other, user_id)
+        timestamp = (start + timedelta(seconds=97 * i)).strftime('%Y-%m-%d %H:%M:%S')
+        batch.append(('transfer', initiator, target, 100 + i % 5000, 'completed', timestamp, f'Bench {i}'))
+        if len(batch) == CHUNK_SIZE or i == rows - 1:
+            conn.executemany('''
+                INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, timestamp, memo)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', batch)
+            conn.commit()
+            batch = []
+    total = conn.execute('SELECT COUNT(*) FROM transactions WHERE initiator_id = ? OR target_id = ?',
+                         (user_id, user_id)).fetchone()[0]
+    conn.close()
+    return total
+
+
+def measure(method, user_id, total, page):
+    # Runs in its own process (see main); prints one JSON line
+    import app as payments
+    client = payments.app.test_client()
+    client.get(f'/transactions?user_id={user_id}&limit=1')
+    client.get(f'/transactions?user_id={user_id}&limit=1&format=columnar')
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    columnar = method.startswith('columnar')
+    if method == 'rows':
+        payments.TRANSACTIONS_MAX_PAGE_SIZE = total
+        size = total
+    elif method == 'columnar':
+        payments.TRANSACTIONS_MAX_COLUMNAR_PAGE_SIZE = total
+        size = total
+    elif method == 'rows-paged':
+        size = payments.TRANSACTIONS_MAX_PAGE_SIZE
+    else:
+        size = page
+
+    digest, rows, response_bytes, requests, peak = hashlib.sha1(), 0, 0, 0, baseline
+    before = None
+    started = time.perf_counter()
+    while True:
+        url = f'/transactions?user_id={user_id}&limit={size}' + ('&format=columnar' if columnar else '')
+        if before:
+            url += f'&before={before}'
+        response = client.get(url, buffered=False)
+        if columnar:
+            # Decode chunk by chunk as the pieces arrive: header, one piece per chunk, trailer
+            pieces = iter(response.response)
+            response_bytes += len(next(pieces))
+            tail = None
+            for piece in pieces:
+                response_bytes += len(piece)
+                if tail is not None:
+                    ids = json.loads(tail.lstrip(b','))['id']
+                    digest.update(array('q', ids).tobytes())
+                    rows += len(ids)
+                tail = piece
+            trailer = json.loads(b'{' + tail[2:])
+            peak = max(peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        else:
+            body = b''.join(response.response)
+            response_bytes += len(body)
+            # High-water mark before the client parses the body
+            peak = max(peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+            trailer = json.loads(body)
+            del body
+            ids = [row['id'] for row in trailer['transactions']]
+            digest.update(array('q', ids).tobytes())
+            rows += len(ids)
+        response.close()
+        requests += 1
+        before = trailer['next_before']
+        if not before:
+            break
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        'method': method, 'requests': requests, 'rows': rows, 'seconds': round(elapsed, 2),
+        'mb': round(response_bytes / 2 ** 20, 1), 'rss_mb': round((peak - baseline) / 1024, 1),
+        'ids_hash': digest.hexdigest(),
+    }))
+    payments.dispatcher.stop(drain=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--history', type=int, default=1000000, help='transactions added to the user')
+    parser.add_argument('--user', type=int, default=1)
+    parser.add_argument('--page', type=int, default=100000, help='rows per page for columnar-paged')
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=list(METHODS))
+    parser.add_argument('--measure', choices=METHODS, help=argparse.SUPPRESS)
+    parser.add_argument('--total', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.measure, args.user, args.total, args.page)
+        return
+
+    seeded = os.path.join(DATA_DIR, f'{args.scale}.db')
+    if not os.path.exists(seeded):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        build(seeded, **SCALES[args.scale])
+    workdir = tempfile.mkdtemp(prefix='columnar-bench-')
+    db_path = os.path.join(workdir, 'payments.db')
+    shutil.copyfile(seeded, db_path)
+    started = time.perf_counter()
+    total = add_history(db_path, args.user, args.history)
+    print(f"user {args.user}: {total:,} transactions (setup {time.perf_counter() - started:.1f}s)")
+
+    env = dict(os.environ, DB_PATH=db_path, EXPO_PUSH_URL='http://127.0.0.1:9/push', METRICS_ENABLED='0')
+    results = []
+    for method in args.methods:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--measure', method, '--user', str(args.user),
+             '--total', str(total), '--page', str(args.page)],
+            cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'method':<16} {'requests':>8} {'rows':>9} {'seconds':>8} {'MB':>7} {'peak RSS MB':>12}")
+    for r in results:
+        print(f"{r['method']:<16} {r['requests']:>8} {r['rows']:>9,} {r['seconds']:>8.2f} {r['mb']:>7.1f} {r['rss_mb']:>12.1f}")
+    same = len({(r['rows'], r['ids_hash']) for r in results}) == 1 and results[0]['rows'] == total
+    print(f"same rows in the same order: {same}")
+    sys.exit(0 if same else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Multi-threaded transfer stress test for the balance ledger.
+
+Hammers POST /transfer_money from many threads against a throwaway copy of
+the seeded database, then checks that no money was created or lost, no
+balance went negative, and every balance still matches its ledger entries.
+
+    python bench/ledger_stress.py --threads 8 --transfers 500
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--transfers', type=int, default=500, help='transfers per thread')
+    parser.add_argument('--max-amount', type=int, default=3000, help='largest transfer in cents')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='ledger-stress-')
+    os.environ['DB_PATH'] = os.path.join(tmpdir, 'payments.db')
+    os.environ.setdefault('EXPO_PUSH_URL', 'http://127.0.0.1:9/--/api/v2/push/send')
+
+    import app as payments
+    import ledger
+    import migrations
+
+    conn = payments.pool.acquire()
+    migrations.upgrade(conn, log=lambda message: None)
+    migrations.seed(conn)
+    ibans = [row[0] for row in conn.execute('SELECT iban FROM bank_balances')]
+    total_before = conn.execute('SELECT SUM(balance_cents) FROM bank_balances').fetchone()[0]
+    payments.pool.release(conn)
+
+    counts = {'ok': 0, 'insufficient': 0, 'error': 0}
+    lock = threading.Lock()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = payments.app.test_client()
+        local = {'ok': 0, 'insufficient': 0, 'error': 0}
+        for _ in range(args.transfers):
+            sender, receiver = rng.sample(ibans, 2)
+            response = client.post('/transfer_money', json={
+                'sender_iban': sender,
+                'receiver_iban': receiver,
+                'amount_cents': rng.randint(1, args.max_amount),
+            })
+            if response.status_code == 200:
+                local['ok'] += 1
+            elif response.status_code == 400:
+                local['insufficient'] += 1
+            else:
+                local['error'] += 1
+                print(response.status_code, response.get_json())
+        with lock:
+            for key, value in local.items():
+                counts[key] += value
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    conn = payments.pool.acquire()
+    total_after = conn.execute('SELECT SUM(balance_cents) FROM bank_balances').fetchone()[0]
+    negative = conn.execute('SELECT COUNT(*) FROM bank_balances WHERE balance_cents < 0').fetchone()[0]
+    logged = conn.execute("SELECT COUNT(*) FROM transactions WHERE type = 'transfer'").fetchone()[0]
+    mismatches = ledger.audit(conn)
+    payments.pool.release(conn)
+
+    attempted = args.threads * args.transfers
+    print(f"threads={args.threads} attempted={attempted} elapsed={elapsed:.2f}s")
+    print(f"completed={counts['ok']} insufficient={counts['insufficient']} errors={counts['error']}")
+    print(f"throughput={attempted / elapsed:.0f} req/s, {counts['ok'] / elapsed:.0f} completed transfers/s")
+    print(f"money before={total_before} after={total_after} negative_balances={negative}")
+    print(f"transfer rows={logged} ledger mismatches={len(mismatches)}")
+
+    ok = (total_before == total_after and negative == 0 and not mismatches
+          and logged == counts['ok'] and counts['error'] == 0)
+    print('PASS' if ok else 'FAIL')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
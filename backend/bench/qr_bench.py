@@ -0,0 +1,187 @@
+"""Cost of a burst of QR scans at /qr/redeem (see qr.py), by kind of scan.
+
+Works on a scratch copy of a synthetic database (see synthetic_db.py).
+One requester shows QR codes and --threads threads scan them, --scans
+scans per kind:
+
+  valid      a fresh code per scan, paid by a random user (a real transfer)
+  replayed   one code that was already paid, scanned again and again
+  forged     codes of the right shape with a wrong signature
+  expired    correctly signed codes past their expiry
+  duplicate  for comparison, the same scan sent as /request_money, whose
+             duplicate check needs IBAN lookups and a pending_requests query
+
+Each kind reports scans/s, p50/p99 latency and how many SQLite statements
+a scan ran. It also times QrTokens.verify() + claim() alone, without
+Flask.
+
+    python bench/qr_bench.py --scans 20000 --threads 8
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import expo_stub
+from api_bench import percentile
+from synthetic_db import SCALES, build, user_iban
+
+DATA_DIR = os.path.join(BACKEND_DIR, 'bench', 'data')
+
+KINDS = ('valid', 'replayed', 'forged', 'expired', 'duplicate')
+
+
+def scans(kind, count, payments, users, requester_id, seed):
+    # (path, json_body) for each scan of this kind, made before the clock starts
+    rng = random.Random(f'{seed}-{kind}')
+    qr_tokens = payments.qr_tokens
+    if kind == 'valid':
+        bodies = []
+        for _ in range(count):
+            payer_id = rng.randint(2, users)
+            token, _ = qr_tokens.issue(requester_id, rng.randint(1, 500), ttl=qr_tokens.max_ttl)
+            bodies.append(('/qr/redeem', {'token': token, 'payer_iban': user_iban(payer_id)}))
+        return bodies
+    if kind == 'replayed':
+        token, _ = qr_tokens.issue(requester_id, 1, ttl=qr_tokens.max_ttl)
+        body = {'token': token, 'payer_iban': user_iban(rng.randint(2, users))}
+        assert payments.app.test_client().post('/qr/redeem', json=body).status_code == 200
+        return [('/qr/redeem', body)] * count
+    if kind == 'forged':
+        bodies = []
+        for _ in range(count):
+            token, _ = qr_tokens.issue(requester_id, 100)
+            bodies.append(('/qr/redeem', {'token': token[:-4] + 'AAAA', 'payer_iban': user_iban(rng.randint(2, users))}))
+        return bodies
+    if kind == 'expired':
+        tokens = [qr_tokens.issue(requester_id, 100, ttl=1)[0] for _ in range(count)]
+        time.sleep(2)
+        return [('/qr/redeem', {'token': token, 'payer_iban': user_iban(rng.randint(2, users))}) for token in tokens]
+    body = {'requester_iban': user_iban(requester_id), 'payer_iban': user_iban(2), 'amount_cents': 100}
+    payments.app.test_client().post('/request_money', json=body)
+    return [('/request_money', body)] * count
+
+
+def run(payments, bodies, threads):
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(share):
+        client = payments.app.test_client()
+        local, codes = [], {}
+        barrier.wait()
+        for path, body in share:
+            started = time.perf_counter()
+            status = client.post(path, json=body).status_code
+            local.append((time.perf_counter() - started) * 1000)
+            codes[status] = codes.get(status, 0) + 1
+        with lock:
+            latencies.extend(local)
+            for status, n in codes.items():
+                statuses[status] = statuses.get(status, 0) + n
+
+    workers = [threading.Thread(target=worker, args=(bodies[i::threads],)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return sorted(latencies), statuses, elapsed
+
+
+def count_statements(pool):
+    # Counts every statement run on the pool's connections, via sqlite3's trace callback
+    counter = {'n': 0}
+    lock = threading.Lock()
+
+    def trace(statement):
+        with lock:
+            counter['n'] += 1
+
+    connections = [pool.acquire() for _ in range(pool.max_connections)]
+    for conn in connections:
+        conn.set_trace_callback(trace)
+    for conn in connections:
+        pool.release(conn)
+    return counter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--scans', type=int, default=20000, help='scans of each kind')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=list(KINDS))
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    seeded = os.path.join(DATA_DIR, f'{args.scale}.db')
+    if not os.path.exists(seeded):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        build(seeded, seed=args.seed, **SCALES[args.scale])
+    workdir = tempfile.mkdtemp(prefix='qr-bench-')
+    db_path = os.path.join(workdir, 'payments.db')
+    shutil.copyfile(seeded, db_path)
+
+    stub = expo_stub.make_server()
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    os.environ['DB_PATH'] = db_path
+    os.environ['EXPO_PUSH_URL'] = expo_stub.push_url(stub)
+    os.environ['METRICS_ENABLED'] = '0'
+    os.environ.setdefault('QR_SECRET', 'bench-secret')
+    os.environ['QR_NONCE_CACHE_SIZE'] = str(args.scans * 2)
+    import app as payments
+    import ledger
+    import migrations
+    conn = payments.pool.acquire()
+    migrations.upgrade(conn, log=lambda message: None)
+    payments.pool.release(conn)
+    statements = count_statements(payments.pool)
+    users = SCALES[args.scale]['users']
+    conn = payments.pool.acquire()
+    # A requester with a push token, as a merchant display would have
+    requester_id = conn.execute('SELECT MIN(user_id) FROM push_tokens').fetchone()[0]
+    payments.pool.release(conn)
+
+    qr_tokens = payments.qr_tokens
+    tokens = [qr_tokens.issue(requester_id, 100, ttl=qr_tokens.max_ttl)[0] for _ in range(args.scans)]
+    started = time.perf_counter()
+    for token in tokens:
+        qr_tokens.claim(qr_tokens.verify(token))
+    per_token_us = (time.perf_counter() - started) * 1e6 / len(tokens)
+    for token in tokens:
+        qr_tokens.release(qr_tokens.verify(token))
+    print(f"verify + claim without Flask: {per_token_us:.1f} us per code ({1e6 / per_token_us:,.0f}/s, one thread)")
+
+    print(f"{'kind':<10} {'scans/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'SQL/scan':>9}  statuses")
+    for kind in args.kinds:
+        bodies = scans(kind, args.scans, payments, users, requester_id, args.seed)
+        before = statements['n']
+        latencies, statuses, elapsed = run(payments, bodies, args.threads)
+        per_scan = (statements['n'] - before) / len(bodies)
+        print(f"{kind:<10} {len(bodies) / elapsed:>9,.0f} {percentile(latencies, 0.5):>8.3f} "
+              f"{percentile(latencies, 0.99):>8.3f} {per_scan:>9.1f}  {dict(sorted(statuses.items()))}")
+
+    conn = payments.pool.acquire()
+    mismatches = ledger.audit(conn)
+    payments.pool.release(conn)
+    print(f"qr stats: {qr_tokens.stats()}")
+    print(f"ledger mismatches={len(mismatches)}")
+    payments.dispatcher.stop(drain=True)
+    stub.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
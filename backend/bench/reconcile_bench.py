@@ -0,0 +1,142 @@
+"""Balance reconciliation (reconcile.py): rows/s, memory, and what a checkpoint saves.
+
+Works on a scratch copy of a synthetic database (see synthetic_db.py). For
+each --engines value (numpy's bincount, or the plain-Python fallback) and
+each --chunk-rows value, a full run reconciles the whole history in a fresh
+process, so ru_maxrss shows the memory the run itself took, and its net
+flows are checked against the same sums done by SQL GROUP BY. Then
+--transfers transfers go through /transfer_money and an incremental run
+picks them up from the checkpoint.
+
+The synthetic history isn't derived from the synthetic balances, so most
+accounts are reported as mismatched; the mismatch count is printed but
+only the flow check decides the exit code.
+
+    python bench/reconcile_bench.py --scale medium --chunk-rows 10000 100000
+    python bench/reconcile_bench.py --engines numpy
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import expo_stub
+import migrations
+import reconcile
+from synthetic_db import SCALES, build, user_iban
+
+DATA_DIR = os.path.join(BACKEND_DIR, 'bench', 'data')
+
+# The same payer/payee rule as reconcile._FLOW_SELECT, summed by SQLite
+EXPECTED_FLOWS = '''
+    SELECT user_id, SUM(cents) FROM (
+        SELECT CASE type WHEN 'transfer' THEN target_id ELSE initiator_id END AS user_id, amount_cents AS cents
+        FROM transactions WHERE type IN ('transfer', 'request_sent') AND status = 'completed'
+          AND target_id IS NOT NULL
+        UNION ALL
+        SELECT CASE type WHEN 'transfer' THEN initiator_id ELSE target_id END, -amount_cents
+        FROM transactions WHERE type IN ('transfer', 'request_sent') AND status = 'completed'
+          AND target_id IS NOT NULL
+    )
+    GROUP BY user_id HAVING SUM(cents) != 0
+'''
+
+
+ENGINES = {'numpy': True, 'python': False}
+
+
+def full_run(db_path, archive_dir, chunk_rows, engine, results):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    conn = sqlite3.connect(db_path)
+    reconciler = reconcile.Reconciler(conn, archive_dir, chunk_rows=chunk_rows, vectorized=ENGINES[engine])
+    reconciler.run(full=True, log=None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    flows = dict(reconciler.flows.items())
+    expected = dict(conn.execute(EXPECTED_FLOWS).fetchall())
+    conn.close()
+    results.put({**reconciler.stats(), 'rss_mb': round((peak - baseline) / 1024, 1), 'flows_match': flows == expected})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--engines', nargs='+', choices=sorted(ENGINES), default=list(ENGINES))
+    parser.add_argument('--chunk-rows', type=int, nargs='+', default=[10000, reconcile.CHUNK_ROWS])
+    parser.add_argument('--transfers', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    seeded = os.path.join(DATA_DIR, f'{args.scale}.db')
+    if not os.path.exists(seeded):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        build(seeded, seed=args.seed, **SCALES[args.scale])
+    workdir = tempfile.mkdtemp(prefix='reconcile-bench-')
+    db_path = os.path.join(workdir, 'payments.db')
+    archive_dir = os.path.join(workdir, 'archive')
+    shutil.copyfile(seeded, db_path)
+    conn = sqlite3.connect(db_path)
+    migrations.upgrade(conn, log=lambda message: None)
+    conn.close()
+
+    print(f"{'run':<12} {'engine':<7} {'chunk':>8} {'rows':>10} {'seconds':>8} {'rows/s':>10} {'rss MB':>7} {'flows':>6} "
+          f"{'mismatches':>10}")
+    broken = False
+    context = multiprocessing.get_context('spawn')
+    for engine, chunk_rows in ((engine, chunk_rows) for engine in args.engines for chunk_rows in args.chunk_rows):
+        results = context.Queue()
+        process = context.Process(target=full_run, args=(db_path, archive_dir, chunk_rows, engine, results))
+        process.start()
+        stats = results.get()
+        process.join()
+        broken |= not stats['flows_match']
+        print(f"{'full':<12} {engine:<7} {chunk_rows:>8,} {stats['rows']:>10,} {stats['seconds']:>8.2f} "
+              f"{stats['rows'] / max(stats['seconds'], 1e-9):>10,.0f} {stats['rss_mb']:>7.1f} "
+              f"{'ok' if stats['flows_match'] else 'WRONG':>6} {stats['mismatches']:>10,}")
+
+    stub = expo_stub.make_server()
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    os.environ['DB_PATH'] = db_path
+    os.environ['ARCHIVE_DIR'] = archive_dir
+    os.environ['EXPO_PUSH_URL'] = expo_stub.push_url(stub)
+    os.environ['METRICS_ENABLED'] = '0'
+    import app as payments
+    client = payments.app.test_client()
+    rng = random.Random(args.seed)
+    users = SCALES[args.scale]['users']
+    for _ in range(args.transfers):
+        sender, receiver = rng.sample(range(1, users + 1), 2)
+        client.post('/transfer_money', json={
+            'sender_iban': user_iban(sender), 'receiver_iban': user_iban(receiver), 'amount_cents': 1})
+
+    conn = payments.pool.acquire()
+    reconciler = reconcile.Reconciler(conn, archive_dir, chunk_rows=args.chunk_rows[-1],
+                                      vectorized=ENGINES[args.engines[0]])
+    started = time.perf_counter()
+    reconciler.run(log=None)
+    elapsed = time.perf_counter() - started
+    stats = reconciler.stats()
+    flows_match = dict(reconciler.flows.items()) == dict(conn.execute(EXPECTED_FLOWS).fetchall())
+    broken |= not flows_match
+    print(f"{'incremental':<12} {args.engines[0]:<7} {args.chunk_rows[-1]:>8,} {stats['rows']:>10,} {elapsed:>8.2f} "
+          f"{stats['rows'] / max(elapsed, 1e-9):>10,.0f} {'-':>7} {'ok' if flows_match else 'WRONG':>6} "
+          f"{stats['mismatches']:>10,}")
+    payments.pool.release(conn)
+    payments.writes.stop()
+    payments.dispatcher.stop(drain=True)
+    stub.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(1 if broken else 0)
+
+
+if __name__ == '__main__':
+    main()
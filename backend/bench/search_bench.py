@@ -0,0 +1,190 @@
+"""Latency of /users/search (search.py) on a large user table.
+
+Builds, or reuses, bench/data/search-<users>.db: a synthetic database of
+--users users and --transactions transactions, so most users have
+contacts to rank. Then it times a mix of queries for random searching
+users, --queries of each kind:
+
+  prefix1 / prefix2   one- and two-letter name prefixes ("m", "ko")
+  word                a whole folded word ("kovac" matches "Kovač")
+  two words           first name plus last-name prefix ("ana nov")
+  phone / national    part of a number typed as "+386 40 1" or "040 12"
+  iban                part of an IBAN typed with spaces ("SI56 0000 0")
+
+Each kind is timed twice: as search.search() on a pooled connection, and
+through the endpoint with Flask's test client. For comparison the run
+also times what the screens did before: building the full /users
+payload, and a LIKE scan over names. Last, it times rebuilding the index
+from scratch, as migration 10 does, and what the triggers cost per write:
+inserting users and transactions with and without them.
+
+    python bench/search_bench.py --users 1000000
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from api_bench import percentile
+from synthetic_db import FIRST_NAMES, LAST_NAMES, build, user_iban
+
+DATA_DIR = os.path.join(BACKEND_DIR, 'bench', 'data')
+
+
+def queries(kind, rng, users):
+    user_id = rng.randint(1, users)
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    if kind == 'prefix1':
+        return first[0]
+    if kind == 'prefix2':
+        return last[:2]
+    if kind == 'word':
+        return last.translate(str.maketrans('čšžČŠŽ', 'cszCSZ')).lower()
+    if kind == 'two words':
+        return f'{first} {last[:3]}'
+    if kind == 'phone':
+        typed = f'+386 40 {user_id // 1000 % 1000:03d} {user_id % 1000:03d}'
+        return typed[:rng.randint(2, len(typed))]
+    if kind == 'national':
+        typed = f'040 {user_id // 1000 % 1000:03d} {user_id % 1000:03d}'
+        return typed[:rng.randint(1, len(typed))]
+    iban = user_iban(user_id)
+    typed = ' '.join(iban[i:i + 4] for i in range(0, len(iban), 4))
+    return typed[:rng.randint(4, len(typed))]
+
+
+KINDS = ('prefix1', 'prefix2', 'word', 'two words', 'phone', 'national', 'iban')
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return sorted(samples)
+
+
+def rebuild_seconds(db_path):
+    # What migration 10 costs on this database, from scratch
+    import migrations
+    scratch = tempfile.mkdtemp(prefix='search-bench-')
+    path = os.path.join(scratch, 'payments.db')
+    shutil.copyfile(db_path, path)
+    conn = sqlite3.connect(path)
+    started = time.perf_counter()
+    migrations._user_search(conn.cursor())
+    conn.commit()
+    elapsed = time.perf_counter() - started
+    conn.close()
+    shutil.rmtree(scratch, ignore_errors=True)
+    return elapsed
+
+
+def write_cost(db_path, count):
+    # Per-row insert cost with the search triggers in place and with them dropped
+    results = {}
+    for label in ('with triggers', 'without triggers'):
+        scratch = tempfile.mkdtemp(prefix='search-bench-')
+        path = os.path.join(scratch, 'payments.db')
+        shutil.copyfile(db_path, path)
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        if label == 'without triggers':
+            for trigger in ('users_fts_insert', 'user_contacts_insert'):
+                conn.execute(f'DROP TRIGGER {trigger}')
+        top = conn.execute('SELECT MAX(id) FROM users').fetchone()[0]
+        started = time.perf_counter()
+        for i in range(1, count + 1):
+            conn.execute('INSERT INTO users (name, email, phone, iban) VALUES (?, ?, ?, ?)',
+                         (f'Nova Oseba {i}', f'new{i}@bench.test', f'+386 70 {i:06d}', user_iban(top + i)))
+            conn.commit()
+        users_ms = (time.perf_counter() - started) * 1000 / count
+        started = time.perf_counter()
+        for i in range(count):
+            conn.execute('''
+                INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status)
+                VALUES ('transfer', ?, ?, 100, 'completed')
+            ''', (1 + i % top, 1 + (i * 7919) % top))
+            conn.commit()
+        transactions_ms = (time.perf_counter() - started) * 1000 / count
+        conn.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+        results[label] = (users_ms, transactions_ms)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--transactions', type=int, default=2000000)
+    parser.add_argument('--queries', type=int, default=300, help='queries of each kind')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--writes', type=int, default=2000, help='inserts timed for the trigger cost')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    seeded = os.path.join(DATA_DIR, f'search-{args.users}.db')
+    if not os.path.exists(seeded):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        build(seeded, users=args.users, transactions=args.transactions, groups=0, pending=0, seed=args.seed)
+    workdir = tempfile.mkdtemp(prefix='search-bench-')
+    db_path = os.path.join(workdir, 'payments.db')
+    shutil.copyfile(seeded, db_path)
+
+    os.environ['DB_PATH'] = db_path
+    os.environ['EXPO_PUSH_URL'] = 'http://127.0.0.1:9/push'
+    os.environ['METRICS_ENABLED'] = '0'
+    import app as payments
+    import search
+    client = payments.app.test_client()
+    conn = payments.pool.acquire()
+    cursor = conn.cursor()
+    with_contacts = conn.execute('SELECT COUNT(DISTINCT user_id) FROM user_contacts').fetchone()[0]
+    print(f"{args.users:,} users, {with_contacts:,} with contacts, limit {args.limit}")
+
+    print(f"{'query':<12} {'example':<24} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'http p50':>9} {'http p99':>9} {'hits':>5}")
+    for kind in KINDS:
+        rng = random.Random(f'{args.seed}-{kind}')
+        cases = [(queries(kind, rng, args.users), rng.randint(1, args.users)) for _ in range(args.queries)]
+        hits = []
+        for query, user_id in cases[:20]:  # warm the page cache
+            search.search(cursor, query, user_id, args.limit)
+        it = iter(cases * 2)
+
+        def direct():
+            query, user_id = next(it)
+            hits.append(len(search.search(cursor, query, user_id, args.limit)))
+        direct_ms = timed(direct, len(cases))
+
+        def http():
+            query, user_id = next(it)
+            client.get('/users/search', query_string={'q': query, 'user_id': user_id, 'limit': args.limit})
+        http_ms = timed(http, len(cases))
+        print(f"{kind:<12} {cases[0][0]!r:<24} {percentile(direct_ms, 0.5):>7.3f} {percentile(direct_ms, 0.95):>7.3f} "
+              f"{percentile(direct_ms, 0.99):>7.3f} {percentile(http_ms, 0.5):>9.3f} {percentile(http_ms, 0.99):>9.3f} "
+              f"{sum(hits) / len(hits):>5.1f}")
+
+    like_ms = timed(lambda: conn.execute("SELECT id FROM users WHERE name LIKE '%kovac%' LIMIT 20").fetchall(), 3)
+    payments.pool.release(conn)
+    users_ms = timed(lambda: client.get('/users'), 1)
+    print(f"before: full /users payload {users_ms[0]:.0f} ms, LIKE scan over names {percentile(like_ms, 0.5):.0f} ms")
+
+    print(f"rebuilding the index and contacts (migration 10): {rebuild_seconds(db_path):.1f}s")
+    for label, (users_write_ms, transactions_write_ms) in write_cost(db_path, args.writes).items():
+        print(f"insert {label:<17} user {users_write_ms:.3f} ms  transaction {transactions_write_ms:.3f} ms")
+
+    payments.dispatcher.stop(drain=False)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
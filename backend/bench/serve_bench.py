@@ -0,0 +1,240 @@
+"""Throughput of the gunicorn setup (gunicorn.conf.py) against the `python app.py` dev server.
+
+Each server runs as a subprocess on a scratch copy of a synthetic database
+and gets the same load: keep-alive HTTP clients spread across a few
+processes, issuing a read-heavy mix (/users, /transactions,
+/pending_requests, /pending_requests/summary) plus --write-ratio
+/transfer_money calls, for --duration seconds. The report gives req/s and
+p50/p95/p99 latency overall and for writes alone.
+
+The gunicorn server is then stopped with SIGTERM, the way a deploy stops it.
+The run checks three things: it exits within its grace period, no push
+notification is left in the outbox, and the ledger still balances.
+
+    python bench/serve_bench.py --scale small --duration 15
+    python bench/serve_bench.py --workers 4 --threads 8 --clients 32
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import expo_stub
+import ledger
+import migrations
+from api_bench import make_request, percentile
+from synthetic_db import SCALES, build
+
+DATA_DIR = os.path.join(BACKEND_DIR, 'bench', 'data')
+
+READS = ('GET /users', 'GET /transactions', 'GET /pending_requests', 'GET /pending_requests/summary')
+WRITE = 'POST /transfer_money'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(port, process, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'server exited with {process.returncode}')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/pending_requests/summary?user_id=1')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('server did not come up')
+
+
+def client_process(port, threads, duration, write_ratio, users, seed, results):
+    latencies = []  # (is_write, seconds)
+    errors = []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def worker(index):
+        rng = random.Random(f'{seed}-{index}')
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        local, local_errors = [], []
+        while time.monotonic() < stop_at:
+            endpoint = WRITE if rng.random() < write_ratio else rng.choice(READS)
+            method, path, body = make_request(endpoint, rng, users)
+            data = json.dumps(body) if body is not None else None
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            started = time.perf_counter()
+            try:
+                connection.request(method, path, data, headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port)
+                status = 599
+            local.append((endpoint == WRITE, time.perf_counter() - started))
+            if status >= 400:
+                local_errors.append(status)
+        with lock:
+            latencies.extend(local)
+            errors.extend(local_errors)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    results.put((latencies, errors))
+
+
+def drive(port, clients, client_procs, duration, write_ratio, users, seed):
+    results = multiprocessing.Queue()
+    per_process = max(1, clients // client_procs)
+    processes = [
+        multiprocessing.Process(target=client_process,
+                                args=(port, per_process, duration, write_ratio, users, f'{seed}-{i}', results))
+        for i in range(client_procs)
+    ]
+    for process in processes:
+        process.start()
+    latencies, errors = [], []
+    for _ in processes:
+        process_latencies, process_errors = results.get()
+        latencies.extend(process_latencies)
+        errors.extend(process_errors)
+    for process in processes:
+        process.join()
+
+    def summarize(values):
+        ms = sorted(value * 1000 for value in values)
+        return {
+            'requests': len(ms),
+            'rps': round(len(ms) / duration, 1),
+            'p50_ms': round(percentile(ms, 0.50), 2),
+            'p95_ms': round(percentile(ms, 0.95), 2),
+            'p99_ms': round(percentile(ms, 0.99), 2),
+        }
+
+    report = summarize([seconds for _, seconds in latencies])
+    report['errors'] = len(errors)
+    report['writes'] = summarize([seconds for is_write, seconds in latencies if is_write])
+    return report
+
+
+def prepare(seeded, workdir):
+    db_path = os.path.join(workdir, 'payments.db')
+    shutil.copyfile(seeded, db_path)
+    conn = sqlite3.connect(db_path)
+    migrations.upgrade(conn, log=lambda message: None)
+    users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    conn.close()
+    return db_path, users
+
+
+def check_db(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        queued = conn.execute("SELECT COUNT(*) FROM push_outbox WHERE status != 'failed'").fetchone()[0]
+        mismatches = len(ledger.audit(conn))
+        wal = os.path.getsize(db_path + '-wal') if os.path.exists(db_path + '-wal') else 0
+    finally:
+        conn.close()
+    return queued, mismatches, wal
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of load per server')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent keep-alive connections')
+    parser.add_argument('--client-procs', type=int, default=2, help='processes the clients are spread over')
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    parser.add_argument('--workers', type=int, default=None, help='gunicorn workers (default: gunicorn.conf.py)')
+    parser.add_argument('--threads', type=int, default=None, help='gunicorn threads per worker')
+    parser.add_argument('--servers', nargs='+', choices=('dev', 'gunicorn'), default=['dev', 'gunicorn'])
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    seeded = os.path.join(DATA_DIR, f'{args.scale}.db')
+    if not os.path.exists(seeded):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        build(seeded, seed=args.seed, **SCALES[args.scale])
+
+    stub = expo_stub.make_server()
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    commands = {
+        # Same app.run() call as `python app.py`, without its demo seeding
+        'dev': lambda port: [sys.executable, '-c', f"import app; app.app.run(host='127.0.0.1', port={port})"],
+        'gunicorn': lambda port: [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+    }
+
+    results = {}
+    for name in args.servers:
+        workdir = tempfile.mkdtemp(prefix='serve-bench-')
+        db_path, users = prepare(seeded, workdir)
+        port = free_port()
+        env = dict(os.environ, DB_PATH=db_path, EXPO_PUSH_URL=expo_stub.push_url(stub),
+                   WEB_BIND=f'127.0.0.1:{port}', METRICS_ENABLED='0')
+        if args.workers:
+            env['WEB_WORKERS'] = str(args.workers)
+        if args.threads:
+            env['WEB_THREADS'] = str(args.threads)
+        process = subprocess.Popen(commands[name](port), cwd=BACKEND_DIR, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_up(port, process)
+            results[name] = drive(port, args.clients, args.client_procs, args.duration,
+                                  args.write_ratio, users, args.seed)
+        finally:
+            started = time.monotonic()
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            stop_seconds = time.monotonic() - started
+        queued, mismatches, wal = check_db(db_path)
+        results[name].update(stop_seconds=round(stop_seconds, 2), queued_pushes=queued,
+                             ledger_mismatches=mismatches, wal_bytes=wal)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    stub.shutdown()
+    print(f"\n{args.clients} clients, {args.write_ratio:.0%} writes, {args.duration:.0f}s per server, "
+          f"{os.cpu_count()} CPU(s)")
+    print(f"{'server':<10} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'write p99':>10} "
+          f"{'errors':>7} {'stop s':>7} {'queued':>7} {'ledger':>7} {'wal KB':>7}")
+    for name, r in results.items():
+        print(f"{name:<10} {r['rps']:>9.1f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} "
+              f"{r['writes']['p99_ms']:>10.2f} {r['errors']:>7} {r['stop_seconds']:>7.2f} {r['queued_pushes']:>7} "
+              f"{r['ledger_mismatches']:>7} {r['wal_bytes'] // 1024:>7}")
+    if 'dev' in results and 'gunicorn' in results and results['dev']['rps']:
+        print(f"gunicorn/dev throughput: {results['gunicorn']['rps'] / results['dev']['rps']:.2f}x")
+    # The dev server has no SIGTERM handling, so only gunicorn is expected to leave an empty outbox
+    failed = any(r['ledger_mismatches'] for r in results.values()) or results.get('gunicorn', {}).get('queued_pushes')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Settle-up speed and plan size for a group with many open debts (see settle.py).
+
+Works on a scratch copy of a synthetic database (see synthetic_db.py).
+It creates one group of --members users and fills it with --debts open
+split requests between random members, plus a few group transfers.
+It then times each step: netting the balances in SQL, planning with
+settle.min_cash_flow, the GET preview and the POST that executes the plan.
+The plan's transfer count is compared with paying every debt as it stands
+and with netting each pair of members separately. Afterwards every member
+must be square, the ledger must balance and each balance must have moved
+by exactly the member's net position.
+
+It also times min_cash_flow alone on random balances for larger member counts.
+
+    python bench/settle_bench.py --members 300 --debts 10000
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import expo_stub
+import migrations
+from synthetic_db import SCALES, build, user_iban
+
+DATA_DIR = os.path.join(BACKEND_DIR, 'bench', 'data')
+
+
+def make_group(db_path, members, debts, transfers, seed):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    migrations.upgrade(conn, log=lambda message: None)
+    member_ids = list(range(1, members + 1))
+    cursor = conn.execute("INSERT INTO groups (name, creator_id, member_ids) VALUES ('Bench', 1, '[]')")
+    group_id = cursor.lastrowid
+    conn.executemany('INSERT INTO group_members (group_id, user_id) VALUES (?, ?)',
+                     [(group_id, member_id) for member_id in member_ids])
+
+    rows = []
+    for _ in range(debts):
+        requester_id, payer_id = rng.sample(member_ids, 2)
+        rows.append((requester_id, payer_id, rng.randint(100, 20000), group_id))
+    first_new_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM pending_requests').fetchone()[0]
+    conn.executemany('INSERT INTO pending_requests (requester_id, payer_id, amount_cents, group_id) VALUES (?, ?, ?, ?)', rows)
+    conn.execute('''
+        INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, request_ref, group_id)
+        SELECT 'request_sent', requester_id, payer_id, amount_cents, 'pending', id, group_id
+        FROM pending_requests WHERE id > ?
+    ''', (first_new_id,))
+    # Partial repayments made inside the group before anyone settles up
+    conn.executemany('''
+        INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, group_id)
+        VALUES ('transfer', ?, ?, ?, 'completed', ?)
+    ''', [(*rng.sample(member_ids, 2), rng.randint(100, 5000), group_id) for _ in range(transfers)])
+    conn.commit()
+    conn.close()
+    return group_id, rows
+
+
+def pairwise_transfers(rows):
+    # Transfers needed when each pair of members only nets the debts between the two of them
+    net = {}
+    for requester_id, payer_id, amount, _ in rows:
+        pair = (min(requester_id, payer_id), max(requester_id, payer_id))
+        net[pair] = net.get(pair, 0) + (amount if requester_id == pair[0] else -amount)
+    return sum(1 for cents in net.values() if cents)
+
+
+def time_algorithm(settle, sizes, seed):
+    rng = random.Random(seed)
+    for size in sizes:
+        balances = {user_id: rng.randint(-500000, 500000) for user_id in range(1, size)}
+        balances[size] = -sum(balances.values())
+        started = time.perf_counter()
+        transfers = settle.min_cash_flow(balances)
+        elapsed = time.perf_counter() - started
+        print(f"min_cash_flow {size:>7} members: {len(transfers):>7} transfers in {elapsed * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--members', type=int, default=300)
+    parser.add_argument('--debts', type=int, default=10000)
+    parser.add_argument('--transfers', type=int, default=500, help='group transfers already made')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='member counts for the min_cash_flow-only timings')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    seeded = os.path.join(DATA_DIR, f'{args.scale}.db')
+    if not os.path.exists(seeded):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        build(seeded, seed=args.seed, **SCALES[args.scale])
+    workdir = tempfile.mkdtemp(prefix='settle-bench-')
+    db_path = os.path.join(workdir, 'payments.db')
+    shutil.copyfile(seeded, db_path)
+    group_id, rows = make_group(db_path, args.members, args.debts, args.transfers, args.seed)
+
+    stub = expo_stub.make_server()
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    os.environ['DB_PATH'] = db_path
+    os.environ['EXPO_PUSH_URL'] = expo_stub.push_url(stub)
+
+    import app as payments
+    import ledger
+    import settle
+    client = payments.app.test_client()
+
+    conn = payments.pool.acquire()
+    cursor = conn.cursor()
+    started = time.perf_counter()
+    balances, _, open_requests, group_transfers = settle.net_balances(cursor, group_id, 0)
+    net_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    plan = settle.min_cash_flow(balances)
+    plan_ms = (time.perf_counter() - started) * 1000
+    before = dict(conn.execute('SELECT iban, balance_cents FROM bank_balances').fetchall())
+    payments.pool.release(conn)
+
+    started = time.perf_counter()
+    preview = client.get(f'/groups/{group_id}/settle?user_id=1').get_json()
+    preview_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    response = client.post(f'/groups/{group_id}/settle', json={'user_id': 1, 'fingerprint': preview['fingerprint']})
+    execute_ms = (time.perf_counter() - started) * 1000
+    after_preview = client.get(f'/groups/{group_id}/settle?user_id=1').get_json()
+
+    conn = payments.pool.acquire()
+    after = dict(conn.execute('SELECT iban, balance_cents FROM bank_balances').fetchall())
+    mismatches = ledger.audit(conn)
+    payments.pool.release(conn)
+    moved = [user_id for user_id, cents in balances.items()
+             if after[user_iban(user_id)] - before[user_iban(user_id)] != cents]
+
+    print(f"{args.members} members, {open_requests} open debts, {group_transfers} group transfers")
+    print(f"net balances (SQL)       {net_ms:8.1f} ms")
+    print(f"min_cash_flow            {plan_ms:8.1f} ms")
+    print(f"GET  /groups/<id>/settle {preview_ms:8.1f} ms")
+    print(f"POST /groups/<id>/settle {execute_ms:8.1f} ms (status {response.status_code})")
+    print(f"transfers: {len(rows)} paying every debt as is, {pairwise_transfers(rows)} netting pairwise, "
+          f"{len(plan)} with the plan ({sum(1 for cents in balances.values() if cents)} non-zero balances)")
+    time_algorithm(settle, args.sizes, args.seed)
+
+    payments.dispatcher.stop(drain=True)
+    stub.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+    print(f"open after settling={len(after_preview['transfers'])} balance mismatches={len(moved)} "
+          f"ledger mismatches={len(mismatches)}")
+    sys.exit(1 if response.status_code != 200 or after_preview['transfers'] or moved or mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""Build a synthetic payments database of a chosen size for benchmarking.
+
+The schema comes from migrations.py, so it always matches what the app
+expects. The data is generated from a fixed seed, which means the same
+arguments always produce the same database.
+
+    python bench/synthetic_db.py /tmp/bench.db --users 100000 --transactions 10000000 --groups 50000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ledger
+import migrations
+
+# Named sizes for api_bench.py --scale; 'large' is the production-sized target
+SCALES = {
+    'small': {'users': 2000, 'transactions': 50000, 'groups': 500, 'pending': 5000},
+    'medium': {'users': 20000, 'transactions': 1000000, 'groups': 5000, 'pending': 50000},
+    'large': {'users': 100000, 'transactions': 10000000, 'groups': 50000, 'pending': 200000},
+}
+
+# Every synthetic account starts rich enough that benchmark transfers rarely bounce
+START_BALANCE_CENTS = 10000000
+
+# Rows per executemany() batch and per commit while loading
+CHUNK_SIZE = 50000
+
+TRANSACTION_TYPES = ('transfer', 'request_sent', 'split_sent')
+
+# Names are combined from these so searches see realistic, accented, repeating words
+FIRST_NAMES = ('Ana', 'Marko', 'Petra', 'Tomaž', 'Nina', 'Luka', 'Maja', 'Jan', 'Sara', 'Žan', 'Katarina', 'Miha',
+               'Tjaša', 'Rok', 'Eva', 'Nejc', 'Tina', 'Gregor', 'Barbara', 'David', 'Špela', 'Matej', 'Urška', 'Črt')
+LAST_NAMES = ('Novak', 'Kovač', 'Zupan', 'Horvat', 'Mlakar', 'Kralj', 'Rozman', 'Potočnik', 'Bizjak', 'Kastelic',
+              'Koren', 'Medved', 'Vidmar', 'Zajc', 'Kos', 'Kosi', 'Lesjak', 'Hrovat', 'Turk', 'Dolinar', 'Šinkovec',
+              'Žagar', 'Golob', 'Jerše', 'Pečnik', 'Erjavec', 'Kolar', 'Černe', 'Štrukelj', 'Jereb')
+
+
+def user_iban(user_id):
+    return f'SI56{user_id:015d}'
+
+
+def user_name(user_id):
+    # Deterministic and spread out, so neighbouring ids don't share a name
+    first = FIRST_NAMES[user_id * 7 % len(FIRST_NAMES)]
+    last = LAST_NAMES[user_id * 13 // len(FIRST_NAMES) % len(LAST_NAMES)]
+    return f'{first} {last} {user_id}'
+
+
+def _chunked(rows, size=CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _load(conn, sql, rows):
+    count = 0
+    for chunk in _chunked(rows):
+        conn.executemany(sql, chunk)
+        conn.commit()
+        count += len(chunk)
+    return count
+
+
+def build(path, users, transactions, groups, pending, push_tokens=0.5, seed=42, log=print):
+    """Create `path` from scratch and fill it with synthetic rows.
+
+    User ids are 1..users. A `push_tokens` fraction of the users get a
+    token, so requests that notify people also go through the push outbox.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    started = time.perf_counter()
+
+    conn = sqlite3.connect(path)
+    migrations.upgrade(conn, log=lambda message: None)
+    # Nobody else can see this file yet, so skip durability while loading
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA cache_size = -200000')
+
+    _load(conn, 'INSERT INTO users (id, name, email, phone, iban) VALUES (?, ?, ?, ?, ?)', (
+        (i, user_name(i), f'user{i}@bench.test', f'+386 40 {i // 1000 % 1000:03d} {i % 1000:03d}', user_iban(i))
+        for i in range(1, users + 1)
+    ))
+    _load(conn, 'INSERT INTO bank_balances (iban, balance_cents) VALUES (?, ?)', (
+        (user_iban(i), START_BALANCE_CENTS) for i in range(1, users + 1)
+    ))
+    ledger.record_opening_balances(conn.cursor())
+    conn.commit()
+    _load(conn, 'INSERT INTO push_tokens (user_id, push_token) VALUES (?, ?)', (
+        (i, f'ExponentPushToken[bench-{i}]') for i in range(1, users + 1) if rng.random() < push_tokens
+    ))
+    log(f'users: {users}')
+
+    # History spans the last year, oldest first, like a real append-only log
+    start = datetime(2025, 1, 1)
+    step = timedelta(days=365) / max(transactions, 1)
+
+    def transaction_rows():
+        for n in range(transactions):
+            initiator, target = rng.randint(1, users), rng.randint(1, users)
+            kind = rng.choice(TRANSACTION_TYPES)
+            timestamp = (start + step * n).strftime('%Y-%m-%d %H:%M:%S')
+            if kind == 'split_sent':
+                yield kind, initiator, None, rng.randint(100, 20000), 'completed', timestamp, 'Bench split'
+            else:
+                status = 'completed' if kind == 'transfer' else rng.choice(('completed', 'rejected'))
+                yield kind, initiator, target, rng.randint(1, 10000), status, timestamp, ''
+
+    loaded = _load(conn, '''
+        INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, timestamp, memo)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', transaction_rows())
+    log(f'transactions: {loaded}')
+
+    def pending_rows():
+        for _ in range(pending):
+            requester, payer = rng.sample(range(1, users + 1), 2) if users > 1 else (1, 1)
+            yield requester, payer, rng.randint(1, 5000)
+
+    _load(conn, 'INSERT INTO pending_requests (requester_id, payer_id, amount_cents) VALUES (?, ?, ?)', pending_rows())
+    conn.execute('''
+        INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, memo, request_ref)
+        SELECT 'request_sent', requester_id, payer_id, amount_cents, 'pending', '', id FROM pending_requests
+    ''')
+    conn.commit()
+    log(f'pending requests: {pending}')
+
+    memberships = []
+    for group_id in range(1, groups + 1):
+        creator = rng.randint(1, users)
+        members = set(rng.sample(range(1, users + 1), min(users, rng.randint(2, 8))))
+        members.discard(creator)
+        memberships.append((group_id, f'Bench Group {group_id}', creator, sorted(members)))
+    _load(conn, 'INSERT INTO groups (id, name, creator_id, member_ids) VALUES (?, ?, ?, ?)', (
+        (group_id, name, creator, json.dumps(members)) for group_id, name, creator, members in memberships
+    ))
+    _load(conn, 'INSERT INTO group_members (group_id, user_id) VALUES (?, ?)', (
+        (group_id, user_id)
+        for group_id, _, creator, members in memberships
+        for user_id in [creator, *members]
+    ))
+    log(f'groups: {groups}')
+
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.close()
+    log(f'built {path} in {time.perf_counter() - started:.1f}s ({os.path.getsize(path) / 1e6:.0f} MB)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--transactions', type=int)
+    parser.add_argument('--groups', type=int)
+    parser.add_argument('--pending', type=int)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    sizes = dict(SCALES[args.scale])
+    for key in sizes:
+        if getattr(args, key) is not None:
+            sizes[key] = getattr(args, key)
+    build(args.path, seed=args.seed, **sizes)
+
+
+if __name__ == '__main__':
+    main()
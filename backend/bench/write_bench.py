@@ -0,0 +1,169 @@
+"""Commits per second through /transfer_money, with and without the writer thread (writer.py).
+
+Works on a scratch copy of a synthetic database (see synthetic_db.py).
+Each mode starts --processes worker processes, as gunicorn would, each
+importing the app with WRITE_QUEUE set and driving /transfer_money
+through the Flask test client from --threads threads for --duration
+seconds. Every transfer moves 1 cent between two random users.
+
+  inline  WRITE_QUEUE=0: each request thread runs BEGIN IMMEDIATE ... COMMIT
+          on its own pooled connection
+  queue   WRITE_QUEUE=1: request threads hand intents to the worker's writer
+          thread, which commits them in batches
+
+The report gives committed transfers/s, p50/p99 latency, failed requests
+and how many of them were "database is locked", and for the queue the
+mean batch size. The ledger is audited after each mode.
+
+    python bench/write_bench.py --threads 16 --duration 10
+    python bench/write_bench.py --processes 4 --threads 8 --batch-delay-ms 1
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+import expo_stub
+import ledger
+import migrations
+from api_bench import percentile
+from synthetic_db import SCALES, build, user_iban
+
+DATA_DIR = os.path.join(BACKEND_DIR, 'bench', 'data')
+
+MODES = {'inline': '0', 'queue': '1'}
+
+
+def worker_process(index, env, threads, duration, users, seed, start_at, results):
+    os.environ.update(env)
+    import app as payments
+
+    latencies, statuses, locked = [], {}, [0]
+    lock = threading.Lock()
+
+    def worker(thread_index):
+        rng = random.Random(f'{seed}-{index}-{thread_index}')
+        client = payments.app.test_client()
+        local, codes, local_locked = [], {}, 0
+        while time.time() < start_at:
+            time.sleep(0.001)
+        stop_at = start_at + duration
+        while time.time() < stop_at:
+            sender, receiver = rng.sample(range(1, users + 1), 2)
+            started = time.perf_counter()
+            response = client.post('/transfer_money', json={
+                'sender_iban': user_iban(sender), 'receiver_iban': user_iban(receiver), 'amount_cents': 1})
+            local.append((time.perf_counter() - started) * 1000)
+            codes[response.status_code] = codes.get(response.status_code, 0) + 1
+            if response.status_code >= 500 and 'locked' in (response.get_json() or {}).get('error', ''):
+                local_locked += 1
+        with lock:
+            latencies.extend(local)
+            for status, n in codes.items():
+                statuses[status] = statuses.get(status, 0) + n
+            locked[0] += local_locked
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    writer = payments.writes.stats()
+    payments.writes.stop()
+    payments.dispatcher.stop(drain=False)
+    results.put((latencies, statuses, locked[0], writer))
+
+
+def run_mode(mode, db_path, push_url, args, users):
+    env = {
+        'DB_PATH': db_path,
+        'EXPO_PUSH_URL': push_url,
+        'METRICS_ENABLED': '0',
+        'WRITE_QUEUE': MODES[mode],
+        'WRITE_BATCH_SIZE': str(args.batch_size),
+        'WRITE_BATCH_DELAY_MS': str(args.batch_delay_ms),
+    }
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    # Imports take a while in a spawned process; everyone starts on the same clock
+    start_at = time.time() + 3 + args.processes
+    processes = [context.Process(target=worker_process,
+                                 args=(i, env, args.threads, args.duration, users, args.seed, start_at, results))
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+    latencies, statuses, locked, writers = [], {}, 0, []
+    for _ in processes:
+        process_latencies, process_statuses, process_locked, writer = results.get()
+        latencies.extend(process_latencies)
+        for status, n in process_statuses.items():
+            statuses[status] = statuses.get(status, 0) + n
+        locked += process_locked
+        writers.append(writer)
+    for process in processes:
+        process.join()
+    return sorted(latencies), statuses, locked, writers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=16, help='request threads per process')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--batch-delay-ms', type=float, default=0.0)
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=list(MODES))
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    seeded = os.path.join(DATA_DIR, f'{args.scale}.db')
+    if not os.path.exists(seeded):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        build(seeded, seed=args.seed, **SCALES[args.scale])
+    users = SCALES[args.scale]['users']
+
+    stub = expo_stub.make_server()
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    print(f"{args.processes} process(es) x {args.threads} threads, {args.duration:.0f}s per mode")
+    print(f"{'mode':<7} {'commits/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'failed':>7} {'locked':>7} "
+          f"{'batch':>6}  statuses")
+    mismatched = False
+    for mode in args.modes:
+        workdir = tempfile.mkdtemp(prefix='write-bench-')
+        db_path = os.path.join(workdir, 'payments.db')
+        shutil.copyfile(seeded, db_path)
+        conn = sqlite3.connect(db_path)
+        migrations.upgrade(conn, log=lambda message: None)
+        conn.close()
+
+        latencies, statuses, locked, writers = run_mode(mode, db_path, expo_stub.push_url(stub), args, users)
+        committed = statuses.get(200, 0)
+        failed = sum(n for status, n in statuses.items() if status != 200)
+        batches = sum(writer['batches'] for writer in writers)
+        batch = f"{sum(writer['intents'] for writer in writers) / batches:.1f}" if batches else '-'
+        print(f"{mode:<7} {committed / args.duration:>10,.0f} {percentile(latencies, 0.5):>8.2f} "
+              f"{percentile(latencies, 0.99):>8.2f} {failed:>7} {locked:>7} {batch:>6}  {dict(sorted(statuses.items()))}")
+
+        conn = sqlite3.connect(db_path)
+        mismatches = ledger.audit(conn)
+        conn.close()
+        if mismatches:
+            print(f"  ledger mismatches={len(mismatches)}")
+            mismatched = True
+        shutil.rmtree(workdir, ignore_errors=True)
+    stub.shutdown()
+    sys.exit(1 if mismatched else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import csv
+import io
+import itertools
+import json
+import tempfile
+
+import ledger
+import splits
+
+# Lines per write transaction; keeps each lock hold short while amortizing the commit
+BULK_CHUNK_SIZE = 500
+
+# Upper bound on one upload, checked while reading; everything is applied in one request
+BULK_MAX_LINES = 100000
+
+# A planned upload stays in memory up to this size and spills to a temporary file past it
+SPOOL_MEMORY = 1024 * 1024
+
+CSV_CONTENT_TYPES = ('text/csv', 'application/csv')
+
+
+class BulkError(ValueError):
+    pass
+
+
+class TooManyLines(BulkError):
+    pass
+
+
+def _parse_line(line_no, record):
+    """(line_no, receiver_iban, amount_cents, memo, error) for one NDJSON object or CSV row."""
+    try:
+        receiver_iban = str(record['receiver_iban']).strip()
+        amount_cents = int(record['amount_cents'])
+    except (KeyError, TypeError, ValueError) as e:
+        return line_no, None, None, None, f'Invalid line: {e}'
+    if amount_cents <= 0:
+        return line_no, receiver_iban, amount_cents, None, 'Amount must be positive'
+    return line_no, receiver_iban, amount_cents, str(record.get('memo') or ''), None
+
+
+def read_lines(stream, content_type):
+    """Parse an NDJSON (default) or CSV upload into parsed line tuples, yielded as the body is read.
+
+    CSV needs a header row naming receiver_iban and amount_cents (memo optional).
+    Blank lines are skipped but still count towards line numbers.
+    """
+    if isinstance(stream, io.RawIOBase):
+        stream = io.BufferedReader(stream)
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    if content_type in CSV_CONTENT_TYPES:
+        reader = csv.DictReader(text)
+        if not reader.fieldnames or not {'receiver_iban', 'amount_cents'} <= set(reader.fieldnames):
+            raise BulkError('CSV header must include receiver_iban and amount_cents')
+        lines = (_parse_line(reader.line_num, record) for record in reader)
+    else:
+        lines = _parse_ndjson(text)
+    for count, line in enumerate(lines, start=1):
+        if count > BULK_MAX_LINES:
+            raise TooManyLines(f'At most {BULK_MAX_LINES} lines per upload')
+        yield line
+
+
+def _parse_ndjson(text):
+    for line_no, raw in enumerate(text, start=1):
+        if not raw.strip():
+            continue
+        try:
+            record = json.loads(raw)
+        except ValueError as e:
+            yield line_no, None, None, None, f'Invalid JSON: {e}'
+            continue
+        yield _parse_line(line_no, record if isinstance(record, dict) else {})
+
+
+def chunks(items, size=BULK_CHUNK_SIZE):
+    items = iter(items)
+    while chunk := list(itertools.islice(items, size)):
+        yield chunk
+
+
+class Plan:
+    """Resolved transfers and per-line failures of one upload, spooled rather than held in memory.
+
+    Only the counts and the total are kept as attributes; the rows go to
+    temporary files (in memory up to SPOOL_MEMORY each) and are read back
+    once, a chunk at a time.
+    """
+
+    def __init__(self):
+        self._transfers = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY, mode='w+')
+        self._failures = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY, mode='w+')
+        self.transfers = 0
+        self.failures = 0
+        self.total_cents = 0
+
+    def add_transfer(self, transfer):
+        self._transfers.write(json.dumps(transfer) + '\n')
+        self.transfers += 1
+        self.total_cents += transfer[3]
+
+    def add_failure(self, failure):
+        self._failures.write(json.dumps(failure) + '\n')
+        self.failures += 1
+
+    def failure_lines(self):
+        # Already-serialized NDJSON result lines
+        self._failures.seek(0)
+        return iter(self._failures)
+
+    def transfer_chunks(self, size=BULK_CHUNK_SIZE):
+        self._transfers.seek(0)
+        return chunks((tuple(json.loads(row)) for row in self._transfers), size)
+
+    def close(self):
+        self._transfers.close()
+        self._failures.close()
+
+
+def plan(cursor, sender_id, lines):
+    """Resolve receivers with one IN (...) query per chunk of lines; returns a Plan.
+
+    Transfers are (line_no, receiver_id, receiver_iban, amount_cents, memo)
+    ready to apply, failures are per-line error results.
+    """
+    result = Plan()
+    try:
+        for chunk in chunks(lines):
+            users = splits.resolve_ibans(cursor, [line[1] for line in chunk if line[4] is None])
+            for line_no, receiver_iban, amount_cents, memo, error in chunk:
+                if error is None and receiver_iban not in users:
+                    error = 'Receiver not found'
+                if error is None and users[receiver_iban][0] == sender_id:
+                    error = 'Cannot transfer to yourself'
+                if error:
+                    result.add_failure({'line': line_no, 'status': 'error', 'error': error})
+                else:
+                    result.add_transfer((line_no, users[receiver_iban][0], receiver_iban, amount_cents, memo))
+    except BaseException:
+        result.close()
+        raise
+    return result
+
+
+def apply_chunk(cursor, sender_id, sender_iban, chunk):
+    """Write one chunk inside the caller's (immediate) transaction; returns transaction ids in chunk order."""
+    # We hold the write lock, so every row above this id is one we insert below
+    cursor.execute('SELECT COALESCE(MAX(id), 0) FROM transactions')
+    first_new_id = cursor.fetchone()[0]
+
+    cursor.executemany('''
+        INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, memo)
+        VALUES ('transfer', ?, ?, ?, 'completed', ?)
+    ''', [(sender_id, receiver_id, amount_cents, memo) for _, receiver_id, _, amount_cents, memo in chunk])
+    cursor.execute('SELECT id FROM transactions WHERE id > ? ORDER BY id', (first_new_id,))
+    transaction_ids = [row[0] for row in cursor.fetchall()]
+
+    # One guarded debit for the whole chunk, credits summed per receiver
+    ledger.pay_many(cursor, sender_iban, [
+        (receiver_iban, amount_cents, transaction_id)
+        for (_, _, receiver_iban, amount_cents, _), transaction_id in zip(chunk, transaction_ids)
+    ], 'transfer')
+    return transaction_ids
@@ -0,0 +1,38 @@
+import json
+
+# Rows per fetchmany() call, and so per chunk of a columnar response
+FETCH_SIZE = 1000
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def requested(request):
+    return request.args.get('format') == 'columnar'
+
+
+def encode(cursor, fields, convert=None, trailer=None, fetch_size=FETCH_SIZE):
+    """Yield the rows left in `cursor` as a columnar JSON document, one piece per fetchmany() batch.
+
+        {"fields": ["id", ...], "chunks": [{"id": [...], ...}, ...], "count": N, ...}
+
+    Each chunk holds one batch as parallel arrays in `fields` order, so
+    neither the server nor the client has to hold one object per row.
+    Values go out as stored (amounts stay integer cents). `convert(row)`
+    rewrites a row before encoding; `trailer(last_row, count)` returns
+    extra top-level members such as a next-page cursor.
+    """
+    yield '{"fields":' + _dumps(fields) + ',"chunks":['
+    count, last_row = 0, None
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            break
+        if convert is not None:
+            rows = [convert(row) for row in rows]
+        yield (',' if count else '') + _dumps(dict(zip(fields, zip(*rows))))
+        count += len(rows)
+        last_row = rows[-1]
+    extra = trailer(last_row, count) if trailer is not None else {}
+    yield '],"count":' + str(count) + ''.join(f',{_dumps(key)}:{_dumps(value)}' for key, value in extra.items()) + '}'
@@ -0,0 +1,246 @@
+import os
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g
+
+# Connection tuning applied once per physical connection
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',   # Safe with WAL, avoids an fsync per commit
+    'PRAGMA cache_size = -16000',    # ~16 MB page cache per connection
+    'PRAGMA mmap_size = 268435456',  # 256 MB memory-mapped reads
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA journal_size_limit = 67108864',  # Shrink the WAL file back to 64 MB whenever it is reset
+)
+
+# Size of sqlite3's per-connection prepared statement LRU
+STATEMENT_CACHE_SIZE = 256
+
+
+class ConnectionPool:
+    """Bounded pool of long-lived SQLite connections.
+
+    A connection is checked out for the lifetime of a Flask app context and
+    handed back on teardown, so every worker thread reuses a warm connection
+    (page cache, parsed schema, prepared statements) instead of reconnecting.
+    A `readonly` pool's connections refuse writes (PRAGMA query_only).
+    """
+
+    def __init__(self, path, max_connections=16, timeout=10.0, factory=sqlite3.Connection, wal_autocheckpoint=None,
+                 readonly=False):
+        self.path = path
+        self.factory = factory
+        self.wal_autocheckpoint = wal_autocheckpoint
+        self.readonly = readonly
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._idle = []
+        self._open = 0
+        self._cond = threading.Condition()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def _create(self):
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,  # Connections move between threads via the pool
+            cached_statements=STATEMENT_CACHE_SIZE,
+            factory=self.factory,
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if self.wal_autocheckpoint is not None:
+            # 0 leaves checkpointing to a Checkpointer instead of whichever commit crosses the threshold
+            conn.execute(f'PRAGMA wal_autocheckpoint = {int(self.wal_autocheckpoint)}')
+        if self.readonly:
+            conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def acquire(self):
+        with self._cond:
+            deadline = time.monotonic() + self.timeout
+            waited = False
+            while not self._idle and self._open >= self.max_connections:
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('Timed out waiting for a database connection')
+                self._cond.wait(remaining)
+
+            if self._idle:
+                self.hits += 1
+                return self._idle.pop()
+
+            self.misses += 1
+            self._open += 1
+
+        try:
+            return self._create()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn):
+        # Never hand a connection with an open transaction to the next caller
+        if conn.in_transaction:
+            conn.rollback()
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        finally:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'open': self._open,
+                'idle': len(self._idle),
+                'max_connections': self.max_connections,
+                'readonly': self.readonly,
+            }
+
+
+CHECKPOINT_MODES = ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE')
+
+
+def checkpoint(conn, mode='PASSIVE'):
+    """Run a WAL checkpoint; returns (busy, wal_frames, checkpointed_frames)."""
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError(f'Unknown checkpoint mode: {mode}')
+    return tuple(conn.execute(f'PRAGMA wal_checkpoint({mode})').fetchone())
+
+
+class Checkpointer:
+    """Background WAL checkpoints on a dedicated connection.
+
+    Meant for servers that turn off wal_autocheckpoint in their request
+    connections: every `interval` seconds it copies committed WAL frames
+    back into the database without blocking readers or writers (PASSIVE).
+    Once the WAL file grows past `max_wal_bytes` it uses RESTART, which
+    waits up to busy_timeout for readers so the log can be reused from
+    the start.
+
+    With `lock_path`, every worker process can run one and only the holder
+    of an exclusive flock on that file checkpoints; if it exits, another
+    worker's checkpointer takes over on its next tick.
+    """
+
+    def __init__(self, path, interval=1.0, max_wal_bytes=64 * 1024 * 1024, lock_path=None):
+        self.path = path
+        self.interval = interval
+        self.max_wal_bytes = max_wal_bytes
+        self.lock_path = lock_path
+        self._lock_file = None
+        self._stopping = threading.Event()
+        self._thread = None
+        self.checkpoints = 0
+        self.restarts = 0
+        self.busy = 0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='wal-checkpointer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _holds_lock(self):
+        if self.lock_path is None:
+            return True
+        if self._lock_file is None:
+            import fcntl
+            lock_file = open(self.lock_path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+        return True
+
+    def _wal_bytes(self):
+        try:
+            return os.path.getsize(self.path + '-wal')
+        except OSError:
+            return 0
+
+    def _run(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            conn.execute('PRAGMA busy_timeout = 5000')
+            while not self._stopping.wait(self.interval):
+                if not self._holds_lock():
+                    continue
+                mode = 'RESTART' if self._wal_bytes() > self.max_wal_bytes else 'PASSIVE'
+                try:
+                    busy, _, _ = checkpoint(conn, mode)
+                except sqlite3.Error as e:
+                    print(f"Checkpoint error: {e}")
+                    continue
+                self.checkpoints += 1
+                self.restarts += mode == 'RESTART'
+                self.busy += busy
+        finally:
+            conn.close()
+            if self._lock_file is not None:
+                self._lock_file.close()  # Releases the flock for the next worker
+                self._lock_file = None
+
+
+def init_app(app, pool, readers=None):
+    app.extensions['db_pool'] = pool
+    app.extensions['db_readers'] = readers or pool
+
+    @app.teardown_appcontext
+    def release_db(exc):
+        for name, owner in (('db', pool), ('reader', readers or pool)):
+            conn = g.pop(name, None)
+            if conn is None:
+                continue
+            try:
+                owner.release(conn)
+            except sqlite3.Error:
+                owner.discard(conn)
+
+
+def get_db():
+    # One pooled connection per app context, reused by every helper in the request
+    if 'db' not in g:
+        g.db = current_app.extensions['db_pool'].acquire()
+    return g.db
+
+
+def get_reader():
+    # Like get_db(), from the read-only pool when the app has one
+    if 'reader' not in g:
+        g.reader = current_app.extensions['db_readers'].acquire()
+    return g.reader
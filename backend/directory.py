@@ -0,0 +1,68 @@
+import hashlib
+import json
+import threading
+import time
+
+import columnar
+
+
+class UserDirectory:
+    """In-process cache of the serialized `/users` payload.
+
+    The payload is rebuilt with one joined query only after `invalidate()`
+    (called by routes that change users or balances) or once `ttl` seconds
+    have passed, which bounds staleness from writes made by other workers.
+    The row and columnar (`?format=columnar`) bodies are cached separately.
+    """
+
+    FIELDS = ('id', 'name', 'email', 'phone', 'iban', 'balance_cents')
+
+    def __init__(self, ttl=5.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cached = {}  # format -> (body, etag, loaded_at)
+        self._version = 0
+        self.hits = 0
+        self.rebuilds = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+            self._cached.clear()
+
+    def get(self, conn, fmt='rows'):
+        with self._lock:
+            cached = self._cached.get(fmt)
+            if cached is not None and time.monotonic() - cached[2] < self.ttl:
+                self.hits += 1
+                return cached[0], cached[1]
+            version = self._version
+
+        body = self._build(conn, fmt)
+        etag = hashlib.sha1(body).hexdigest()
+
+        with self._lock:
+            # Don't cache a snapshot that an invalidate() raced past while we were building
+            if version == self._version:
+                self._cached[fmt] = (body, etag, time.monotonic())
+            self.rebuilds += 1
+        return body, etag
+
+    def _build(self, conn, fmt):
+        cursor = conn.execute('''
+            SELECT u.id, u.name, u.email, u.phone, u.iban, COALESCE(b.balance_cents, 0)
+            FROM users u
+            LEFT JOIN bank_balances b ON b.iban = u.iban
+            ORDER BY u.id
+        ''')
+        if fmt == 'columnar':
+            return ''.join(columnar.encode(cursor, self.FIELDS)).encode()
+        users_list = [{
+            'id': id,
+            'name': name,
+            'email': email,
+            'phone': phone,
+            'iban': iban,
+            'balance': balance_cents / 100.0
+        } for id, name, email, phone, iban, balance_cents in cursor.fetchall()]
+        return json.dumps(users_list, separators=(',', ':')).encode()
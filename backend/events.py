@@ -0,0 +1,222 @@
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from collections import deque
+
+# Put on every open stream by close() so its generator returns
+_CLOSED = object()
+
+
+class TooManyStreams(RuntimeError):
+    pass
+
+
+class EventBroker:
+    """In-process pub/sub fan-out for the `/events` Server-Sent Events stream.
+
+    Routes publish small "something changed" events per user after they
+    commit; every open stream for that user gets a copy. The last `history`
+    events per user are kept so a reconnecting client can resume from its
+    `Last-Event-ID` instead of refetching everything.
+
+    Each open stream holds a server thread until the client goes away, so
+    at most `max_streams` are open at once (None for no limit); stream()
+    raises TooManyStreams past that.
+    """
+
+    def __init__(self, history=100, heartbeat=15.0, max_streams=None):
+        self.heartbeat = heartbeat
+        self.max_streams = max_streams
+        self._history_size = history
+        self._epoch = str(int(time.time() * 1000))  # Distinguishes ids issued before a restart
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self._history = {}      # user_id -> deque of (event_id, topic, payload)
+        self._subscribers = {}  # user_id -> set of queues
+        self._evicted = {}      # user_id -> newest event id dropped from history
+        self._open_streams = 0
+        self._closed = False
+        self._relay = None
+        self.published = 0
+        self.rejected = 0
+
+    def enable_relay(self, directory):
+        # Share published events with the other worker processes using the same directory
+        self._relay = EventRelay(self, directory)
+
+    def publish(self, user_ids, topic, data=None):
+        payload = json.dumps(data or {}, separators=(',', ':'))
+        self._deliver(user_ids, topic, payload)
+        if self._relay is not None:
+            self._relay.send(user_ids, topic, payload)
+
+    def _deliver(self, user_ids, topic, payload):
+        with self._lock:
+            for user_id in set(user_ids):
+                self._last_id += 1
+                event = (self._last_id, topic, payload)
+                history = self._history.get(user_id)
+                if history is None:
+                    history = self._history[user_id] = deque(maxlen=self._history_size)
+                if len(history) == history.maxlen:
+                    self._evicted[user_id] = history[0][0]
+                history.append(event)
+                for subscriber in self._subscribers.get(user_id, ()):
+                    subscriber.put(event)
+                self.published += 1
+
+    def _parse_event_id(self, value):
+        # Ids look like "<epoch>-<n>"; anything from another process lifetime maps to -1
+        epoch, _, n = (value or '').partition('-')
+        if epoch != self._epoch or not n.isdigit():
+            return -1
+        return int(n)
+
+    def _subscribe(self, user_id, last_event_id):
+        subscriber = queue.SimpleQueue()
+        with self._lock:
+            if self.max_streams is not None and self._open_streams >= self.max_streams:
+                self.rejected += 1
+                raise TooManyStreams(f'{self._open_streams} event streams already open')
+            self._open_streams += 1
+            if self._closed:
+                subscriber.put(_CLOSED)
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+            history = list(self._history.get(user_id, ()))
+            evicted = self._evicted.get(user_id, 0)
+            newest = self._last_id
+        if not last_event_id:
+            return subscriber, [], False
+
+        last_seen = self._parse_event_id(last_event_id)
+        missed = [event for event in history if event[0] > last_seen]
+        # Events we no longer hold, or ids from before a restart, need a full refetch
+        gap = last_seen < evicted or last_seen > newest
+        return subscriber, missed, gap
+
+    def _unsubscribe(self, user_id, subscriber):
+        with self._lock:
+            self._open_streams -= 1
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    def _format(self, event):
+        event_id, topic, payload = event
+        return f'id: {self._epoch}-{event_id}\nevent: {topic}\ndata: {payload}\n\n'
+
+    def stream(self, user_id, last_event_id=None):
+        subscriber, missed, gap = self._subscribe(user_id, last_event_id)
+
+        def generate():
+            try:
+                yield  # Primed below
+                yield 'retry: 3000\n\n'
+                if gap:
+                    yield 'event: resync\ndata: {}\n\n'
+                for event in missed:
+                    yield self._format(event)
+                while True:
+                    try:
+                        event = subscriber.get(timeout=self.heartbeat)
+                    except queue.Empty:
+                        # SSE comment line keeps proxies and the browser from timing out
+                        yield ': heartbeat\n\n'
+                        continue
+                    if event is _CLOSED:
+                        return
+                    yield self._format(event)
+            finally:
+                self._unsubscribe(user_id, subscriber)
+
+        # Once started, closing the stream (or dropping it unread) runs the finally and frees its slot
+        stream = generate()
+        next(stream)
+        return stream
+
+    def close(self):
+        """End every open stream (and any opened later) so a graceful shutdown isn't held up.
+
+        Clients reconnect to another worker with their Last-Event-ID, which
+        that worker answers with a resync.
+        """
+        with self._lock:
+            self._closed = True
+            for subscribers in self._subscribers.values():
+                for subscriber in subscribers:
+                    subscriber.put(_CLOSED)
+        if self._relay is not None:
+            self._relay.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'published': self.published,
+                'subscribed_users': len(self._subscribers),
+                'open_streams': self._open_streams,
+                'max_streams': self.max_streams,
+                'rejected': self.rejected,
+                'relay': self._relay is not None,
+            }
+
+
+class EventRelay:
+    """Forwards events between the worker processes of one server.
+
+    Each worker binds a Unix datagram socket named after its pid in
+    `directory`. Events published in one worker are sent to every other
+    socket there, and a receiver thread delivers incoming events to the
+    local streams only (never relaying them again). Sockets left behind
+    by dead workers are removed on the first failed send.
+    """
+
+    def __init__(self, broker, directory):
+        self.broker = broker
+        self.directory = directory
+        self.path = os.path.join(directory, f'{os.getpid()}.sock')
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._socket.bind(self.path)
+        self._thread = threading.Thread(target=self._receive, name='event-relay', daemon=True)
+        self._thread.start()
+
+    def send(self, user_ids, topic, payload):
+        message = json.dumps([list(set(user_ids)), topic, payload], separators=(',', ':')).encode()
+        for entry in os.scandir(self.directory):
+            if entry.path == self.path or not entry.name.endswith('.sock'):
+                continue
+            try:
+                self._socket.sendto(message, entry.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+            except OSError as e:
+                # A full receive buffer drops the event for that worker; its clients resync on reconnect
+                print(f"Event relay send to {entry.name} failed: {e}")
+
+    def _receive(self):
+        while True:
+            try:
+                message = self._socket.recv(65536)
+            except OSError:
+                return  # Socket closed
+            try:
+                user_ids, topic, payload = json.loads(message)
+            except ValueError:
+                continue
+            self.broker._deliver(user_ids, topic, payload)
+
+    def close(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self._socket.close()
@@ -0,0 +1,79 @@
+"""Local stand-in for the Expo push API.
+
+Run it and point the backend at it:
+
+    python expo_stub.py --port 8081
+    EXPO_PUSH_URL=http://127.0.0.1:8081/--/api/v2/push/send python app.py
+
+Use --delay and --fail-rate to simulate a slow or flaky Expo.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ExpoStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real endpoint
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'[]')
+        messages = payload if isinstance(payload, list) else [payload]
+
+        server = self.server
+        if server.delay:
+            time.sleep(server.delay)
+
+        if random.random() < server.fail_rate:
+            status, body = 503, {'errors': [{'code': 'UNAVAILABLE', 'message': 'stub failure'}]}
+        else:
+            status, body = 200, {'data': [{'status': 'ok', 'id': str(uuid.uuid4())} for _ in messages]}
+            with server.lock:
+                server.received.extend(messages)
+                server.requests += 1
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(host='127.0.0.1', port=0, delay=0.0, fail_rate=0.0, quiet=True):
+    # port=0 picks a free port; read it back from server.server_address
+    server = ThreadingHTTPServer((host, port), ExpoStubHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.fail_rate = fail_rate
+    server.quiet = quiet
+    server.lock = threading.Lock()
+    server.received = []
+    server.requests = 0
+    return server
+
+
+def push_url(server):
+    host, port = server.server_address[:2]
+    return f'http://{host}:{port}/--/api/v2/push/send'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds to wait before answering')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.delay, args.fail_rate, quiet=False)
+    print(f"Expo stub listening on {push_url(server)}")
+    server.serve_forever()
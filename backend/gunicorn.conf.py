@@ -0,0 +1,123 @@
+"""Production serving: gunicorn with threaded workers (Linux/macOS).
+
+    cd backend
+    flask --app app db upgrade
+    gunicorn -c gunicorn.conf.py app:app
+
+Settings come from the environment:
+
+  WEB_BIND                 address to listen on (default 0.0.0.0:5000)
+  WEB_WORKERS              worker processes (default: CPU count, at most 4)
+  WEB_THREADS              request threads per worker (default 8)
+  EVENTS_MAX_STREAMS       open /events streams per worker (default WEB_THREADS // 2,
+                           must be below WEB_THREADS)
+  WEB_GRACEFUL_TIMEOUT     seconds a worker gets to finish requests on SIGTERM (default 30)
+  DB_WAL_CHECKPOINT_INTERVAL
+                           seconds between background WAL checkpoints; 0 keeps
+                           SQLite's per-commit autocheckpoint instead (default 1)
+
+SQLite allows one writer at a time and any number of readers under WAL.
+Processes mainly add readers, so a few workers with several threads each
+suit this app. Within a worker, request threads hand their writes to one
+writer thread (writer.py) that commits them in batches, and read on
+separate query_only connections. Across workers, writers queue on the
+database lock: BEGIN IMMEDIATE with busy_timeout, plus retries. WAL checkpoints run
+on a background thread in one worker at a time, chosen by a flock. They
+no longer run inside whichever request's commit crosses the
+autocheckpoint threshold. The master runs no threads of its own, so a
+worker it forks can't inherit a held SQLite lock.
+
+An open /events stream occupies one of its worker's threads for as long
+as the client stays connected. Each worker therefore serves at most
+EVENTS_MAX_STREAMS streams and answers 503 past that (the web client
+falls back to refetching and retries). The remaining threads stay free
+for every other route. A client that goes away without closing its
+stream keeps the slot until a heartbeat write fails (up to about 30s).
+For S connected browser tabs across W workers, size WEB_THREADS to about
+2 * S / W: WEB_WORKERS=4 WEB_THREADS=64 keeps up to 128 streams open
+with 32 threads per worker left for ordinary requests.
+
+On SIGTERM each worker stops accepting connections and closes its
+/events streams so clients reconnect elsewhere. It then finishes
+in-flight requests, delivers every queued push notification and closes
+its connections. The master checkpoints and truncates the WAL last.
+
+bench/serve_bench.py compares this setup with the `python app.py` dev server.
+"""
+import os
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from db import Checkpointer, checkpoint
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', min(4, os.cpu_count() or 1)))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+events_max_streams = int(os.environ.get('EVENTS_MAX_STREAMS', threads // 2))
+if events_max_streams >= threads:
+    raise ValueError(f'EVENTS_MAX_STREAMS ({events_max_streams}) must be below WEB_THREADS ({threads}), '
+                     'or open /events streams can take every thread')
+os.environ['EVENTS_MAX_STREAMS'] = str(events_max_streams)
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+timeout = 60
+keepalive = 5
+
+# app.py opens a pooled connection at import; each worker must import it after the fork
+preload_app = False
+
+# Every request thread can hold a pooled connection, with room for the push dispatcher and the writer thread
+os.environ.setdefault('DB_POOL_SIZE', str(threads + 3))
+os.environ.setdefault('DB_READERS_POOL_SIZE', str(threads))
+
+checkpoint_interval = float(os.environ.get('DB_WAL_CHECKPOINT_INTERVAL', 1))
+if checkpoint_interval > 0:
+    os.environ.setdefault('DB_WAL_AUTOCHECKPOINT', '0')
+
+# Per-server scratch directory: the checkpoint lock, and the /events relay sockets (see events.EventRelay)
+runtime_dir = tempfile.mkdtemp(prefix='gocash-')
+if workers > 1:
+    os.environ.setdefault('EVENTS_RELAY_DIR', runtime_dir)
+
+
+def post_worker_init(worker):
+    import app
+
+    worker.checkpointer = None
+    if checkpoint_interval > 0:
+        worker.checkpointer = Checkpointer(app.DB_PATH, interval=checkpoint_interval,
+                                           lock_path=os.path.join(runtime_dir, 'checkpoint.lock'))
+        worker.checkpointer.start()
+
+    # Close /events streams as soon as SIGTERM arrives; otherwise they hold the worker for the whole grace period
+    handle_exit = worker.handle_exit
+
+    def drain(sig, frame):
+        app.broker.close()
+        handle_exit(sig, frame)
+    signal.signal(signal.SIGTERM, drain)
+
+
+def worker_exit(server, worker):
+    if getattr(worker, 'checkpointer', None) is not None:
+        worker.checkpointer.stop()
+    app = sys.modules.get('app')
+    if app is not None:
+        app.shutdown()
+
+
+def on_exit(server):
+    # Every worker is gone; fold the WAL back into the database and truncate it
+    conn = sqlite3.connect(os.environ.get('DB_PATH', 'payments.db'))
+    try:
+        conn.execute('PRAGMA busy_timeout = 5000')
+        busy, wal_frames, _ = checkpoint(conn, 'TRUNCATE')
+        server.log.info('Final WAL checkpoint: busy=%s frames=%s', busy, wal_frames)
+    finally:
+        conn.close()
+    shutil.rmtree(runtime_dir, ignore_errors=True)
@@ -0,0 +1,197 @@
+import functools
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, jsonify, make_response, request
+
+from db import get_db
+from writer import WriteTimeout
+
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyStore:
+    """Replays stored responses for requests that carry an `Idempotency-Key` header.
+
+    The first request with a key claims it in the `idempotency_keys` table
+    before the view runs; once the view returns, its response (anything
+    below 500) is stored against the key. A retry with the same key and
+    body gets that response back with `Idempotent-Replayed: true` and
+    never reaches the view, so balances are only touched once. Completed
+    responses are also kept in a bounded in-process LRU so retry storms
+    don't hit SQLite. Keys expire after `ttl` seconds; expired rows are
+    purged at most once per `purge_interval`.
+
+    Claims, stored responses and releases are written through `writes`
+    (writer.WriteQueue), so they are group-committed with the routes'
+    own intents instead of competing with the writer for the lock.
+    """
+
+    def __init__(self, writes, capacity=10000, ttl=86400.0, purge_interval=60.0):
+        self.writes = writes
+        self.capacity = capacity
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # (key, route) -> (request_hash, status_code, body, mimetype, expires_at)
+        self._last_purge = 0.0
+        self.cache_hits = 0
+        self.db_hits = 0
+        self.claims = 0
+        self.conflicts = 0
+        self.purged = 0
+
+    def idempotent(self, view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get('Idempotency-Key')
+            if key is None:
+                return view(*args, **kwargs)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                return jsonify({'error': f'Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters'}), 400
+
+            route = request.path
+            request_hash = hashlib.sha256(request.method.encode() + b' ' + request.get_data()).hexdigest()
+            try:
+                stored = self._cached(key, route) or self._claim(key, route, request_hash)
+            except WriteTimeout:
+                # Not claimed and the view never ran, so the client can simply retry
+                return jsonify({'error': 'Server busy, try again'}), 503
+            if stored is not None:
+                return self._replay(stored, request_hash)
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                if not g.get('write_outcome_unknown'):
+                    self._release(key, route)
+                raise
+            if response.status_code >= 500:
+                # Nothing was stored, so a retry may run the view again, unless the
+                # write may have committed after all (writer.OutcomeUnknown): then
+                # the claim stays and retries get 409 until the key expires
+                if not g.get('write_outcome_unknown'):
+                    self._release(key, route)
+            else:
+                self._complete(key, route, request_hash, response)
+            return response
+        return wrapper
+
+    # --- Lookup ---
+
+    def _cached(self, key, route):
+        with self._lock:
+            entry = self._cache.get((key, route))
+            if entry is None:
+                return None
+            if entry[4] <= time.time():
+                del self._cache[(key, route)]
+                return None
+            self._cache.move_to_end((key, route))
+            self.cache_hits += 1
+            return entry
+
+    def _claim(self, key, route, request_hash):
+        """Claim the key for this request, or return the row another request already holds.
+
+        The claim is committed (as a write intent) before the view runs; an
+        expired row with the same key is taken over in place.
+        """
+        now = time.time()
+        purge = self._purge_due(now)
+
+        def work(cursor):
+            purged = 0
+            if purge:
+                purged = cursor.execute('DELETE FROM idempotency_keys WHERE expires_at <= ?', (now,)).rowcount
+            cursor.execute('''
+                INSERT INTO idempotency_keys (key, route, request_hash, created_at, expires_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (key, route) DO UPDATE SET
+                    request_hash = excluded.request_hash,
+                    status_code = NULL,
+                    response_body = NULL,
+                    mimetype = NULL,
+                    created_at = excluded.created_at,
+                    expires_at = excluded.expires_at
+                WHERE idempotency_keys.expires_at <= excluded.created_at
+            ''', (key, route, request_hash, now, now + self.ttl))
+            if cursor.rowcount == 1:
+                return purged, None
+            cursor.execute('''
+                SELECT request_hash, status_code, response_body, mimetype, expires_at
+                FROM idempotency_keys WHERE key = ? AND route = ?
+            ''', (key, route))
+            return purged, cursor.fetchone()
+
+        purged, row = self.writes.run(work)
+        with self._lock:
+            self.purged += purged
+            if row is None:
+                self.claims += 1
+                return None
+            self.db_hits += 1
+            if row[1] is not None:
+                self._remember((key, route), row)
+        return row
+
+    def _replay(self, stored, request_hash):
+        stored_hash, status_code, body, mimetype, _ = stored
+        if stored_hash != request_hash:
+            with self._lock:
+                self.conflicts += 1
+            return jsonify({'error': 'Idempotency-Key was already used with a different request'}), 422
+        if status_code is None:
+            with self._lock:
+                self.conflicts += 1
+            return jsonify({'error': 'A request with this Idempotency-Key is still being processed'}), 409
+        response = make_response(body, status_code)
+        response.mimetype = mimetype
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    # --- Storage ---
+
+    def _complete(self, key, route, request_hash, response):
+        entry = (request_hash, response.status_code, response.get_data(), response.mimetype, time.time() + self.ttl)
+        self.writes.run(lambda cursor: cursor.execute('''
+            UPDATE idempotency_keys SET status_code = ?, response_body = ?, mimetype = ?, expires_at = ?
+            WHERE key = ? AND route = ?
+        ''', (*entry[1:], key, route)))
+        with self._lock:
+            self._remember((key, route), entry)
+
+    def _release(self, key, route):
+        # The view may have failed with a transaction open on the request's connection
+        get_db().rollback()
+        self.writes.run(lambda cursor: cursor.execute(
+            'DELETE FROM idempotency_keys WHERE key = ? AND route = ? AND status_code IS NULL', (key, route)))
+
+    def _remember(self, cache_key, entry):
+        # Caller holds self._lock
+        self._cache[cache_key] = tuple(entry)
+        self._cache.move_to_end(cache_key)
+        while len(self._cache) > self.capacity:
+            self._cache.popitem(last=False)
+
+    def _purge_due(self, now):
+        # Expired rows are deleted along with at most one claim per purge_interval
+        with self._lock:
+            if now - self._last_purge < self.purge_interval:
+                return False
+            self._last_purge = now
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                'cached': len(self._cache),
+                'capacity': self.capacity,
+                'cache_hits': self.cache_hits,
+                'db_hits': self.db_hits,
+                'claims': self.claims,
+                'conflicts': self.conflicts,
+                'purged': self.purged,
+            }
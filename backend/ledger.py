@@ -0,0 +1,161 @@
+import random
+import sqlite3
+import threading
+import time
+
+# Bounded retry for SQLITE_BUSY on top of the connection's busy_timeout
+BUSY_RETRIES = 5
+BUSY_BASE_DELAY = 0.02
+
+# One writer per process: threads queue here and are woken as soon as the lock
+# frees, instead of polling SQLite's lock through busy_timeout sleeps. Other
+# processes are still kept out by SQLite's own lock.
+WRITE_LOCK = threading.Lock()
+
+
+class LedgerError(Exception):
+    pass
+
+
+class InsufficientFunds(LedgerError):
+    pass
+
+
+class AccountNotFound(LedgerError):
+    pass
+
+
+def is_busy(error):
+    message = str(error).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def run_immediate(conn, work, retries=BUSY_RETRIES, base_delay=BUSY_BASE_DELAY):
+    """Run `work(cursor)` inside BEGIN IMMEDIATE and commit.
+
+    Taking the write lock up front means balance checks and the updates
+    that depend on them can't interleave with another writer; within a
+    process writers also take WRITE_LOCK first. SQLITE_BUSY is retried
+    with jittered exponential backoff, slept outside the lock. Any other
+    error (including LedgerError raised by `work`) rolls everything back
+    and propagates.
+    """
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(base_delay * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+        with WRITE_LOCK:
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+            except sqlite3.OperationalError as e:
+                if is_busy(e) and attempt < retries:
+                    continue
+                raise
+
+            try:
+                result = work(conn.cursor())
+                conn.commit()
+                return result
+            except sqlite3.OperationalError as e:
+                conn.rollback()
+                if is_busy(e) and attempt < retries:
+                    continue
+                raise
+            except Exception:
+                conn.rollback()
+                raise
+
+
+def move_funds(cursor, from_iban, to_iban, amount_cents, transaction_id, entry_type):
+    # Guarded debit: succeeds only if the balance still covers the amount at write time
+    cursor.execute('''
+        UPDATE bank_balances SET balance_cents = balance_cents - ?
+        WHERE iban = ? AND balance_cents >= ?
+    ''', (amount_cents, from_iban, amount_cents))
+    if cursor.rowcount == 0:
+        cursor.execute('SELECT 1 FROM bank_balances WHERE iban = ?', (from_iban,))
+        if cursor.fetchone() is None:
+            raise AccountNotFound(from_iban)
+        raise InsufficientFunds(from_iban)
+
+    cursor.execute('UPDATE bank_balances SET balance_cents = balance_cents + ? WHERE iban = ?', (amount_cents, to_iban))
+    if cursor.rowcount == 0:
+        raise AccountNotFound(to_iban)
+
+    cursor.executemany('''
+        INSERT INTO ledger_entries (transaction_id, iban, amount_cents, entry_type) VALUES (?, ?, ?, ?)
+    ''', [
+        (transaction_id, from_iban, -amount_cents, entry_type),
+        (transaction_id, to_iban, amount_cents, entry_type),
+    ])
+
+
+def pay_many(cursor, from_iban, payments, entry_type):
+    """Debit `from_iban` once for all `payments` [(to_iban, amount_cents, transaction_id), ...].
+
+    The debit is guarded on the combined total, credits are summed per
+    receiving account, and every payment still gets its own pair of
+    ledger entries.
+    """
+    total = sum(amount for _, amount, _ in payments)
+    cursor.execute('''
+        UPDATE bank_balances SET balance_cents = balance_cents - ?
+        WHERE iban = ? AND balance_cents >= ?
+    ''', (total, from_iban, total))
+    if cursor.rowcount == 0:
+        cursor.execute('SELECT 1 FROM bank_balances WHERE iban = ?', (from_iban,))
+        if cursor.fetchone() is None:
+            raise AccountNotFound(from_iban)
+        raise InsufficientFunds(from_iban)
+
+    credits = {}
+    for to_iban, amount, _ in payments:
+        credits[to_iban] = credits.get(to_iban, 0) + amount
+    for to_iban, amount in credits.items():
+        cursor.execute('UPDATE bank_balances SET balance_cents = balance_cents + ? WHERE iban = ?', (amount, to_iban))
+        if cursor.rowcount == 0:
+            raise AccountNotFound(to_iban)
+
+    cursor.executemany('''
+        INSERT INTO ledger_entries (transaction_id, iban, amount_cents, entry_type) VALUES (?, ?, ?, ?)
+    ''', [
+        entry
+        for to_iban, amount, transaction_id in payments
+        for entry in ((transaction_id, from_iban, -amount, entry_type), (transaction_id, to_iban, amount, entry_type))
+    ])
+
+
+def record_opening_balances(cursor):
+    # Accounts without any ledger history start from their current balance
+    cursor.execute('''
+        INSERT INTO ledger_entries (transaction_id, iban, amount_cents, entry_type)
+        SELECT NULL, b.iban, b.balance_cents, 'opening' FROM bank_balances b
+        WHERE NOT EXISTS (SELECT 1 FROM ledger_entries l WHERE l.iban = b.iban)
+    ''')
+
+
+def audit(conn):
+    # Accounts whose stored balance disagrees with the sum of their ledger entries
+    return conn.execute('''
+        SELECT b.iban, b.balance_cents, COALESCE(SUM(l.amount_cents), 0) AS ledger_cents
+        FROM bank_balances b
+        LEFT JOIN ledger_entries l ON l.iban = b.iban
+        GROUP BY b.iban
+        HAVING b.balance_cents != ledger_cents
+    ''').fetchall()
+
+
+def rebuild_balances(conn):
+    # Recompute every stored balance from the ledger; returns the number of accounts changed
+    def work(cursor):
+        cursor.execute('''
+            UPDATE bank_balances SET balance_cents = (
+                SELECT COALESCE(SUM(l.amount_cents), 0) FROM ledger_entries l
+                WHERE l.iban = bank_balances.iban
+            )
+            WHERE balance_cents != (
+                SELECT COALESCE(SUM(l.amount_cents), 0) FROM ledger_entries l
+                WHERE l.iban = bank_balances.iban
+            )
+        ''')
+        return cursor.rowcount
+    return run_immediate(conn, work)
@@ -0,0 +1,306 @@
+import bisect
+import random
+import re
+import sqlite3
+import threading
+import time
+import weakref
+
+from flask import g, request
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Statements that get no EXPLAIN QUERY PLAN when they are slow
+_NO_PLAN = ('BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA', 'ANALYZE', 'VACUUM', 'CREATE', 'DROP', 'ALTER')
+
+# Background threads whose statements are labelled with their own name; the rest are request threads
+BACKGROUND_THREADS = ('db-writer', 'push-dispatcher')
+
+_WHITESPACE = re.compile(r'\s+')
+_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+
+def normalize_sql(sql):
+    # One label per statement shape: collapse whitespace and (?, ?, ...) placeholder lists of any length
+    return _PLACEHOLDER_LIST.sub('(?, ...)', _WHITESPACE.sub(' ', sql).strip())
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    def __init__(self, name, help, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, label_values, seconds):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, seconds)] += 1
+        series[-1] += seconds
+
+    def render(self, lines):
+        lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} histogram')
+        for label_values, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_labels(self.label_names, label_values, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, label_values)} {series[-1]:.6f}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, label_values)} {cumulative}')
+
+
+class Counter:
+    def __init__(self, name, help, label_names):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self._values = {}
+
+    def inc(self, label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self, lines):
+        lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} counter')
+        for label_values, value in sorted(self._values.items()):
+            if isinstance(value, float):
+                value = f'{value:.6f}'
+            lines.append(f'{self.name}{_labels(self.label_names, label_values)} {value}')
+
+
+class Metrics:
+    """Request, SQLite and push timings, rendered in the Prometheus text format.
+
+    Every request's latency is recorded. A `sample_rate` fraction of SQL
+    statements and commits is timed, on any thread (the writer thread's
+    batches included), using the connection class from
+    `connection_factory()`; statements slower than `slow_query_ms` are
+    printed with their EXPLAIN QUERY PLAN. With `enabled=False` nothing is
+    hooked in and the pool uses plain sqlite3 connections.
+    """
+
+    def __init__(self, enabled=True, sample_rate=1.0, slow_query_ms=100.0, slow_log_interval=60.0):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.slow_query_seconds = slow_query_ms / 1000.0
+        self.slow_log_interval = slow_log_interval
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._slow_logged = {}  # statement -> monotonic time it was last printed
+
+        self.request_seconds = Histogram(
+            'http_request_duration_seconds', 'Time spent handling a request.', ('method', 'route'))
+        self.requests = Counter(
+            'http_requests_total', 'Requests handled, by response status.', ('method', 'route', 'status'))
+        self.query_seconds = Histogram(
+            'sqlite_query_duration_seconds', 'Time spent in sampled SQLite statements, including fetches.',
+            ('op', 'thread'))
+        self.statement_seconds = Counter(
+            'sqlite_statement_seconds_total', 'Time spent per sampled statement.', ('statement',))
+        self.statement_calls = Counter(
+            'sqlite_statement_calls_total', 'Executions per sampled statement.', ('statement',))
+        self.slow_queries = Counter(
+            'sqlite_slow_queries_total', 'Sampled statements slower than the slow query threshold.', ('op',))
+        self.push_seconds = Histogram(
+            'push_send_duration_seconds', 'Time spent posting one batch to the Expo push API.', ('result',))
+        self.push_messages = Counter(
+            'push_messages_total', 'Messages posted to the Expo push API.', ('result',))
+        self.sampled_statements = Counter(
+            'sqlite_sampled_statements_total', 'SQLite statements and commits that were timed.', ('thread',))
+
+    # --- Flask hooks ---
+
+    def init_app(self, app):
+        if not self.enabled:
+            return
+
+        @app.before_request
+        def start_request_timer():
+            g.metrics_started = time.perf_counter()
+
+        @app.after_request
+        def record_status(response):
+            g.metrics_status = response.status_code
+            return response
+
+        @app.teardown_request
+        def record_request(exc):
+            # Runs before the pooled connection is released, so pending statements can still be explained
+            started = g.pop('metrics_started', None)
+            for cursor in list(self._pending()):
+                cursor._finish()
+            if started is None:
+                return
+            elapsed = time.perf_counter() - started
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            status = g.pop('metrics_status', 500)
+            with self._lock:
+                self.request_seconds.observe((request.method, route), elapsed)
+                self.requests.inc((request.method, route, str(status)))
+
+    def connection_factory(self):
+        if not self.enabled:
+            return sqlite3.Connection
+        return type('TimedConnection', (TimedConnection,), {'metrics': self})
+
+    # --- Recording ---
+
+    def _sampled(self):
+        return random.random() < self.sample_rate
+
+    def _pending(self):
+        # This thread's cursors with a timed statement not yet recorded
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            pending = self._local.pending = weakref.WeakSet()
+        return pending
+
+    def observe_query(self, conn, sql, parameters, elapsed, many=False):
+        statement = normalize_sql(sql)
+        op = statement.split(' ', 1)[0].upper()
+        thread = threading.current_thread().name
+        thread = thread if thread in BACKGROUND_THREADS else 'request'
+        slow = elapsed >= self.slow_query_seconds
+        with self._lock:
+            self.sampled_statements.inc((thread,))
+            self.query_seconds.observe((op, thread), elapsed)
+            self.statement_seconds.inc((statement,), elapsed)
+            self.statement_calls.inc((statement,))
+            if slow:
+                self.slow_queries.inc((op,))
+                now = time.monotonic()
+                slow = now - self._slow_logged.get(statement, -self.slow_log_interval) >= self.slow_log_interval
+                if slow:
+                    self._slow_logged[statement] = now
+        if slow:
+            self._log_slow_query(conn, statement, sql, parameters, elapsed, many)
+
+    def _log_slow_query(self, conn, statement, sql, parameters, elapsed, many):
+        plan = ''
+        if not many and not statement.upper().startswith(_NO_PLAN):
+            try:
+                # Plain sqlite3 execute, so explaining doesn't get timed itself
+                rows = sqlite3.Connection.execute(conn, f'EXPLAIN QUERY PLAN {sql}', parameters).fetchall()
+                plan = ' | plan: ' + '; '.join(row[-1] for row in rows)
+            except sqlite3.Error as e:
+                plan = f' | plan unavailable: {e}'
+        print(f"Slow query ({elapsed * 1000:.1f} ms): {statement}{plan}")
+
+    def observe_push(self, elapsed, messages, ok):
+        if not self.enabled:
+            return
+        result = 'ok' if ok else 'error'
+        with self._lock:
+            self.push_seconds.observe((result,), elapsed)
+            self.push_messages.inc((result,), messages)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric in (self.request_seconds, self.requests, self.query_seconds, self.statement_seconds,
+                           self.statement_calls, self.slow_queries, self.push_seconds, self.push_messages,
+                           self.sampled_statements):
+                metric.render(lines)
+        return '\n'.join(lines) + '\n'
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that times each statement from execute() through its last fetch.
+
+    Only sampled statements are timed. One is recorded when the cursor runs
+    its next statement, is garbage collected, or the request ends, so time
+    spent stepping through rows is included. Cursors are tracked weakly so
+    their lifetime (and the statement reset that comes with freeing them)
+    is unchanged.
+    """
+
+    _sql = None
+
+    def _start(self, sql, parameters, many, run):
+        self._finish()
+        metrics = self.connection.metrics
+        if not metrics._sampled():
+            return run()
+        started = time.perf_counter()
+        try:
+            return run()
+        finally:
+            self._sql, self._parameters, self._many = sql, parameters, many
+            self._elapsed = time.perf_counter() - started
+            metrics._pending().add(self)
+
+    def _finish(self):
+        if self._sql is not None:
+            sql, self._sql = self._sql, None
+            self.connection.metrics.observe_query(self.connection, sql, self._parameters, self._elapsed, self._many)
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+    def _timed(self, fetch, *args):
+        if self._sql is None:
+            return fetch(*args)
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            self._elapsed += time.perf_counter() - started
+
+    def execute(self, sql, parameters=()):
+        return self._start(sql, parameters, False, lambda: super(TimedCursor, self).execute(sql, parameters))
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._start(sql, None, True, lambda: super(TimedCursor, self).executemany(sql, seq_of_parameters))
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self._timed(super().fetchmany)
+        return self._timed(super().fetchmany, size)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+
+class TimedConnection(sqlite3.Connection):
+    metrics = None  # Set on the subclass built by Metrics.connection_factory()
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute() builds a plain cursor internally, so route it through ours
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        if not self.in_transaction or not self.metrics._sampled():
+            return super().commit()
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.metrics.observe_query(self, 'COMMIT', (), time.perf_counter() - started)
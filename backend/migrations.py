@@ -0,0 +1,700 @@
+import json
+
+import ledger
+
+# Schema changes are numbered and applied in order; PRAGMA user_version records
+# the last one applied. Append new migrations to MIGRATIONS, never edit old ones.
+# Each migration spells out the SQL it ran instead of calling the feature
+# modules, so changing a module can't change what an old migration does on
+# a fresh database: a later schema change goes in a new migration.
+
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+
+def _base_schema(cursor):
+    # Users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT NOT NULL UNIQUE,
+            phone TEXT NOT NULL,
+            iban TEXT NOT NULL UNIQUE
+        )
+    ''')
+
+    # Bank balances (in integer cents)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bank_balances (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            iban TEXT UNIQUE,
+            balance_cents INTEGER DEFAULT 0,
+            FOREIGN KEY (iban) REFERENCES users (iban)
+        )
+    ''')
+
+    # Push tokens
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS push_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE,
+            push_token TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Pending requests (amount in cents)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            requester_id INTEGER NOT NULL,
+            payer_id INTEGER NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            status TEXT DEFAULT 'pending', -- 'pending', 'approved', 'denied'
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (requester_id) REFERENCES users (id),
+            FOREIGN KEY (payer_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Groups; member_ids is the legacy JSON membership list (see group_members)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            creator_id INTEGER NOT NULL,
+            member_ids TEXT NOT NULL, -- Stored as JSON string: [id1, id2, ...]
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (creator_id) REFERENCES users (id)
+        )
+    ''')
+
+    # Transactions
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,
+            initiator_id INTEGER NOT NULL,
+            target_id INTEGER,
+            amount_cents INTEGER,
+            status TEXT DEFAULT 'pending',
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            memo TEXT,
+            request_ref INTEGER,
+            FOREIGN KEY (initiator_id) REFERENCES users (id),
+            FOREIGN KEY (target_id) REFERENCES users (id),
+            FOREIGN KEY (request_ref) REFERENCES pending_requests (id)
+        )
+    ''')
+
+
+def _push_outbox(cursor):
+    # Push notification outbox, drained by the background dispatcher
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS push_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            token TEXT NOT NULL,
+            title TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT DEFAULT 'queued', -- 'queued', 'sending', 'failed'
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            created_at REAL NOT NULL,
+            last_error TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_push_outbox_due ON push_outbox (status, next_attempt_at)')
+
+
+def _transaction_history_indexes(cursor):
+    # History lookups walk these newest-first per user (see get_transactions)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_initiator_ts ON transactions (initiator_id, timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_target_ts ON transactions (target_id, timestamp)')
+
+
+def _group_members(cursor):
+    # Group memberships, one row per (group, user) including the creator
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_members (
+            group_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (group_id, user_id),
+            FOREIGN KEY (group_id) REFERENCES groups (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members (user_id, group_id)')
+
+    # Migrate groups that only have the legacy member_ids JSON column
+    cursor.execute('''
+        INSERT OR IGNORE INTO group_members (group_id, user_id)
+        SELECT g.id, json_each.value FROM groups g, json_each(g.member_ids)
+        WHERE json_valid(g.member_ids)
+          AND g.id NOT IN (SELECT group_id FROM group_members)
+        UNION
+        SELECT g.id, g.creator_id FROM groups g
+        WHERE g.id NOT IN (SELECT group_id FROM group_members)
+    ''')
+
+
+def _ledger(cursor):
+    # Double-entry ledger backing every balance change; existing accounts get an opening entry
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            transaction_id INTEGER,
+            iban TEXT NOT NULL,
+            amount_cents INTEGER NOT NULL, -- signed: negative debits, positive credits
+            entry_type TEXT NOT NULL,      -- 'opening', 'transfer', 'request'
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (transaction_id) REFERENCES transactions (id),
+            FOREIGN KEY (iban) REFERENCES bank_balances (iban)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ledger_entries_iban ON ledger_entries (iban, id)')
+    cursor.execute('''
+        INSERT INTO ledger_entries (transaction_id, iban, amount_cents, entry_type)
+        SELECT NULL, b.iban, b.balance_cents, 'opening' FROM bank_balances b
+        WHERE NOT EXISTS (SELECT 1 FROM ledger_entries l WHERE l.iban = b.iban)
+    ''')
+
+
+def _pending_inbox(cursor):
+    # Pending rows per payer, newest first, without touching resolved history
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pending_requests_payer_pending
+        ON pending_requests (payer_id, id) WHERE status = 'pending'
+    ''')
+
+    # Home screen badge: one row per payer, kept current by the triggers below
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_summary (
+            user_id INTEGER PRIMARY KEY,
+            pending_count INTEGER NOT NULL DEFAULT 0,
+            pending_total_cents INTEGER NOT NULL DEFAULT 0,
+            last_request_id INTEGER NOT NULL DEFAULT 0, -- newest request ever addressed to this user
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO pending_summary (user_id, pending_count, pending_total_cents, last_request_id)
+        SELECT payer_id,
+               SUM(status = 'pending'),
+               COALESCE(SUM(CASE WHEN status = 'pending' THEN amount_cents END), 0),
+               MAX(id)
+        FROM pending_requests
+        GROUP BY payer_id
+    ''')
+
+    # Triggers run inside whichever transaction changes pending_requests, so the
+    # summary can't drift from the rows it counts
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS pending_summary_insert AFTER INSERT ON pending_requests
+        BEGIN
+            INSERT INTO pending_summary (user_id, pending_count, pending_total_cents, last_request_id)
+            VALUES (NEW.payer_id,
+                    NEW.status = 'pending',
+                    CASE WHEN NEW.status = 'pending' THEN NEW.amount_cents ELSE 0 END,
+                    NEW.id)
+            ON CONFLICT (user_id) DO UPDATE SET
+                pending_count = pending_count + excluded.pending_count,
+                pending_total_cents = pending_total_cents + excluded.pending_total_cents,
+                last_request_id = MAX(last_request_id, excluded.last_request_id);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS pending_summary_update
+        AFTER UPDATE OF status, amount_cents, payer_id ON pending_requests
+        WHEN OLD.status = 'pending' OR NEW.status = 'pending'
+        BEGIN
+            UPDATE pending_summary SET
+                pending_count = pending_count - 1,
+                pending_total_cents = pending_total_cents - OLD.amount_cents
+            WHERE user_id = OLD.payer_id AND OLD.status = 'pending';
+            INSERT INTO pending_summary (user_id, pending_count, pending_total_cents, last_request_id)
+            SELECT NEW.payer_id, 1, NEW.amount_cents, NEW.id WHERE NEW.status = 'pending'
+            ON CONFLICT (user_id) DO UPDATE SET
+                pending_count = pending_count + 1,
+                pending_total_cents = pending_total_cents + excluded.pending_total_cents;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS pending_summary_delete AFTER DELETE ON pending_requests
+        WHEN OLD.status = 'pending'
+        BEGIN
+            UPDATE pending_summary SET
+                pending_count = pending_count - 1,
+                pending_total_cents = pending_total_cents - OLD.amount_cents
+            WHERE user_id = OLD.payer_id;
+        END
+    ''')
+
+
+def _idempotency(cursor):
+    # Stored responses for Idempotency-Key retries, purged by expires_at
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT NOT NULL,
+            route TEXT NOT NULL,           -- request path the key was used on
+            request_hash TEXT NOT NULL,
+            status_code INTEGER,           -- NULL while the first request is still running
+            response_body BLOB,
+            mimetype TEXT,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (key, route)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at)')
+
+    # Duplicate checks in request_money and splits.existing_pending only look at pending rows
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pending_requests_requester_pending
+        ON pending_requests (requester_id, payer_id, amount_cents) WHERE status = 'pending'
+    ''')
+
+
+def _monthly_statements(cursor):
+    # Per-user monthly totals for /statements, maintained by triggers on transactions.
+    # Kinds are from the user's point of view (see statements.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS monthly_statements (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,            -- 'YYYY-MM' of the transaction timestamp (UTC)
+            kind TEXT NOT NULL,
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            total_cents INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month, kind),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+
+    # Each trigger adds (NEW) or removes (OLD) a completed row's contribution, one upsert per side
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS monthly_statements_insert AFTER INSERT ON transactions
+        WHEN NEW.status = 'completed'
+        BEGIN
+            INSERT INTO monthly_statements (user_id, month, kind, tx_count, total_cents)
+            SELECT NEW.initiator_id, substr(NEW.timestamp, 1, 7), kind, 1, 1 * COALESCE(NEW.amount_cents, 0)
+            FROM (SELECT CASE NEW.type WHEN 'transfer' THEN 'transfer_out'
+                                       WHEN 'request_sent' THEN 'request_in'
+                                       WHEN 'split_sent' THEN 'split_created' END AS kind)
+            WHERE NEW.initiator_id IS NOT NULL AND kind IS NOT NULL AND NEW.status = 'completed'
+            ON CONFLICT (user_id, month, kind) DO UPDATE SET
+                tx_count = tx_count + excluded.tx_count,
+                total_cents = total_cents + excluded.total_cents;
+            INSERT INTO monthly_statements (user_id, month, kind, tx_count, total_cents)
+            SELECT NEW.target_id, substr(NEW.timestamp, 1, 7), kind, 1, 1 * COALESCE(NEW.amount_cents, 0)
+            FROM (SELECT CASE NEW.type WHEN 'transfer' THEN 'transfer_in'
+                                       WHEN 'request_sent' THEN 'request_out' END AS kind)
+            WHERE NEW.target_id IS NOT NULL AND kind IS NOT NULL AND NEW.status = 'completed'
+            ON CONFLICT (user_id, month, kind) DO UPDATE SET
+                tx_count = tx_count + excluded.tx_count,
+                total_cents = total_cents + excluded.total_cents;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS monthly_statements_update
+        AFTER UPDATE OF status, type, initiator_id, target_id, amount_cents, timestamp ON transactions
+        WHEN OLD.status = 'completed' OR NEW.status = 'completed'
+        BEGIN
+            INSERT INTO monthly_statements (user_id, month, kind, tx_count, total_cents)
+            SELECT OLD.initiator_id, substr(OLD.timestamp, 1, 7), kind, -1, -1 * COALESCE(OLD.amount_cents, 0)
+            FROM (SELECT CASE OLD.type WHEN 'transfer' THEN 'transfer_out'
+                                       WHEN 'request_sent' THEN 'request_in'
+                                       WHEN 'split_sent' THEN 'split_created' END AS kind)
+            WHERE OLD.initiator_id IS NOT NULL AND kind IS NOT NULL AND OLD.status = 'completed'
+            ON CONFLICT (user_id, month, kind) DO UPDATE SET
+                tx_count = tx_count + excluded.tx_count,
+                total_cents = total_cents + excluded.total_cents;
+            INSERT INTO monthly_statements (user_id, month, kind, tx_count, total_cents)
+            SELECT OLD.target_id, substr(OLD.timestamp, 1, 7), kind, -1, -1 * COALESCE(OLD.amount_cents, 0)
+            FROM (SELECT CASE OLD.type WHEN 'transfer' THEN 'transfer_in'
+                                       WHEN 'request_sent' THEN 'request_out' END AS kind)
+            WHERE OLD.target_id IS NOT NULL AND kind IS NOT NULL AND OLD.status = 'completed'
+            ON CONFLICT (user_id, month, kind) DO UPDATE SET
+                tx_count = tx_count + excluded.tx_count,
+                total_cents = total_cents + excluded.total_cents;
+            INSERT INTO monthly_statements (user_id, month, kind, tx_count, total_cents)
+            SELECT NEW.initiator_id, substr(NEW.timestamp, 1, 7), kind, 1, 1 * COALESCE(NEW.amount_cents, 0)
+            FROM (SELECT CASE NEW.type WHEN 'transfer' THEN 'transfer_out'
+                                       WHEN 'request_sent' THEN 'request_in'
+                                       WHEN 'split_sent' THEN 'split_created' END AS kind)
+            WHERE NEW.initiator_id IS NOT NULL AND kind IS NOT NULL AND NEW.status = 'completed'
+            ON CONFLICT (user_id, month, kind) DO UPDATE SET
+                tx_count = tx_count + excluded.tx_count,
+                total_cents = total_cents + excluded.total_cents;
+            INSERT INTO monthly_statements (user_id, month, kind, tx_count, total_cents)
+            SELECT NEW.target_id, substr(NEW.timestamp, 1, 7), kind, 1, 1 * COALESCE(NEW.amount_cents, 0)
+            FROM (SELECT CASE NEW.type WHEN 'transfer' THEN 'transfer_in'
+                                       WHEN 'request_sent' THEN 'request_out' END AS kind)
+            WHERE NEW.target_id IS NOT NULL AND kind IS NOT NULL AND NEW.status = 'completed'
+            ON CONFLICT (user_id, month, kind) DO UPDATE SET
+                tx_count = tx_count + excluded.tx_count,
+                total_cents = total_cents + excluded.total_cents;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS monthly_statements_delete AFTER DELETE ON transactions
+        WHEN OLD.status = 'completed'
+        BEGIN
+            INSERT INTO monthly_statements (user_id, month, kind, tx_count, total_cents)
+            SELECT OLD.initiator_id, substr(OLD.timestamp, 1, 7), kind, -1, -1 * COALESCE(OLD.amount_cents, 0)
+            FROM (SELECT CASE OLD.type WHEN 'transfer' THEN 'transfer_out'
+                                       WHEN 'request_sent' THEN 'request_in'
+                                       WHEN 'split_sent' THEN 'split_created' END AS kind)
+            WHERE OLD.initiator_id IS NOT NULL AND kind IS NOT NULL AND OLD.status = 'completed'
+            ON CONFLICT (user_id, month, kind) DO UPDATE SET
+                tx_count = tx_count + excluded.tx_count,
+                total_cents = total_cents + excluded.total_cents;
+            INSERT INTO monthly_statements (user_id, month, kind, tx_count, total_cents)
+            SELECT OLD.target_id, substr(OLD.timestamp, 1, 7), kind, -1, -1 * COALESCE(OLD.amount_cents, 0)
+            FROM (SELECT CASE OLD.type WHEN 'transfer' THEN 'transfer_in'
+                                       WHEN 'request_sent' THEN 'request_out' END AS kind)
+            WHERE OLD.target_id IS NOT NULL AND kind IS NOT NULL AND OLD.status = 'completed'
+            ON CONFLICT (user_id, month, kind) DO UPDATE SET
+                tx_count = tx_count + excluded.tx_count,
+                total_cents = total_cents + excluded.total_cents;
+        END
+    ''')
+
+    # Existing history
+    cursor.execute('DELETE FROM monthly_statements')
+    cursor.execute('''
+        INSERT INTO monthly_statements (user_id, month, kind, tx_count, total_cents)
+        SELECT user_id, month, kind, COUNT(*), SUM(COALESCE(amount_cents, 0)) FROM (
+            SELECT t.initiator_id AS user_id, substr(t.timestamp, 1, 7) AS month,
+                   CASE t.type WHEN 'transfer' THEN 'transfer_out'
+                               WHEN 'request_sent' THEN 'request_in'
+                               WHEN 'split_sent' THEN 'split_created' END AS kind,
+                   t.amount_cents
+            FROM transactions t WHERE t.status = 'completed'
+            UNION ALL
+            SELECT t.target_id, substr(t.timestamp, 1, 7),
+                   CASE t.type WHEN 'transfer' THEN 'transfer_in'
+                               WHEN 'request_sent' THEN 'request_out' END,
+                   t.amount_cents
+            FROM transactions t WHERE t.status = 'completed'
+        )
+        WHERE user_id IS NOT NULL AND kind IS NOT NULL
+        GROUP BY user_id, month, kind
+    ''')
+
+
+def _group_settlements(cursor):
+    # Requests and transfers tied to a group, netted by settle.py; 'settled' joins the request statuses
+    cursor.execute('ALTER TABLE pending_requests ADD COLUMN group_id INTEGER REFERENCES groups (id)')
+    cursor.execute('ALTER TABLE transactions ADD COLUMN group_id INTEGER REFERENCES groups (id)')
+    # Group transfers with an id above this were made since the last settle-up
+    cursor.execute('ALTER TABLE groups ADD COLUMN settled_through_tx INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pending_requests_group_pending
+        ON pending_requests (group_id) WHERE status = 'pending' AND group_id IS NOT NULL
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_group
+        ON transactions (group_id, id) WHERE group_id IS NOT NULL
+    ''')
+
+
+def _user_search(cursor):
+    # FTS5 contact search over users and the per-user contacts rollup that ranks it (see search.py).
+    # Names are folded (Kovač -> kovac) when indexed and queried; prefix indexes cover typing
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+            name,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '1 2 3 4 5 6 7 8'
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO users_fts (rowid, name) VALUES (NEW.id, NEW.name);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF name ON users
+        BEGIN
+            DELETE FROM users_fts WHERE rowid = OLD.id;
+            INSERT INTO users_fts (rowid, name) VALUES (NEW.id, NEW.name);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users
+        BEGIN
+            DELETE FROM users_fts WHERE rowid = OLD.id;
+        END
+    ''')
+    cursor.execute('DELETE FROM users_fts')
+    cursor.execute('INSERT INTO users_fts (rowid, name) SELECT id, name FROM users')
+
+    # Phone numbers as international digits ("+386 40 123 456", "00386 40..." and "040..." -> 38640123456);
+    # search.py spells out the same expression so its queries use this index
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_phone_key ON users (CASE WHEN replace(replace(replace(replace(replace(replace(replace(phone, ' ', ''), '+', ''), '-', ''), '(', ''), ')', ''), '.', ''), '/', '') LIKE '00%' THEN substr(replace(replace(replace(replace(replace(replace(replace(phone, ' ', ''), '+', ''), '-', ''), '(', ''), ')', ''), '.', ''), '/', ''), 3) WHEN replace(replace(replace(replace(replace(replace(replace(phone, ' ', ''), '+', ''), '-', ''), '(', ''), ')', ''), '.', ''), '/', '') LIKE '0%' THEN '386' || substr(replace(replace(replace(replace(replace(replace(replace(phone, ' ', ''), '+', ''), '-', ''), '(', ''), ')', ''), '.', ''), '/', ''), 2) ELSE replace(replace(replace(replace(replace(replace(replace(phone, ' ', ''), '+', ''), '-', ''), '(', ''), ')', ''), '.', ''), '/', '') END)
+    ''')
+
+    # Who each user has sent money to, requested from or been paid by, most recent first
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_contacts (
+            user_id INTEGER NOT NULL,
+            contact_id INTEGER NOT NULL,
+            last_interaction TIMESTAMP NOT NULL,
+            interactions INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, contact_id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (contact_id) REFERENCES users (id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_contacts_recent ON user_contacts (user_id, last_interaction)')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS user_contacts_insert AFTER INSERT ON transactions
+        WHEN NEW.target_id IS NOT NULL AND NEW.target_id != NEW.initiator_id
+        BEGIN
+            INSERT INTO user_contacts (user_id, contact_id, last_interaction, interactions)
+            VALUES (NEW.initiator_id, NEW.target_id, NEW.timestamp, 1), (NEW.target_id, NEW.initiator_id, NEW.timestamp, 1)
+            ON CONFLICT (user_id, contact_id) DO UPDATE SET
+                last_interaction = MAX(last_interaction, excluded.last_interaction),
+                interactions = interactions + 1;
+        END
+    ''')
+    cursor.execute('DELETE FROM user_contacts')
+    cursor.execute('''
+        INSERT INTO user_contacts (user_id, contact_id, last_interaction, interactions)
+        SELECT user_id, contact_id, MAX(timestamp), COUNT(*) FROM (
+            SELECT initiator_id AS user_id, target_id AS contact_id, timestamp FROM transactions
+            WHERE target_id IS NOT NULL AND target_id != initiator_id
+            UNION ALL
+            SELECT target_id, initiator_id, timestamp FROM transactions
+            WHERE target_id IS NOT NULL AND target_id != initiator_id
+        )
+        GROUP BY user_id, contact_id
+    ''')
+
+
+def _qr_redemptions(cursor):
+    # Nonces of redeemed QR payment codes, kept until the code expires (see qr.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS qr_redemptions (
+            nonce BLOB PRIMARY KEY,
+            requester_id INTEGER NOT NULL,
+            payer_id INTEGER NOT NULL,
+            amount_cents INTEGER NOT NULL,
+            transaction_id INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,   -- the token's expiry; the row is not needed after it
+            redeemed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (transaction_id) REFERENCES transactions (id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_qr_redemptions_expires ON qr_redemptions (expires_at)')
+
+
+def _transaction_archives(cursor):
+    # Registry of per-month archive files of old transactions (see archive.py); `oldest` and
+    # `newest` bound each file's timestamps, so a reader can tell which months a page reaches
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS transaction_archives (
+            month TEXT PRIMARY KEY,        -- 'YYYY-MM' of the archived rows' timestamps
+            filename TEXT NOT NULL,        -- in the archive directory
+            row_count INTEGER NOT NULL DEFAULT 0,
+            oldest TIMESTAMP NOT NULL,
+            newest TIMESTAMP NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+    # Approving or denying a request flips its pending request_sent row
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_request_ref_pending
+        ON transactions (request_ref) WHERE status = 'pending'
+    ''')
+
+    # Deleting a completed row of an archived month is archiving it, not undoing the
+    # transaction, so the statements delete trigger leaves that month alone
+    cursor.execute('DROP TRIGGER IF EXISTS monthly_statements_delete')
+    cursor.execute('''
+        CREATE TRIGGER monthly_statements_delete AFTER DELETE ON transactions
+        WHEN OLD.status = 'completed'
+             AND substr(OLD.timestamp, 1, 7) NOT IN (SELECT month FROM transaction_archives)
+        BEGIN
+            INSERT INTO monthly_statements (user_id, month, kind, tx_count, total_cents)
+            SELECT OLD.initiator_id, substr(OLD.timestamp, 1, 7), kind, -1, -1 * COALESCE(OLD.amount_cents, 0)
+            FROM (SELECT CASE OLD.type WHEN 'transfer' THEN 'transfer_out'
+                                       WHEN 'request_sent' THEN 'request_in'
+                                       WHEN 'split_sent' THEN 'split_created' END AS kind)
+            WHERE OLD.initiator_id IS NOT NULL AND kind IS NOT NULL AND OLD.status = 'completed'
+            ON CONFLICT (user_id, month, kind) DO UPDATE SET
+                tx_count = tx_count + excluded.tx_count,
+                total_cents = total_cents + excluded.total_cents;
+            INSERT INTO monthly_statements (user_id, month, kind, tx_count, total_cents)
+            SELECT OLD.target_id, substr(OLD.timestamp, 1, 7), kind, -1, -1 * COALESCE(OLD.amount_cents, 0)
+            FROM (SELECT CASE OLD.type WHEN 'transfer' THEN 'transfer_in'
+                                       WHEN 'request_sent' THEN 'request_out' END AS kind)
+            WHERE OLD.target_id IS NOT NULL AND kind IS NOT NULL AND OLD.status = 'completed'
+            ON CONFLICT (user_id, month, kind) DO UPDATE SET
+                tx_count = tx_count + excluded.tx_count,
+                total_cents = total_cents + excluded.total_cents;
+        END
+    ''')
+
+
+def _reconciliation(cursor):
+    # Checkpoint of the balance reconciliation job (see reconcile.py): net cents per user over
+    # every completed row up to through_id, and the rows at or below it that were still pending
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reconcile_flows (
+            user_id INTEGER PRIMARY KEY,
+            net_cents INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reconcile_open (
+            transaction_id INTEGER PRIMARY KEY
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reconcile_checkpoint (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            through_id INTEGER NOT NULL,    -- every row with a lower or equal id is in reconcile_flows
+            mismatches INTEGER NOT NULL,
+            finished_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+MIGRATIONS = [
+    (1, 'base schema', _base_schema),
+    (2, 'push notification outbox', _push_outbox),
+    (3, 'transaction history indexes', _transaction_history_indexes),
+    (4, 'group_members table', _group_members),
+    (5, 'ledger entries', _ledger),
+    (6, 'pending request inbox summary', _pending_inbox),
+    (7, 'idempotency keys and request dedup index', _idempotency),
+    (8, 'monthly statements rollup', _monthly_statements),
+    (9, 'group ids on requests and transactions', _group_settlements),
+    (10, 'user search index and contacts', _user_search),
+    (11, 'qr payment redemptions', _qr_redemptions),
+    (12, 'transaction archives and request_ref index', _transaction_archives),
+    (13, 'reconciliation checkpoint', _reconciliation),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def upgrade(conn, log=print):
+    """Apply every pending migration, each in its own immediate transaction.
+
+    The version is re-read after taking the write lock, so several processes
+    running this at once apply each migration exactly once.
+    """
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        if current_version(conn) >= version:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if current_version(conn) >= version:
+                conn.rollback()
+                continue
+            migrate(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        log(f"Applied migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+def check(conn):
+    version = current_version(conn)
+    if version < SCHEMA_VERSION:
+        raise SchemaOutOfDate(
+            f'Database schema is at version {version}, expected {SCHEMA_VERSION}. '
+            'Run `flask --app app db upgrade`.'
+        )
+    return version
+
+
+# --- Demo seed data ---
+
+SEED_USERS = [
+    ("Ana Novak", "ana.novak@gmail.com", "+386 40 123 456", "SI56123456780000123"),
+    ("Marko Kovač", "marko.kovac@yahoo.com", "+386 31 987 654", "SI56123456780000234"),
+    ("Petra Zupan", "petra.zupan@outlook.com", "+386 41 555 111", "SI56123456780000345"),
+    ("Tomaž Horvat", "tomaz.horvat@gmail.com", "+386 40 222 333", "SI56123456780000456"),
+    ("Nina Mlakar", "nina.mlakar@hotmail.com", "+386 31 444 555", "SI56123456780000567"),
+    ("Luka Kralj", "luka.kralj@gmail.com", "+386 40 666 777", "SI56123456780000678"),
+    ("Maja Rozman", "maja.rozman@yahoo.com", "+386 41 888 999", "SI56123456780000789"),
+    ("Jan Potočnik", "jan.potocnik@gmail.com", "+386 31 123 789", "SI56123456780000890"),
+    ("Sara Bizjak", "sara.bizjak@gmail.com", "+386 40 234 567", "SI56123456780000901"),
+    ("Žan Kastelic", "zan.kastelic@outlook.com", "+386 41 345 678", "SI56123456780001012"),
+    ("Katarina Koren", "katarina.koren@gmail.com", "+386 31 456 789", "SI56123456780001123"),
+    ("Miha Medved", "miha.medved@yahoo.com", "+386 40 567 890", "SI56123456780001234"),
+    ("Tjaša Vidmar", "tjasa.vidmar@gmail.com", "+386 31 678 901", "SI56123456780001345"),
+    ("Rok Zajc", "rok.zajc@gmail.com", "+386 41 789 012", "SI56123456780001456"),
+    ("Eva Kos", "eva.kos@hotmail.com", "+386 40 890 123", "SI56123456780001567"),
+    ("Nejc Kosi", "nejc.kosi@gmail.com", "+386 31 901 234", "SI56123456780001678"),
+    ("Tina Lesjak", "tina.lesjak@yahoo.com", "+386 40 012 345", "SI56123456780001789"),
+    ("Gregor Hrovat", "gregor.hrovat@gmail.com", "+386 41 111 222", "SI56123456780001890"),
+    ("Barbara Turk", "barbara.turk@outlook.com", "+386 31 222 333", "SI56123456780001901"),
+    ("David Dolinar", "david.dolinar@gmail.com", "+386 40 333 444", "SI56123456780002012"),
+]
+
+# Initial balance 100 EUR = 10000 cents
+SEED_BALANCE_CENTS = 10000
+
+
+def seed(conn, log=print):
+    """Insert the demo users, balances, request and group. Safe to run repeatedly."""
+    def work(cursor):
+        cursor.executemany('''
+            INSERT OR IGNORE INTO users (name, email, phone, iban) VALUES (?, ?, ?, ?)
+        ''', SEED_USERS)
+        users_added = cursor.rowcount
+        cursor.executemany('''
+            INSERT OR IGNORE INTO bank_balances (iban, balance_cents) VALUES (?, ?)
+        ''', [(iban, SEED_BALANCE_CENTS) for _, _, _, iban in SEED_USERS])
+        ledger.record_opening_balances(cursor)
+
+        # Demo request and group only go into an otherwise empty database
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM pending_requests), EXISTS (SELECT 1 FROM groups)')
+        has_requests, has_groups = cursor.fetchone()
+        ids = dict(cursor.execute('SELECT email, id FROM users').fetchall())
+        ana, marko, petra = (ids[SEED_USERS[i][1]] for i in range(3))
+
+        if not has_requests:
+            # Marko requests 5.00 from Ana
+            cursor.execute('''
+                INSERT INTO pending_requests (requester_id, payer_id, amount_cents, status)
+                VALUES (?, ?, ?, 'pending')
+            ''', (marko, ana, 500))
+            cursor.execute('''
+                INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, request_ref)
+                VALUES ('request_sent', ?, ?, ?, 'pending', ?)
+            ''', (marko, ana, 500, cursor.lastrowid))
+
+        if not has_groups:
+            # Ana's "Dinner Crew" with Marko and Petra
+            cursor.execute('''
+                INSERT INTO groups (name, creator_id, member_ids)
+                VALUES (?, ?, ?)
+            ''', ("Dinner Crew", ana, json.dumps([marko, petra])))
+            group_id = cursor.lastrowid
+            cursor.executemany('''
+                INSERT INTO group_members (group_id, user_id) VALUES (?, ?)
+            ''', [(group_id, member_id) for member_id in (ana, marko, petra)])
+
+        return users_added
+
+    added = ledger.run_immediate(conn, work)
+    log(f"Seed complete: {added} new users.")
+    return added
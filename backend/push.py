@@ -0,0 +1,282 @@
+import random
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import ledger
+
+# Expo accepts at most 100 messages per push request
+MAX_BATCH_SIZE = 100
+
+
+class PushDispatcher:
+    """Sends queued push notifications from the `push_outbox` table.
+
+    Routes only insert outbox rows inside their own transaction and call
+    `wake()` after committing; a background thread claims due rows, posts
+    them to Expo in batches on a keep-alive session and retries failures
+    with exponential backoff. Its own writes go through
+    ledger.run_immediate, so they take ledger.WRITE_LOCK like the writer
+    thread instead of waiting on SQLite's lock.
+    """
+
+    def __init__(self, pool, url, batch_size=MAX_BATCH_SIZE, max_attempts=5,
+                 base_delay=1.0, max_delay=300.0, lease_seconds=30.0, timeout=5.0, metrics=None):
+        self.pool = pool
+        self.url = url
+        self.metrics = metrics
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease_seconds = lease_seconds
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+            'Content-Type': 'application/json',
+        })
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=4))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=4))
+
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        self.send_seconds = 0.0
+        self.delivery_latency_total = 0.0
+        self.delivery_latency_max = 0.0
+        self.delivery_count = 0
+
+    # --- Producer side (called from routes) ---
+
+    def enqueue(self, cursor, user_id, title, body):
+        # Resolve the token in the caller's transaction; users without a token are skipped
+        now = time.time()
+        cursor.execute('''
+            INSERT INTO push_outbox (user_id, token, title, body, next_attempt_at, created_at)
+            SELECT user_id, push_token, ?, ?, ?, ? FROM push_tokens
+            WHERE user_id = ? AND push_token IS NOT NULL AND push_token != ''
+        ''', (title, body, now, now, user_id))
+        if cursor.rowcount == 0:
+            print(f"No push token available for user {user_id}.")
+
+    def enqueue_many(self, cursor, notifications):
+        # Bulk form of enqueue() for [(user_id, title, body), ...]
+        now = time.time()
+        cursor.executemany('''
+            INSERT INTO push_outbox (user_id, token, title, body, next_attempt_at, created_at)
+            SELECT user_id, push_token, ?, ?, ?, ? FROM push_tokens
+            WHERE user_id = ? AND push_token IS NOT NULL AND push_token != ''
+        ''', [(title, body, now, now, user_id) for user_id, title, body in notifications])
+
+    def wake(self):
+        self._wakeup.set()
+
+    # --- Worker lifecycle ---
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='push-dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, drain=True, timeout=10.0):
+        # Optionally flush whatever is already due before the thread exits
+        if drain:
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline and self.flush_once() > 0:
+                pass
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            # Clear before flushing so a wake() during the flush is not lost
+            self._wakeup.clear()
+            try:
+                sent = self.flush_once()
+            except Exception as e:
+                print(f"Push dispatcher error: {e}")
+                sent = 0
+            if sent == 0:
+                try:
+                    timeout = self._idle_wait()
+                except sqlite3.Error as e:
+                    print(f"Push dispatcher error: {e}")
+                    timeout = 5.0
+                self._wakeup.wait(timeout)
+
+    def _idle_wait(self):
+        # Sleep until the next retry is due, but never longer than a few seconds
+        conn = self.pool.acquire()
+        try:
+            row = conn.execute('''
+                SELECT MIN(next_attempt_at) FROM push_outbox WHERE status != 'failed'
+            ''').fetchone()
+        finally:
+            self.pool.release(conn)
+        if row[0] is None:
+            return 5.0
+        return max(0.05, min(5.0, row[0] - time.time()))
+
+    # --- Sending ---
+
+    def _claim(self, conn):
+        # Lease a batch so concurrent dispatchers (other workers) skip it
+        now = time.time()
+
+        def work(cursor):
+            cursor.execute('''
+                SELECT id, token, title, body, attempts, created_at FROM push_outbox
+                WHERE status IN ('queued', 'sending') AND next_attempt_at <= ?
+                ORDER BY next_attempt_at
+                LIMIT ?
+            ''', (now, self.batch_size))
+            rows = cursor.fetchall()
+            if rows:
+                cursor.executemany('''
+                    UPDATE push_outbox SET status = 'sending', next_attempt_at = ? WHERE id = ?
+                ''', [(now + self.lease_seconds, row[0]) for row in rows])
+            return rows
+        return ledger.run_immediate(conn, work)
+
+    def _backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempts))
+        return delay * random.uniform(0.5, 1.0)
+
+    def flush_once(self):
+        conn = self.pool.acquire()
+        try:
+            try:
+                rows = self._claim(conn)
+            except sqlite3.OperationalError as e:
+                print(f"Push dispatcher could not claim batch: {e}")
+                return 0
+            if not rows:
+                return 0
+
+            messages = [{
+                'to': token,
+                'title': title,
+                'body': body,
+                '_displayInForeground': True,
+            } for _, token, title, body, _, _ in rows]
+
+            started = time.perf_counter()
+            ok = False
+            try:
+                response = self.session.post(self.url, json=messages, timeout=self.timeout)
+                response.raise_for_status()
+                tickets = response.json().get('data', [])
+                ok = True
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Error sending push batch of {len(rows)}: {e}")
+                self._record_failure(conn, rows, str(e))
+                return 0
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self.batches += 1
+                    self.send_seconds += elapsed
+                if self.metrics:
+                    self.metrics.observe_push(elapsed, len(rows), ok)
+
+            self._record_success(conn, rows, tickets)
+            return len(rows)
+        finally:
+            self.pool.release(conn)
+
+    def _record_success(self, conn, rows, tickets):
+        now = time.time()
+        done, rejected = [], []
+        for i, row in enumerate(rows):
+            ticket = tickets[i] if i < len(tickets) and isinstance(tickets[i], dict) else {}
+            if ticket.get('status') == 'error':
+                # Ticket errors (e.g. DeviceNotRegistered) are permanent; keep them for inspection
+                rejected.append((ticket.get('message', 'error'), row[0]))
+            else:
+                done.append((row[0],))
+
+        def work(cursor):
+            cursor.executemany('DELETE FROM push_outbox WHERE id = ?', done)
+            cursor.executemany('''
+                UPDATE push_outbox SET status = 'failed', last_error = ? WHERE id = ?
+            ''', rejected)
+        ledger.run_immediate(conn, work)
+
+        with self._lock:
+            self.sent += len(done)
+            self.failed += len(rejected)
+            self.delivery_count += len(rows)
+            for row in rows:
+                latency = now - row[5]
+                self.delivery_latency_total += latency
+                self.delivery_latency_max = max(self.delivery_latency_max, latency)
+        print(f"Push batch sent: {len(done)} delivered, {len(rejected)} rejected.")
+
+    def _record_failure(self, conn, rows, error):
+        now = time.time()
+        retry, give_up = [], []
+        for row_id, _, _, _, attempts, _ in rows:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                give_up.append((attempts, error, row_id))
+            else:
+                retry.append((attempts, now + self._backoff(attempts), error, row_id))
+
+        def work(cursor):
+            cursor.executemany('''
+                UPDATE push_outbox SET status = 'queued', attempts = ?, next_attempt_at = ?, last_error = ?
+                WHERE id = ?
+            ''', retry)
+            cursor.executemany('''
+                UPDATE push_outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?
+            ''', give_up)
+        ledger.run_immediate(conn, work)
+
+        with self._lock:
+            self.retried += len(retry)
+            self.failed += len(give_up)
+
+    def stats(self):
+        conn = self.pool.acquire()
+        try:
+            queued, failed, oldest = conn.execute('''
+                SELECT
+                    SUM(CASE WHEN status != 'failed' THEN 1 ELSE 0 END),
+                    SUM(CASE WHEN status = 'failed' THEN 1 ELSE 0 END),
+                    MIN(CASE WHEN status != 'failed' THEN created_at END)
+                FROM push_outbox
+            ''').fetchone()
+        finally:
+            self.pool.release(conn)
+
+        with self._lock:
+            delivered = self.delivery_count
+            return {
+                'queue_depth': queued or 0,
+                'failed_in_outbox': failed or 0,
+                'oldest_queued_age_seconds': round(time.time() - oldest, 3) if oldest else 0,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'batches': self.batches,
+                'avg_batch_seconds': round(self.send_seconds / self.batches, 4) if self.batches else 0,
+                'avg_delivery_latency_seconds': round(self.delivery_latency_total / delivered, 4) if delivered else 0,
+                'max_delivery_latency_seconds': round(self.delivery_latency_max, 4),
+                'running': bool(self._thread and self._thread.is_alive()),
+            }
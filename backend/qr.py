@@ -0,0 +1,196 @@
+import base64
+import hashlib
+import hmac
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+# Payment-request QR codes. A token carries the requester, the amount, an
+# expiry and a random nonce, signed with HMAC-SHA256:
+#
+#   version (1) | requester_id (4) | amount_cents (4) | expires_at (4) | nonce (8) | tag (16)
+#
+# base64url-encoded that is 50 characters, small enough for a low-density
+# QR code. Signature, expiry and replays are all checked in memory, so a
+# flood of stale, forged or repeated scans never reaches SQLite. Only a
+# token that passes gets to the transfer, whose transaction also records the
+# nonce in qr_redemptions: that is what stops a replay in another worker.
+
+VERSION = 1
+_PAYLOAD = struct.Struct('>BIII8s')
+TAG_BYTES = 16
+TOKEN_LENGTH = len(base64.urlsafe_b64encode(bytes(_PAYLOAD.size + TAG_BYTES)).rstrip(b'='))
+
+MAX_AMOUNT_CENTS = 2 ** 32 - 1
+
+
+class QrError(ValueError):
+    pass
+
+
+class InvalidToken(QrError):
+    pass
+
+
+class ExpiredToken(QrError):
+    pass
+
+
+class ReplayedToken(QrError):
+    pass
+
+
+class NonceCacheFull(QrError):
+    pass
+
+
+class QrPayment:
+    __slots__ = ('requester_id', 'amount_cents', 'expires_at', 'nonce')
+
+    def __init__(self, requester_id, amount_cents, expires_at, nonce):
+        self.requester_id = requester_id
+        self.amount_cents = amount_cents
+        self.expires_at = expires_at
+        self.nonce = nonce
+
+
+class QrTokens:
+    """Issues and checks signed QR tokens, and remembers redeemed nonces until they expire.
+
+    Nonces sit in buckets keyed by expiry second // `bucket_seconds`; a
+    bucket is dropped whole once its last token has expired, since an
+    expired token fails the expiry check anyway. At most `nonce_capacity`
+    nonces are held: past that, redemptions are refused rather than
+    forgetting a nonce that could then be replayed.
+
+    Every worker must be given the same `secret` (QR_SECRET). Without one a
+    random per-process key is used and tokens only redeem where they were made.
+    """
+
+    def __init__(self, secret=None, ttl=30, max_ttl=300, nonce_capacity=100000, bucket_seconds=10,
+                 purge_interval=60.0):
+        if not secret:
+            print("QR_SECRET is not set; QR codes will only redeem in the worker that issued them")
+            secret = os.urandom(32)
+        self._key = secret.encode() if isinstance(secret, str) else secret
+        self.ttl = ttl
+        self.max_ttl = max_ttl
+        self.nonce_capacity = nonce_capacity
+        self.bucket_seconds = bucket_seconds
+        self.purge_interval = purge_interval
+        self._lock = threading.Lock()
+        self._buckets = {}  # expiry bucket -> set of nonces
+        self._size = 0
+        self._last_purge = 0.0
+        self.issued = 0
+        self.redeemed = 0
+        self.rejected = {'invalid': 0, 'expired': 0, 'replayed': 0, 'full': 0}
+
+    # --- Tokens ---
+
+    def _tag(self, payload):
+        return hmac.new(self._key, payload, hashlib.sha256).digest()[:TAG_BYTES]
+
+    def issue(self, requester_id, amount_cents, ttl=None):
+        """A token for `amount_cents` to `requester_id`: (token, expires_at)."""
+        if not 0 < amount_cents <= MAX_AMOUNT_CENTS:
+            raise InvalidToken('Amount out of range')
+        ttl = self.ttl if ttl is None else max(1, min(int(ttl), self.max_ttl))
+        expires_at = int(time.time()) + ttl
+        payload = _PAYLOAD.pack(VERSION, requester_id, amount_cents, expires_at, os.urandom(8))
+        token = base64.urlsafe_b64encode(payload + self._tag(payload)).rstrip(b'=').decode()
+        with self._lock:
+            self.issued += 1
+        return token, expires_at
+
+    def verify(self, token):
+        """The QrPayment a token stands for; raises InvalidToken or ExpiredToken."""
+        try:
+            if not isinstance(token, str) or len(token) != TOKEN_LENGTH:
+                raise ValueError
+            raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        except ValueError:
+            self._count('invalid')
+            raise InvalidToken('Malformed QR code')
+        payload, tag = raw[:_PAYLOAD.size], raw[_PAYLOAD.size:]
+        if not hmac.compare_digest(tag, self._tag(payload)):
+            self._count('invalid')
+            raise InvalidToken('QR code signature does not match')
+        version, requester_id, amount_cents, expires_at, nonce = _PAYLOAD.unpack(payload)
+        if version != VERSION:
+            self._count('invalid')
+            raise InvalidToken('Unsupported QR code version')
+        if expires_at <= time.time():
+            self._count('expired')
+            raise ExpiredToken('QR code has expired')
+        return QrPayment(requester_id, amount_cents, expires_at, nonce)
+
+    # --- Nonce cache ---
+
+    def claim(self, payment):
+        """Mark the token's nonce as used; raises ReplayedToken if it already was."""
+        now = time.time()
+        bucket = payment.expires_at // self.bucket_seconds
+        with self._lock:
+            # Buckets whose every token has expired can go
+            for stale in [b for b in self._buckets if (b + 1) * self.bucket_seconds <= now]:
+                self._size -= len(self._buckets.pop(stale))
+            nonces = self._buckets.get(bucket)
+            if nonces is not None and payment.nonce in nonces:
+                self.rejected['replayed'] += 1
+                raise ReplayedToken('QR code was already used')
+            if self._size >= self.nonce_capacity:
+                self.rejected['full'] += 1
+                raise NonceCacheFull('Too many QR payments in progress, try again shortly')
+            self._buckets.setdefault(bucket, set()).add(payment.nonce)
+            self._size += 1
+
+    def release(self, payment):
+        # The payment did not go through (e.g. insufficient funds), so the code may be scanned again
+        bucket = payment.expires_at // self.bucket_seconds
+        with self._lock:
+            nonces = self._buckets.get(bucket)
+            if nonces is not None and payment.nonce in nonces:
+                nonces.discard(payment.nonce)
+                self._size -= 1
+
+    def _count(self, reason):
+        with self._lock:
+            self.rejected[reason] += 1
+
+    # --- Storage ---
+
+    def record(self, cursor, payment, payer_id, transaction_id):
+        """Store the redemption in the transfer's transaction; raises ReplayedToken if another worker got there first."""
+        now = time.time()
+        with self._lock:
+            purge = now - self._last_purge >= self.purge_interval
+            if purge:
+                self._last_purge = now
+        if purge:
+            cursor.execute('DELETE FROM qr_redemptions WHERE expires_at <= ?', (int(now),))
+        try:
+            cursor.execute('''
+                INSERT INTO qr_redemptions (nonce, requester_id, payer_id, amount_cents, transaction_id, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (payment.nonce, payment.requester_id, payer_id, payment.amount_cents, transaction_id,
+                  payment.expires_at))
+        except sqlite3.IntegrityError:
+            with self._lock:
+                self.rejected['replayed'] += 1
+            raise ReplayedToken('QR code was already used')
+        with self._lock:
+            self.redeemed += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'issued': self.issued,
+                'redeemed': self.redeemed,
+                'rejected': dict(self.rejected),
+                'nonces': self._size,
+                'nonce_capacity': self.nonce_capacity,
+                'buckets': len(self._buckets),
+            }
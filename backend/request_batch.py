@@ -0,0 +1,128 @@
+import ledger
+
+BATCH_ACTIONS = ('approve', 'deny')
+
+# One IN (...) list per statement stays well under SQLite's bound-parameter limit
+MAX_BATCH_ITEMS = 500
+
+
+class BatchError(ValueError):
+    pass
+
+
+def parse_items(data):
+    """Validate a /requests/batch body into [(request_id, action), ...] in request order."""
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        raise BatchError('items must be a non-empty list')
+    if len(items) > MAX_BATCH_ITEMS:
+        raise BatchError(f'At most {MAX_BATCH_ITEMS} items per batch')
+
+    parsed = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise BatchError(f'items[{index}] must be an object with request_id and action')
+        action = item.get('action')
+        if action not in BATCH_ACTIONS:
+            raise BatchError(f'Unknown action: {action}')
+        parsed.append((int(item['request_id']), action))
+    return parsed
+
+
+def _in_list(values):
+    return ','.join('?' * len(values))
+
+
+def apply_batch(cursor, payer_id, items):
+    """Approve/deny many of one payer's pending requests inside the caller's (immediate) transaction.
+
+    Approvals are taken in request order while the payer's balance covers
+    them; the rest come back as 'insufficient_funds' and stay pending.
+    Returns (results, per_requester) where `per_requester` maps requester_id
+    to {'approved': [cents, ...], 'denied': [cents, ...]} for notifications.
+    """
+    cursor.execute('''
+        SELECT u.iban, COALESCE(b.balance_cents, 0) FROM users u
+        LEFT JOIN bank_balances b ON b.iban = u.iban
+        WHERE u.id = ?
+    ''', (payer_id,))
+    payer = cursor.fetchone()
+    if payer is None:
+        raise ledger.AccountNotFound(payer_id)
+    payer_iban, available = payer
+
+    request_ids = list(dict.fromkeys(request_id for request_id, _ in items))
+    cursor.execute(f'''
+        SELECT pr.id, pr.requester_id, pr.amount_cents, u.iban
+        FROM pending_requests pr
+        JOIN users u ON u.id = pr.requester_id
+        WHERE pr.payer_id = ? AND pr.status = 'pending' AND pr.id IN ({_in_list(request_ids)})
+    ''', [payer_id, *request_ids])
+    pending = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    results, approved, denied, seen = [], [], [], set()
+    for request_id, action in items:
+        if request_id in seen:
+            status = 'duplicate'
+        elif request_id not in pending:
+            status = 'not_found'
+        elif action == 'deny':
+            status = 'denied'
+            denied.append(request_id)
+        elif pending[request_id][1] > available:
+            status = 'insufficient_funds'
+        else:
+            status = 'approved'
+            available -= pending[request_id][1]
+            approved.append(request_id)
+        seen.add(request_id)
+        result = {'request_id': request_id, 'action': action, 'status': status}
+        if request_id in pending:
+            result['amount_cents'] = pending[request_id][1]
+        results.append(result)
+
+    if approved:
+        cursor.execute(f'''
+            SELECT request_ref, MIN(id) FROM transactions
+            WHERE request_ref IN ({_in_list(approved)}) AND status = 'pending'
+            GROUP BY request_ref
+        ''', approved)
+        transaction_ids = dict(cursor.fetchall())
+
+        cursor.execute(f"UPDATE pending_requests SET status = 'approved' WHERE id IN ({_in_list(approved)})", approved)
+        ledger.pay_many(cursor, payer_iban, [
+            (pending[request_id][2], pending[request_id][1], transaction_ids.get(request_id))
+            for request_id in approved
+        ], 'request')
+        cursor.execute(f'''
+            UPDATE transactions SET status = 'completed'
+            WHERE request_ref IN ({_in_list(approved)}) AND status = 'pending'
+        ''', approved)
+
+    if denied:
+        cursor.execute(f"UPDATE pending_requests SET status = 'denied' WHERE id IN ({_in_list(denied)})", denied)
+        cursor.execute(f'''
+            UPDATE transactions SET status = 'rejected'
+            WHERE request_ref IN ({_in_list(denied)}) AND status = 'pending'
+        ''', denied)
+
+    per_requester = {}
+    for outcome, request_ids in (('approved', approved), ('denied', denied)):
+        for request_id in request_ids:
+            requester_id, amount_cents, _ = pending[request_id]
+            per_requester.setdefault(requester_id, {'approved': [], 'denied': []})[outcome].append(amount_cents)
+    return results, per_requester
+
+
+def notification_text(payer_name, outcome):
+    # One message per requester covering everything the payer did to their requests
+    parts = []
+    for verb, amounts in (('approved', outcome['approved']), ('denied', outcome['denied'])):
+        if len(amounts) == 1:
+            parts.append(f'{verb} your request for €{amounts[0]/100:.2f}')
+        elif amounts:
+            parts.append(f'{verb} {len(amounts)} of your requests (€{sum(amounts)/100:.2f})')
+    title = 'Request Approved' if outcome['approved'] else 'Request Denied'
+    if outcome['approved'] and outcome['denied']:
+        title = 'Requests Updated'
+    return title, f'{payer_name} ' + ' and '.join(parts) + '.'
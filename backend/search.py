@@ -0,0 +1,135 @@
+import re
+
+# Contact search for /users/search. Names go through an FTS5 index, phone
+# numbers and IBANs through ordinary b-tree indexes, and a per-user rollup
+# of who they have dealt with ranks the results. Triggers keep it all current
+# (all from migration 10).
+
+# Names are folded (Kovač -> kovac, Žan -> zan) by the users_fts tokenizer,
+# both when indexing and when parsing a query. Prefix indexes up to 8
+# characters cover most of a word as it is typed; without one, FTS5 would
+# copy every matching term's doclist for each prefix query.
+
+COUNTRY_CODE = '386'
+
+SEARCH_MAX_LIMIT = 50
+
+# Only this many of the user's most recent contacts are checked against a query
+RECENT_CONTACTS = 200
+
+
+def _phone_key(column):
+    # SQL for a phone number as international digits: "+386 40 123 456", "00386 40..." and "040..." -> 38640123456.
+    # Spelled exactly like idx_users_phone_key, or SQLite won't use the index
+    digits = column
+    for char in (' ', '+', '-', '(', ')', '.', '/'):
+        digits = f"replace({digits}, '{char}', '')"
+    return (f"CASE WHEN {digits} LIKE '00%' THEN substr({digits}, 3) "
+            f"WHEN {digits} LIKE '0%' THEN '{COUNTRY_CODE}' || substr({digits}, 2) "
+            f"ELSE {digits} END")
+
+
+# How each kind of query finds matching users: a condition on a users row `u`
+# (used to filter the recent contacts) and a query listing matching ids
+_CONDITIONS = {
+    'name': 'EXISTS (SELECT 1 FROM users_fts WHERE users_fts MATCH ? AND rowid = u.id)',
+    'phone': f"{_phone_key('u.phone')} >= ? AND {_phone_key('u.phone')} < ?",
+    'iban': 'u.iban >= ? AND u.iban < ?',
+}
+
+_LOOKUPS = {
+    'name': 'SELECT rowid FROM users_fts WHERE users_fts MATCH ? LIMIT ?',
+    'phone': f"SELECT u.id FROM users u WHERE {_CONDITIONS['phone']} LIMIT ?",
+    'iban': f"SELECT u.id FROM users u WHERE {_CONDITIONS['iban']} LIMIT ?",
+}
+
+_IBAN = re.compile(r'[A-Za-z]{2}\d{2}[0-9A-Za-z]*')
+_PHONE = re.compile(r'\+?[\d\s()./-]+')
+_WORD = re.compile(r'\w+')
+
+
+def _prefix_range(prefix):
+    # Bounds of every string starting with `prefix`, for an index range scan
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def parse(query):
+    """(kind, params) for a search box query, or None if there is nothing to search for.
+
+    An IBAN-looking query is an IBAN prefix and a phone-looking one a phone
+    number prefix, each found by a range scan. Anything else matches every
+    word as a name prefix through FTS5. Only \\w characters reach the MATCH
+    expression, so user input can't inject FTS5 syntax.
+    """
+    query = query.strip()
+    compact = re.sub(r'[\s-]', '', query)
+    if _IBAN.fullmatch(compact):
+        return 'iban', _prefix_range(compact.upper())
+    if _PHONE.fullmatch(query):
+        digits = re.sub(r'\D', '', query)
+        if not digits:
+            return None
+        if not query.startswith('+'):
+            if digits.startswith('00'):
+                digits = digits[2:]
+            elif digits.startswith('0'):
+                digits = COUNTRY_CODE + digits[1:]
+        return 'phone', _prefix_range(digits)
+    words = _WORD.findall(query)
+    if not words:
+        return None
+    return 'name', (' AND '.join(f'"{word}" *' for word in words),)
+
+
+def search(cursor, query, user_id=None, limit=20):
+    """Users matching `query`, best first, as JSON-ready dicts.
+
+    People `user_id` has dealt with come first, most recent interaction
+    first (only the RECENT_CONTACTS most recent are checked). Other
+    matches follow in index order, so the scan stops after `limit` rows.
+    The searching user is left out.
+    """
+    parsed = parse(query)
+    if parsed is None:
+        return []
+    kind, params = parsed
+
+    ranked = []
+    if user_id:
+        # Each candidate is a lookup by id, not a scan of every match
+        cursor.execute(f'''
+            SELECT c.contact_id, c.last_interaction FROM (
+                SELECT contact_id, last_interaction FROM user_contacts
+                WHERE user_id = ? ORDER BY last_interaction DESC LIMIT ?
+            ) c
+            JOIN users u ON u.id = c.contact_id
+            WHERE {_CONDITIONS[kind]}
+            ORDER BY c.last_interaction DESC
+            LIMIT ?
+        ''', (user_id, RECENT_CONTACTS, *params, limit))
+        ranked = cursor.fetchall()
+
+    seen = {contact_id for contact_id, _ in ranked}
+    seen.add(user_id)
+    if len(ranked) < limit:
+        cursor.execute(_LOOKUPS[kind], (*params, limit + len(seen)))
+        for (found_id,) in cursor.fetchall():
+            if found_id not in seen and len(ranked) < limit:
+                ranked.append((found_id, None))
+                seen.add(found_id)
+    if not ranked:
+        return []
+
+    ids = [found_id for found_id, _ in ranked]
+    cursor.execute(f'''
+        SELECT id, name, email, phone, iban FROM users WHERE id IN ({','.join('?' * len(ids))})
+    ''', ids)
+    users = {row[0]: row for row in cursor.fetchall()}
+    return [{
+        'id': found_id,
+        'name': users[found_id][1],
+        'email': users[found_id][2],
+        'phone': users[found_id][3],
+        'iban': users[found_id][4],
+        'last_interaction': last_interaction,
+    } for found_id, last_interaction in ranked if found_id in users]
@@ -0,0 +1,209 @@
+import heapq
+
+import ledger
+
+# What members of a group owe each other, netted into as few transfers as possible.
+#
+# A member's balance is the sum of:
+#   + open (pending) group requests they sent     - open group requests addressed to them
+#   + group transfers they made since the last settlement
+#   - group transfers they received since then
+# so a positive balance is money the member is owed. Settling pays the plan
+# out, closes the open requests as 'settled' and moves the group's
+# settled_through_tx mark past every transfer it accounted for.
+
+
+class SettleError(ValueError):
+    pass
+
+
+class NotAMember(SettleError):
+    pass
+
+
+class PlanChanged(SettleError):
+    pass
+
+
+def members(cursor, group_id):
+    # {user_id: (name, iban)} for every member of the group
+    cursor.execute('''
+        SELECT u.id, u.name, u.iban FROM group_members m
+        JOIN users u ON u.id = m.user_id
+        WHERE m.group_id = ?
+    ''', (group_id,))
+    return {user_id: (name, iban) for user_id, name, iban in cursor.fetchall()}
+
+
+def net_balances(cursor, group_id, settled_through_tx):
+    """Net the group's open debts: ({user_id: balance_cents}, fingerprint, open_requests, group_transfers).
+
+    The fingerprint changes whenever a request or transfer that feeds the
+    balances is added, resolved or settled, so a plan previewed earlier can
+    be checked before it is executed.
+    """
+    cursor.execute('''
+        SELECT user_id, SUM(delta_cents) FROM (
+            SELECT requester_id AS user_id, amount_cents AS delta_cents FROM pending_requests
+            WHERE group_id = :group_id AND status = 'pending'
+            UNION ALL
+            SELECT payer_id, -amount_cents FROM pending_requests
+            WHERE group_id = :group_id AND status = 'pending'
+            UNION ALL
+            SELECT initiator_id, amount_cents FROM transactions
+            WHERE group_id = :group_id AND id > :through AND type = 'transfer' AND status = 'completed'
+            UNION ALL
+            SELECT target_id, -amount_cents FROM transactions
+            WHERE group_id = :group_id AND id > :through AND type = 'transfer' AND status = 'completed'
+        )
+        GROUP BY user_id
+    ''', {'group_id': group_id, 'through': settled_through_tx})
+    balances = {user_id: cents for user_id, cents in cursor.fetchall() if cents}
+
+    cursor.execute('''
+        SELECT COUNT(*), COALESCE(MAX(id), 0), COALESCE(SUM(amount_cents), 0) FROM pending_requests
+        WHERE group_id = ? AND status = 'pending'
+    ''', (group_id,))
+    open_requests, last_request_id, open_cents = cursor.fetchone()
+    cursor.execute('''
+        SELECT COUNT(*), COALESCE(MAX(id), 0) FROM transactions
+        WHERE group_id = ? AND id > ? AND type = 'transfer' AND status = 'completed'
+    ''', (group_id, settled_through_tx))
+    group_transfers, last_transfer_id = cursor.fetchone()
+    fingerprint = f'{settled_through_tx}-{open_requests}-{last_request_id}-{open_cents}-{group_transfers}-{last_transfer_id}'
+    return balances, fingerprint, open_requests, group_transfers
+
+
+def min_cash_flow(balances):
+    """Reduce net balances {user_id: cents} to [(from_id, to_id, cents), ...] transfers.
+
+    Debtors and creditors whose amounts cancel exactly are paired first.
+    Everyone else is settled greedily: the largest debtor pays the largest
+    creditor (two heaps) until both sides are empty. Each step zeroes at
+    least one balance, so n members with a non-zero balance need at most
+    n - 1 transfers; the whole run is O(n log n).
+    """
+    if sum(balances.values()) != 0:
+        raise SettleError('Balances do not add up to zero')
+
+    owed = {}
+    for user_id, cents in sorted(balances.items()):
+        if cents > 0:
+            owed.setdefault(cents, []).append(user_id)
+
+    transfers, debtors = [], []
+    for user_id, cents in sorted(balances.items()):
+        if cents >= 0:
+            continue
+        exact = owed.get(-cents)
+        if exact:
+            transfers.append((user_id, exact.pop(), -cents))
+        else:
+            debtors.append((cents, user_id))  # most negative first
+    creditors = [(-cents, user_id) for cents, user_ids in owed.items() for user_id in user_ids]
+    heapq.heapify(debtors)
+    heapq.heapify(creditors)
+
+    while debtors and creditors:
+        debt, debtor = heapq.heappop(debtors)
+        credit, creditor = heapq.heappop(creditors)
+        amount = min(-debt, -credit)
+        transfers.append((debtor, creditor, amount))
+        if debt + amount < 0:
+            heapq.heappush(debtors, (debt + amount, debtor))
+        if credit + amount < 0:
+            heapq.heappush(creditors, (credit + amount, creditor))
+    return transfers
+
+
+def _load_group(cursor, group_id, user_id):
+    cursor.execute('SELECT name, settled_through_tx FROM groups WHERE id = ?', (group_id,))
+    group = cursor.fetchone()
+    if group is None:
+        return None
+    group_members = members(cursor, group_id)
+    if user_id not in group_members:
+        raise NotAMember(f'User {user_id} is not a member of group {group_id}')
+    return group[0], group[1], group_members
+
+
+def plan(cursor, group_id, user_id):
+    """Preview settling the group as a JSON-ready dict, or None if the group doesn't exist."""
+    group = _load_group(cursor, group_id, user_id)
+    if group is None:
+        return None
+    name, settled_through_tx, group_members = group
+    balances, fingerprint, open_requests, group_transfers = net_balances(cursor, group_id, settled_through_tx)
+    if not balances.keys() <= group_members.keys():
+        raise SettleError('Group debts involve users who are not members')
+    transfers = min_cash_flow(balances)
+
+    return {
+        'group_id': group_id,
+        'name': name,
+        'fingerprint': fingerprint,
+        'open_requests': open_requests,
+        'group_transfers': group_transfers,
+        'balances': [
+            {'user_id': member_id, 'name': group_members[member_id][0], 'balance_cents': cents}
+            for member_id, cents in sorted(balances.items(), key=lambda item: item[1])
+        ],
+        'transfers': [
+            {'from_id': from_id, 'from_name': group_members[from_id][0],
+             'to_id': to_id, 'to_name': group_members[to_id][0], 'amount_cents': cents}
+            for from_id, to_id, cents in transfers
+        ],
+    }
+
+
+def execute(cursor, group_id, user_id, fingerprint=None):
+    """Settle the group inside the caller's (immediate) transaction.
+
+    The plan is recomputed under the write lock. If `fingerprint` is given
+    and no longer matches, PlanChanged is raised and nothing is written.
+    A debtor who can't cover their transfers raises ledger.InsufficientFunds,
+    which rolls the whole settlement back. Returns the executed plan (as
+    plan() does, plus transaction ids) or None if the group doesn't exist.
+    """
+    settlement = plan(cursor, group_id, user_id)
+    if settlement is None:
+        return None
+    if fingerprint is not None and fingerprint != settlement['fingerprint']:
+        raise PlanChanged('Group balances changed since the preview')
+
+    transfers = settlement['transfers']
+    if transfers:
+        group_members = members(cursor, group_id)
+        memo = f"Poravnava skupine {settlement['name']}"
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM transactions')
+        first_new_id = cursor.fetchone()[0]
+        cursor.executemany('''
+            INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, memo, group_id)
+            VALUES ('transfer', ?, ?, ?, 'completed', ?, ?)
+        ''', [(t['from_id'], t['to_id'], t['amount_cents'], memo, group_id) for t in transfers])
+        # We hold the write lock, so the rows above first_new_id are the ones just inserted, in order
+        cursor.execute('SELECT id FROM transactions WHERE id > ? ORDER BY id', (first_new_id,))
+        transaction_ids = [row[0] for row in cursor.fetchall()]
+
+        # One guarded debit per debtor covering all of their transfers
+        per_debtor = {}
+        for transfer, transaction_id in zip(transfers, transaction_ids):
+            transfer['transaction_id'] = transaction_id
+            per_debtor.setdefault(transfer['from_id'], []).append(
+                (group_members[transfer['to_id']][1], transfer['amount_cents'], transaction_id))
+        for debtor_id, payments in per_debtor.items():
+            ledger.pay_many(cursor, group_members[debtor_id][1], payments, 'settlement')
+
+    # Everything the plan accounted for is now closed
+    # Group requests' request_sent rows carry the group_id too (splits.create_split)
+    cursor.execute('''
+        UPDATE transactions SET status = 'settled'
+        WHERE group_id = ? AND type = 'request_sent' AND status = 'pending'
+    ''', (group_id,))
+    cursor.execute('''
+        UPDATE pending_requests SET status = 'settled' WHERE group_id = ? AND status = 'pending'
+    ''', (group_id,))
+    cursor.execute('''
+        UPDATE groups SET settled_through_tx = (SELECT COALESCE(MAX(id), 0) FROM transactions) WHERE id = ?
+    ''', (group_id,))
+    return settlement
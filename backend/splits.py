@@ -0,0 +1,157 @@
+SPLIT_MODES = ('amounts', 'equal', 'weighted')
+
+# Stay well under SQLite's bound-parameter limit for IN (...) lists
+IN_CHUNK_SIZE = 500
+
+
+class SplitError(ValueError):
+    pass
+
+
+def distribute(total_cents, weights):
+    """Split `total_cents` proportionally to `weights` in whole cents.
+
+    Uses the largest-remainder method, so the parts always add up to the
+    total exactly and leftover cents go to the largest fractional shares
+    (ties broken by position).
+    """
+    weight_sum = sum(weights)
+    if weight_sum <= 0:
+        raise SplitError('Weights must add up to more than zero')
+
+    parts = [total_cents * w // weight_sum for w in weights]
+    remainders = [(total_cents * w % weight_sum, -i) for i, w in enumerate(weights)]
+    leftover = total_cents - sum(parts)
+    for _, neg_index in sorted(remainders, reverse=True)[:leftover]:
+        parts[-neg_index] += 1
+    return parts
+
+
+def compute_shares(data, total_cents):
+    """Turn a /split_request body into [(iban, amount_cents), ...] and the payer's own share.
+
+    Modes:
+      - 'amounts' (default): each recipient carries its own amount_cents
+      - 'equal': total is divided equally between recipients (and the payer
+        unless include_payer is false)
+      - 'weighted': each recipient carries a weight; payer_weight is the
+        payer's own weight (default 0)
+    """
+    mode = data.get('mode', 'amounts')
+    if mode not in SPLIT_MODES:
+        raise SplitError(f'Unknown split mode: {mode}')
+
+    recipients = data.get('recipients')
+    if not isinstance(recipients, list) or not recipients:
+        raise SplitError('recipients must be a non-empty list')
+    ibans = [recipient['iban'] for recipient in recipients]
+
+    if mode == 'amounts':
+        amounts = [int(recipient['amount_cents']) for recipient in recipients]
+        payer_share = total_cents - sum(amounts)
+    elif mode == 'equal':
+        include_payer = data.get('include_payer', True)
+        parts = distribute(total_cents, [1] * (len(ibans) + (1 if include_payer else 0)))
+        amounts = parts[:len(ibans)]
+        payer_share = parts[len(ibans)] if include_payer else 0
+    else:
+        weights = [int(recipient['weight']) for recipient in recipients]
+        payer_weight = int(data.get('payer_weight', 0))
+        if any(w < 0 for w in weights) or payer_weight < 0:
+            raise SplitError('Weights must not be negative')
+        parts = distribute(total_cents, weights + [payer_weight])
+        amounts, payer_share = parts[:-1], parts[-1]
+
+    if any(amount < 0 for amount in amounts):
+        raise SplitError('Share amounts must not be negative')
+    if payer_share < 0:
+        raise SplitError('Shares add up to more than total_cents')
+    if 'payer_share_cents' in data and int(data['payer_share_cents']) != payer_share:
+        raise SplitError('Shares plus payer_share_cents must add up to total_cents')
+
+    # Zero shares (e.g. a weight of 0) don't produce a request
+    shares = [(iban, amount) for iban, amount in zip(ibans, amounts) if amount > 0]
+    return shares, payer_share
+
+
+def _chunks(items, size=IN_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def resolve_ibans(cursor, ibans):
+    # One IN (...) query per chunk instead of one lookup per recipient
+    users = {}
+    unique = list(dict.fromkeys(ibans))
+    for chunk in _chunks(unique):
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'SELECT iban, id, name FROM users WHERE iban IN ({placeholders})', chunk)
+        for iban, user_id, name in cursor.fetchall():
+            users[iban] = (user_id, name)
+    return users
+
+
+def existing_pending(cursor, requester_id, payer_ids):
+    # (payer_id, amount_cents) pairs that already have a pending request from this requester
+    found = set()
+    unique = list(dict.fromkeys(payer_ids))
+    for chunk in _chunks(unique):
+        placeholders = ','.join('?' * len(chunk))
+        cursor.execute(f'''
+            SELECT payer_id, amount_cents FROM pending_requests
+            WHERE requester_id = ? AND status = 'pending' AND payer_id IN ({placeholders})
+        ''', [requester_id, *chunk])
+        found.update(cursor.fetchall())
+    return found
+
+
+def create_split(cursor, payer_id, total_cents, shares, memo, split_memo, group_id=None):
+    """Write one split inside the caller's (immediate) transaction.
+
+    With a `group_id` the split and its requests are tagged with the group,
+    so settle.py can net them against the group's other debts.
+
+    Returns (created, skipped_duplicates, unknown_ibans) where `created` is
+    a list of (recipient_id, recipient_name, amount_cents).
+    """
+    users = resolve_ibans(cursor, [iban for iban, _ in shares])
+    unknown = [iban for iban, _ in shares if iban not in users]
+
+    candidates = [(users[iban][0], users[iban][1], amount) for iban, amount in shares if iban in users]
+    seen = existing_pending(cursor, payer_id, [recipient_id for recipient_id, _, _ in candidates])
+
+    created, duplicates = [], []
+    for recipient_id, recipient_name, amount in candidates:
+        key = (recipient_id, amount)
+        if key in seen:
+            duplicates.append(recipient_name)
+            continue
+        seen.add(key)
+        created.append((recipient_id, recipient_name, amount))
+
+    # Insert split_sent transaction log
+    cursor.execute('''
+        INSERT INTO transactions (type, initiator_id, amount_cents, status, memo, group_id)
+        VALUES ('split_sent', ?, ?, 'completed', ?, ?)
+    ''', (payer_id, total_cents, split_memo, group_id))
+
+    if created:
+        # We hold the write lock, so every row above this id is one we insert below
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM pending_requests")
+        first_new_id = cursor.fetchone()[0]
+
+        cursor.executemany('''
+            INSERT INTO pending_requests (requester_id, payer_id, amount_cents, group_id)
+            VALUES (?, ?, ?, ?)
+        ''', [(payer_id, recipient_id, amount, group_id) for recipient_id, _, amount in created])
+
+        # request_sent log per sub-request, set-based from the rows just written
+        cursor.execute('''
+            INSERT INTO transactions (type, initiator_id, target_id, amount_cents, status, memo, request_ref, group_id)
+            SELECT 'request_sent', requester_id, payer_id, amount_cents, 'pending', ?, id, group_id
+            FROM pending_requests
+            WHERE id > ? AND requester_id = ?
+            ORDER BY id
+        ''', (memo, first_new_id, payer_id))
+
+    return created, duplicates, unknown
@@ -0,0 +1,82 @@
+from datetime import datetime, timezone
+
+# Per-user, per-month sums of completed transactions in `monthly_statements`,
+# kept current by triggers on `transactions` (migrations 8 and 12). Kinds are
+# from the user's point of view:
+#   transfer_in / transfer_out   direct transfers received / sent
+#   request_in / request_out     approved requests paid to / by the user
+#   split_created                bills the user split (total bill, no money moved)
+
+INCOME_KINDS = ('transfer_in', 'request_in')
+SPENDING_KINDS = ('transfer_out', 'request_out')
+KINDS = INCOME_KINDS + SPENDING_KINDS + ('split_created',)
+
+# Month of a transaction; timestamps are stored as 'YYYY-MM-DD HH:MM:SS' (CURRENT_TIMESTAMP)
+_MONTH = "substr({t}.timestamp, 1, 7)"
+
+# Kind for each side of transaction `{t}`: the initiator's and the target's, as the triggers compute them
+_INITIATOR_KIND = """CASE {t}.type WHEN 'transfer' THEN 'transfer_out'
+                                   WHEN 'request_sent' THEN 'request_in'
+                                   WHEN 'split_sent' THEN 'split_created' END"""
+_TARGET_KIND = """CASE {t}.type WHEN 'transfer' THEN 'transfer_in'
+                                WHEN 'request_sent' THEN 'request_out' END"""
+
+
+def backfill(cursor, since=None):
+    """Recompute statements from `transactions`, for every month or only months >= `since` ('YYYY-MM').
+
+    Runs inside the caller's (immediate) transaction, so the triggers can't
+    add to a month while it is being rebuilt. Archived months (archive.py)
+    are kept as they are, since their rows are no longer in `transactions`.
+    Returns the number of rows written.
+    """
+    month_filter = 'AND month NOT IN (SELECT month FROM transaction_archives)'
+    params = ()
+    if since:
+        month_filter += ' AND month >= ?'
+        params = (since,)
+    cursor.execute(f'DELETE FROM monthly_statements WHERE 1 {month_filter}', params)
+    cursor.execute(f'''
+        INSERT INTO monthly_statements (user_id, month, kind, tx_count, total_cents)
+        SELECT user_id, month, kind, COUNT(*), SUM(COALESCE(amount_cents, 0)) FROM (
+            SELECT t.initiator_id AS user_id, {_MONTH.format(t='t')} AS month,
+                   {_INITIATOR_KIND.format(t='t')} AS kind, t.amount_cents
+            FROM transactions t WHERE t.status = 'completed'
+            UNION ALL
+            SELECT t.target_id, {_MONTH.format(t='t')}, {_TARGET_KIND.format(t='t')}, t.amount_cents
+            FROM transactions t WHERE t.status = 'completed'
+        )
+        WHERE user_id IS NOT NULL AND kind IS NOT NULL {month_filter}
+        GROUP BY user_id, month, kind
+    ''', params)
+    return cursor.rowcount
+
+
+def current_month():
+    return datetime.now(timezone.utc).strftime('%Y-%m')
+
+
+def parse_month(value):
+    # 'YYYY-MM' -> normalized 'YYYY-MM'; raises ValueError for anything else
+    return datetime.strptime(value, '%Y-%m').strftime('%Y-%m')
+
+
+def get_statement(cursor, user_id, month):
+    """One user's month as a JSON-ready dict, read from the rollup by primary key."""
+    cursor.execute('''
+        SELECT kind, tx_count, total_cents FROM monthly_statements
+        WHERE user_id = ? AND month = ?
+    ''', (user_id, month))
+    by_kind = {kind: {'count': 0, 'total_cents': 0} for kind in KINDS}
+    for kind, tx_count, total_cents in cursor.fetchall():
+        by_kind[kind] = {'count': tx_count, 'total_cents': total_cents}
+    income = sum(by_kind[kind]['total_cents'] for kind in INCOME_KINDS)
+    spending = sum(by_kind[kind]['total_cents'] for kind in SPENDING_KINDS)
+    return {
+        'user_id': user_id,
+        'month': month,
+        'income_cents': income,
+        'spending_cents': spending,
+        'net_cents': income - spending,
+        'by_kind': by_kind,
+    }
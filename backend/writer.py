@@ -0,0 +1,231 @@
+import queue
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout  # Not the builtin TimeoutError before 3.11
+
+from flask import g, has_app_context
+
+import ledger
+from db import get_db
+
+# Write intents from request threads, applied by one writer thread in group commits.
+#
+# An intent is a function `work(cursor)` that does one request's writes,
+# including the reads they depend on (a balance check, "is this request
+# still pending"). The writer takes whatever is queued, up to `max_batch`
+# intents, optionally waiting `max_delay` seconds for more once it has one,
+# and applies them all in one BEGIN IMMEDIATE transaction: one write lock
+# and one commit for the batch instead of one per request. Each intent runs
+# in its own SAVEPOINT, so one that raises (InsufficientFunds, say) is
+# rolled back alone and its caller gets the exception while the rest of the
+# batch still commits. Callers only get results after COMMIT.
+#
+# The writer holds ledger.WRITE_LOCK for each batch, so writes that still go
+# through ledger.run_immediate on a pooled connection stay serialized with it.
+#
+# A caller whose intent hasn't been picked up within `timeout` cancels it, so
+# a timeout always means nothing was written. Once an intent is in a batch
+# the caller waits for that batch's outcome instead. Only if the writer
+# thread dies mid-batch is the outcome unknown (OutcomeUnknown); the
+# idempotency store then keeps the request's key claimed, so a retry can't
+# apply it a second time.
+
+
+class WriteTimeout(TimeoutError):
+    pass
+
+
+class WriterStopped(RuntimeError):
+    pass
+
+
+class OutcomeUnknown(RuntimeError):
+    pass
+
+
+class WriteQueue:
+    """Single writer thread per process; `run(work)` blocks until the intent has committed.
+
+    With enabled=False, run() applies the intent inline with
+    ledger.run_immediate on the request's pooled connection, as the routes
+    did before. Intents must not call run() themselves.
+    """
+
+    def __init__(self, pool, max_batch=64, max_delay=0.0, timeout=30.0, enabled=True):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.enabled = enabled
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.intents = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.busy_retries = 0
+        self.largest_batch = 0
+        self.commit_seconds = 0.0
+
+    # --- Producer side (called from routes) ---
+
+    def submit(self, work):
+        future = Future()
+        # Queued first, so a writer that dies on start still finds it and fails it
+        self._queue.put((work, future))
+        self.start()
+        return future
+
+    def run(self, work):
+        if not self.enabled:
+            return ledger.run_immediate(get_db(), work)
+        future = self.submit(work)
+        try:
+            try:
+                return future.result(self.timeout)
+            except FutureTimeout:
+                if future.cancel():
+                    # Never started, and now never will: safe to retry
+                    with self._lock:
+                        self.timeouts += 1
+                    raise WriteTimeout(f'write not started within {self.timeout}s') from None
+                # Already in a batch; its outcome is known once the batch commits or rolls back
+                return future.result()
+        except OutcomeUnknown:
+            if has_app_context():
+                g.write_outcome_unknown = True
+            raise
+
+    # --- Writer lifecycle ---
+
+    def start(self):
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+        with self._start_lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=10.0):
+        # Intents queued before the stop are still applied
+        if self._thread and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout)
+
+    def _run(self):
+        conn = None
+        batch = []
+        try:
+            conn = self.pool.acquire()
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    try:
+                        item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._apply(conn, batch)
+                batch = []
+        finally:
+            # Nobody else will resolve these; a caller must not wait on them forever
+            for _, future in batch:
+                if future.running():
+                    future.set_exception(OutcomeUnknown('the writer thread stopped during this write'))
+                elif not future.done():
+                    future.set_exception(WriterStopped('the writer thread stopped before this write'))
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None and item[1].set_running_or_notify_cancel():
+                    item[1].set_exception(WriterStopped('the writer thread stopped before this write'))
+            if conn is not None:
+                self.pool.release(conn)
+
+    # --- Group commit ---
+
+    def _apply(self, conn, batch):
+        # Intents their callers gave up on are dropped; the rest can't be cancelled from here on
+        batch[:] = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        outcomes = None
+        for attempt in range(ledger.BUSY_RETRIES + 1):
+            if attempt:
+                with self._lock:
+                    self.busy_retries += 1
+                time.sleep(ledger.BUSY_BASE_DELAY * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+            started = time.perf_counter()
+            with ledger.WRITE_LOCK:
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    outcomes = [self._apply_one(conn.cursor(), work) for work, _ in batch]
+                    conn.commit()
+                except sqlite3.OperationalError as e:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    if ledger.is_busy(e) and attempt < ledger.BUSY_RETRIES:
+                        continue
+                    outcomes = [(False, e)] * len(batch)
+                except Exception as e:
+                    # The transaction itself failed (a savepoint couldn't be rolled back, say): nothing committed
+                    if conn.in_transaction:
+                        conn.rollback()
+                    outcomes = [(False, e)] * len(batch)
+            break
+
+        with self._lock:
+            self.batches += 1
+            self.intents += len(batch)
+            self.failed += sum(1 for ok, _ in outcomes if not ok)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.commit_seconds += time.perf_counter() - started
+        for (_, future), (ok, value) in zip(batch, outcomes):
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def _apply_one(self, cursor, work):
+        cursor.execute('SAVEPOINT intent')
+        try:
+            result = work(cursor)
+        except Exception as e:
+            cursor.execute('ROLLBACK TO intent')
+            cursor.execute('RELEASE intent')
+            return False, e
+        cursor.execute('RELEASE intent')
+        return True, result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'running': bool(self._thread and self._thread.is_alive()),
+                'queued': self._queue.qsize(),
+                'batches': self.batches,
+                'intents': self.intents,
+                'failed': self.failed,
+                'timeouts': self.timeouts,
+                'busy_retries': self.busy_retries,
+                'largest_batch': self.largest_batch,
+                'mean_batch': round(self.intents / self.batches, 2) if self.batches else 0.0,
+                'commit_ms_total': round(self.commit_seconds * 1000, 1),
+            }
@@ -1,4 +1,4 @@
-import React, { useState, useEffect, useMemo } from 'react';
+import React, { useState, useEffect, useMemo, useRef } from 'react';
 import {
   View,
   Text,
@@ -55,9 +55,13 @@ const btnImages = {
   const [selectedRequest, setSelectedRequest] = useState(null); // NEW: For request detail
   const [isRequestFlow, setIsRequestFlow] = useState(false); // Send vs Request mode
   const [pendingRequests, setPendingRequests] = useState([]); // For requests screen
+  const [pendingCount, setPendingCount] = useState(0); // Home screen badge
   const [amountInput, setAmountInput] = useState(''); // Amount input, default 10
   const [transactions, setTransactions] = useState([]);
   const [refreshingTransactions, setRefreshingTransactions] = useState(false);
+  const [statement, setStatement] = useState(null); // This month's totals from /statements
+  const [transactionsCursor, setTransactionsCursor] = useState(null); // 'before' cursor for the next page
+  const [loadingMoreTransactions, setLoadingMoreTransactions] = useState(false);
 
   // For split: NOTE: These are now treated as WEIGHTS (0-100), not fixed percentages.
   const [splitSelectedIds, setSplitSelectedIds] = useState([]); // array of user ids selected
@@ -65,6 +69,7 @@ const btnImages = {
   // Setting initial weights to 50 for a middle-point starting position
   const [shares, setShares] = useState([]); // Array of WEIGHTS (0-100) for each selected user
   const [userSharePercent, setUserSharePercent] = useState(50); // User's WEIGHT, starts at 50
+  const [splitGroupId, setSplitGroupId] = useState(null); // Group the split was started from, if any
 
   // --- NEW: Group State ---
   const [groups, setGroups] = useState([]); 
@@ -75,6 +80,20 @@ const btnImages = {
   const projectId = Constants?.expoConfig?.extra?.eas?.projectId;
   const API_BASE = 'http://127.0.0.1:5000'; // Keep this here as it's logic/config
 
+  // Idempotency-Key per money-moving action. A retry after a network error reuses
+  // the key, so the backend replays the first result instead of moving money twice;
+  // once the server has answered, the next attempt gets a fresh key.
+  const idempotencyKeys = useRef({});
+  const idempotencyKeyFor = (action) => {
+    if (!idempotencyKeys.current[action]) {
+      idempotencyKeys.current[action] = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+    }
+    return idempotencyKeys.current[action];
+  };
+  const clearIdempotencyKey = (action) => {
+    delete idempotencyKeys.current[action];
+  };
+
   // Notification setup (mobile only, with token registration after login)
   useEffect(() => {
     if (Platform.OS === 'web') {
@@ -146,7 +165,15 @@ const btnImages = {
     setLoading(false);
     setRefreshing(false);
   };
-  
+
+  // Server-side contact search: recent contacts first, then everyone else who matches
+  const searchUsers = async (query) => {
+    const userParam = currentUser ? `&user_id=${currentUser.id}` : '';
+    const response = await fetch(`${API_BASE}/users/search?q=${encodeURIComponent(query)}${userParam}`);
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    return response.json();
+  };
+
   // --- NEW: Fetch Groups ---
   const fetchGroups = async (userId) => {
     if (!userId) return;
@@ -189,7 +216,7 @@ const btnImages = {
       if (redirectToSplitConfirm) {
         // Automatically select group members and navigate to confirm screen
         setSplitSelectedIds(memberIds);
-        handleConfirmSelection(memberIds); // Use the new signature
+        handleConfirmSelection(memberIds, data.id);
       } else {
         // Go back to the split selection screen
         setCurrentScreen('split');
@@ -202,11 +229,11 @@ const btnImages = {
     setLoading(false);
   };
 
-  const handleGroupSelection = (memberIds) => {
+  const handleGroupSelection = (memberIds, groupId) => {
     // Select all members of the group and go to split confirm screen
     const otherMemberIds = memberIds.filter(id => id !== currentUser.id);
     setSplitSelectedIds(otherMemberIds);
-    handleConfirmSelection(otherMemberIds); // Use the new signature
+    handleConfirmSelection(otherMemberIds, groupId); // Tags the split with the group for settle-up
   };
 
   const fetchPendingRequests = async () => {
@@ -216,12 +243,27 @@ const btnImages = {
       if (!response.ok) throw new Error('Failed to fetch requests');
       const data = await response.json();
       setPendingRequests(data);
+      setPendingCount(data.length);
       return data.length;
     } catch (error) {
       console.error('Requests fetch error:', error);
       return 0;
     }
   };
+
+  // The home screen only needs the badge, so it reads the per-user counter instead of the list
+  const fetchPendingSummary = async () => {
+    if (!currentUser) return;
+    try {
+      const response = await fetch(`${API_BASE}/pending_requests/summary?user_id=${currentUser.id}`);
+      if (!response.ok) throw new Error('Failed to fetch request summary');
+      const data = await response.json();
+      setPendingCount(data.pending_count);
+    } catch (error) {
+      console.error('Request summary fetch error:', error);
+    }
+  };
+  // Reloads the newest page of history (pull-to-refresh, polling)
   const fetchTransactions = async () => {
     if (!currentUser) return;
     console.log('Fetching transactions...');
@@ -230,8 +272,10 @@ const btnImages = {
       const response = await fetch(`${API_BASE}/transactions?user_id=${currentUser.id}`);
       if (!response.ok) throw new Error(`HTTP ${response.status}: ${await response.text()}`);
       const data = await response.json();
-      setTransactions(data);
-      console.log('Transactions fetched:', data.length);
+      setTransactions(data.transactions);
+      setTransactionsCursor(data.next_before);
+      console.log('Transactions fetched:', data.transactions.length);
+      fetchStatement();
     } catch (error) {
       console.error('Fetch transactions error:', error);
       //setMessage('Error fetching transactions!');
@@ -240,6 +284,47 @@ const btnImages = {
     setRefreshingTransactions(false);
   };
 
+  // Monthly income/spending totals are precomputed on the server
+  const fetchStatement = async () => {
+    if (!currentUser) return;
+    try {
+      const response = await fetch(`${API_BASE}/statements?user_id=${currentUser.id}`);
+      if (!response.ok) throw new Error(`HTTP ${response.status}`);
+      setStatement(await response.json());
+    } catch (error) {
+      console.error('Fetch statement error:', error);
+    }
+  };
+
+  // Signed, short-lived payment code for the current user; the payer redeems it at /qr/redeem
+  const createQr = async (amountCents) => {
+    const response = await fetch(`${API_BASE}/qr/create`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ user_id: currentUser.id, amount_cents: amountCents }),
+    });
+    const data = await response.json();
+    if (!response.ok) throw new Error(data.error || `HTTP ${response.status}`);
+    return data;
+  };
+
+  // Appends the next older page when the history list is scrolled to the end
+  const fetchMoreTransactions = async () => {
+    if (!currentUser || !transactionsCursor || loadingMoreTransactions) return;
+    setLoadingMoreTransactions(true);
+    try {
+      const before = encodeURIComponent(transactionsCursor);
+      const response = await fetch(`${API_BASE}/transactions?user_id=${currentUser.id}&before=${before}`);
+      if (!response.ok) throw new Error(`HTTP ${response.status}: ${await response.text()}`);
+      const data = await response.json();
+      setTransactions(prev => [...prev, ...data.transactions]);
+      setTransactionsCursor(data.next_before);
+    } catch (error) {
+      console.error('Fetch more transactions error:', error);
+    }
+    setLoadingMoreTransactions(false);
+  };
+
   const handleLogin = async (user) => {
     console.log('handleLogin called for user:', user.id, user.name);
     setLoading(true);
@@ -340,11 +425,13 @@ const btnImages = {
         body.receiver_iban = selectedRecipient.iban;
       }
 
+      const action = `${endpoint}:${selectedRecipient.iban}:${amountCents}`;
       const response = await fetch(`${API_BASE}${endpoint}`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKeyFor(action) },
         body: JSON.stringify(body),
       });
+      clearIdempotencyKey(action);
       if (!response.ok) {
         const errorData = await response.json().catch(() => ({}));
         throw new Error(errorData.error || `HTTP ${response.status}`);
@@ -376,11 +463,13 @@ const btnImages = {
         receiver_iban: request.requester_iban,
         amount_cents: request.amount
       };
+      const action = `approve:${request.id}`;
       const response = await fetch(`${API_BASE}/approve_request/${request.id}`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKeyFor(action) },
         body: JSON.stringify(body),
       });
+      clearIdempotencyKey(action);
       const responseText = await response.text();
       console.log('Approve response status:', response.status, 'body:', responseText);
       if (!response.ok) {
@@ -428,6 +517,33 @@ const btnImages = {
     setLoading(false);
   };
 
+  // Pays every listed request in one /requests/batch call instead of one call per request
+  const handleApproveAll = async () => {
+    if (!currentUser || pendingRequests.length === 0) return;
+    setLoading(true);
+    try {
+      const response = await fetch(`${API_BASE}/requests/batch`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          user_id: currentUser.id,
+          items: pendingRequests.map(request => ({ request_id: request.id, action: 'approve' })),
+        }),
+      });
+      const data = await response.json();
+      if (!response.ok) throw new Error(data.error || `HTTP ${response.status}`);
+      if (data.failed > 0) {
+        Alert.alert('Opozorilo', `Plačanih ${data.approved} zahtev, ${data.failed} ni uspelo (premalo sredstev?).`);
+      }
+      await fetchPendingRequests();
+      await fetchTransactions();
+    } catch (error) {
+      console.error('Approve all error:', error);
+      Alert.alert('Napaka', error.message);
+    }
+    setLoading(false);
+  };
+
   // Split selection handlers (assuming these exist from original code)
   const toggleSplitSelect = (userId) => {
     setSplitSelectedIds(prev =>
@@ -437,11 +553,12 @@ const btnImages = {
     );
   };
 
-  const handleConfirmSelection = (selectedIds) => {
+  const handleConfirmSelection = (selectedIds, groupId = null) => {
     if (selectedIds.length > 0) {
       setShares(Array(selectedIds.length).fill(50));
       setUserSharePercent(50);
       setSplitAmountInput('');
+      setSplitGroupId(groupId);
 
       setCurrentScreen('split_confirm');
     } else {
@@ -535,7 +652,7 @@ const btnImages = {
       const u = users.find(x => x.id === uid);
       // We are requesting the 'other' amount from them
       const amount_cents = Math.round(requestedAmounts[idx] * 100);
-      return { iban: u.iban, name: u.name, amount_cents };
+      return { iban: u.iban, name: u.name, amount_cents, weight: shares[idx] };
     }).filter(r => r.amount_cents > 0); // Only request if amount > 0
 
     if (recipientsWithIban.length === 0 && memoizedAmounts.user === total) {
@@ -543,20 +660,27 @@ const btnImages = {
       return;
     }
 
+    // Send the raw weights; the backend converts them to cents so the shares
+    // (including our own) always add up to total_cents exactly.
     const body = {
       // Payer is the current user, who is requesting money from the recipients
       payer_iban: currentUser.iban, 
-      recipients: recipientsWithIban.map(r => ({ iban: r.iban, amount_cents: r.amount_cents })),
-      total_cents
+      mode: 'weighted',
+      payer_weight: userSharePercent,
+      recipients: recipientsWithIban.map(r => ({ iban: r.iban, weight: r.weight })),
+      total_cents,
+      ...(splitGroupId ? { group_id: splitGroupId } : {}),
     };
 
     setLoading(true);
     try {
+      const action = `split:${JSON.stringify(body)}`;
       const response = await fetch(`${API_BASE}/split_request`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'Idempotency-Key': idempotencyKeyFor(action) },
         body: JSON.stringify(body),
       });
+      clearIdempotencyKey(action);
       const data = await response.json();
       if (!response.ok) {
         throw new Error(data.error || 'Split request failed');
@@ -566,6 +690,7 @@ const btnImages = {
       setShares([]);
       setUserSharePercent(50); // Reset to 50
       setSplitAmountInput('');
+      setSplitGroupId(null);
       setCurrentScreen('home');
       fetchPendingRequests();
     } catch (error) {
@@ -620,73 +745,85 @@ const btnImages = {
     }
   }, [currentUser, currentScreen]);
 
-  // Refresh pending requests when on home screen
+  // Refresh the pending badge when on home screen
   useEffect(() => {
     if (currentUser && currentScreen === 'home') {
-      fetchPendingRequests();
+      fetchPendingSummary();
     }
   }, [currentUser, currentScreen]);
 
   useEffect(() => {
     if (currentUser) {
       fetchGroups(currentUser.id);
-      fetchPendingRequests();
+      if (currentScreen === 'requests') {
+        fetchPendingRequests();
+      }
       if (currentScreen === 'transactions') {
         fetchTransactions();
       }
     }
   }, [currentUser, currentScreen]);
 
-  // Web polling & visibility handlers (from earlier fix)
+  // Keep the latest screen in a ref so the event stream doesn't reconnect on navigation
+  const currentScreenRef = useRef(currentScreen);
+  useEffect(() => {
+    currentScreenRef.current = currentScreen;
+  }, [currentScreen]);
+
+  // Web: the backend pushes change events over SSE (/events), so we only refetch
+  // when something actually changed instead of polling every few seconds.
   useEffect(() => {
     if (Platform.OS !== 'web') return;
     if (!currentUser) return;
 
-  console.log('Starting web polling & visibility handlers for pending requests and transactions');
+    console.log('Opening event stream for pending requests and transactions');
 
-    // Initial fetch based on current screen
-    if (currentScreen === 'requests' || currentScreen === 'home') {  // *** ADDED: 'home' ***
-      fetchPendingRequests();
-    } else if (currentScreen === 'transactions') {
-      fetchTransactions();
-    }
-
-    const POLL_MS = 10000;
-    const intervalId = setInterval(() => {
-      // Poll conditionally based on current screen
-      if (currentScreen === 'requests' || currentScreen === 'home') {  // *** ADDED: 'home' ***
+    const refreshPending = () => {
+      const screen = currentScreenRef.current;
+      if (screen === 'requests') {
         fetchPendingRequests();
-      } else if (currentScreen === 'transactions') {
-        fetchTransactions();
-      }
-    }, POLL_MS);
-
-    const onVisibilityChange = () => {
-      if (document.visibilityState === 'visible') {
-        if (currentScreen === 'requests' || currentScreen === 'home') {  // *** ADDED: 'home' ***
-          fetchPendingRequests();
-        } else if (currentScreen === 'transactions') {
-          fetchTransactions();
-        }
+      } else if (screen === 'home') {
+        fetchPendingSummary();
       }
     };
-    const onFocus = () => {
-      if (currentScreen === 'requests' || currentScreen === 'home') {  // *** ADDED: 'home' ***
-        fetchPendingRequests();
-      } else if (currentScreen === 'transactions') {
+    const refreshTransactions = () => {
+      if (currentScreenRef.current === 'transactions') {
         fetchTransactions();
       }
     };
 
-    window.addEventListener('visibilitychange', onVisibilityChange);
-    window.addEventListener('focus', onFocus);
+    let source = null;
+    let retryTimer = null;
+    const open = () => {
+      // EventSource reconnects on its own and resumes from the last event id it saw
+      source = new EventSource(`${API_BASE}/events?user_id=${currentUser.id}`);
+      source.addEventListener('pending_requests', refreshPending);
+      source.addEventListener('transactions', refreshTransactions);
+      // Sent when the server can't replay what we missed (e.g. after a restart)
+      source.addEventListener('resync', () => {
+        refreshPending();
+        refreshTransactions();
+      });
+      source.onerror = () => {
+        if (source.readyState !== EventSource.CLOSED) {
+          console.warn('Event stream interrupted, reconnecting...');
+          return;
+        }
+        // An error response (503 when the server has too many open streams) ends the
+        // stream for good: refetch now and open a new one later
+        console.warn('Event stream refused, retrying in 30s');
+        refreshPending();
+        refreshTransactions();
+        retryTimer = setTimeout(open, 30000);
+      };
+    };
+    open();
 
     return () => {
-      clearInterval(intervalId);
-      window.removeEventListener('visibilitychange', onVisibilityChange);
-      window.removeEventListener('focus', onFocus);
+      clearTimeout(retryTimer);
+      source.close();
     };
-  }, [currentUser, currentScreen]);  // Already has currentScreen dep
+  }, [currentUser]);
   // Login Renderer
   const loginRenderer = renderLoginUser(styles, handleLogin);
 
@@ -724,7 +861,7 @@ const btnImages = {
           <HomeScreen 
             currentUser={currentUser}
             handleLogout={handleLogout}
-            pendingRequests={pendingRequests}
+            pendingCount={pendingCount}
             setCurrentScreen={setCurrentScreen}
             setIsRequestFlow={setIsRequestFlow}
             setSplitSelectedIds={setSplitSelectedIds}
@@ -742,6 +879,7 @@ const btnImages = {
             setCurrentScreen={setCurrentScreen}
             refreshing={refreshing}
             fetchUsers={fetchUsers}
+            searchUsers={searchUsers}
             btnImages={btnImages} // NEW PROP
           />
         )}
@@ -763,6 +901,8 @@ const btnImages = {
             pendingRequests={pendingRequests}
             setCurrentScreen={setCurrentScreen}
             setSelectedRequest={setSelectedRequest}
+            handleApproveAll={handleApproveAll}
+            loading={loading}
           />
         )}
         {!showLogin && currentScreen === 'request_detail' && (
@@ -779,7 +919,10 @@ const btnImages = {
           <TransactionScreen 
             currentUser={currentUser}
             transactions={transactions}
+            statement={statement}
             fetchTransactions={fetchTransactions}
+            fetchMoreTransactions={fetchMoreTransactions}
+            loadingMore={loadingMoreTransactions}
             refreshing={refreshingTransactions}
             setCurrentScreen={setCurrentScreen}
           />
@@ -840,6 +983,7 @@ const btnImages = {
             amountInput={amountInput} // Pass global amount for initial value
             currentUser={currentUser}
             setCurrentScreen={setCurrentScreen}
+            createQr={createQr}
           />
         )}
 
@@ -1,5 +1,5 @@
-import React, { useMemo } from 'react';
-import { View, Text, FlatList, TouchableOpacity, Image } from 'react-native';
+import React, { useMemo, useState, useEffect } from 'react';
+import { View, Text, FlatList, TouchableOpacity, Image, TextInput } from 'react-native';
 import styles from '../Styles.js';
 import { renderUser } from './Renderers';
 
@@ -11,8 +11,33 @@ const ContactsScreen = ({
   setCurrentScreen,
   refreshing,
   fetchUsers,
+  searchUsers,
   btnImages
 }) => {
+  const [query, setQuery] = useState('');
+  const [results, setResults] = useState(null);
+
+  // Ask the server once typing pauses; an empty box shows the full list again
+  useEffect(() => {
+    if (!query.trim()) {
+      setResults(null);
+      return;
+    }
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      try {
+        const found = await searchUsers(query);
+        if (!cancelled) setResults(found);
+      } catch (error) {
+        console.error('Search error:', error);
+      }
+    }, 200);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [query]);
+
   // Filter out the current user (self) from the list
   const filteredUsers = useMemo(() => {
     if (!currentUser) return users;
@@ -45,8 +70,18 @@ const ContactsScreen = ({
         </TouchableOpacity>
       )}
 
+      <TextInput
+        style={styles.searchInput}
+        value={query}
+        onChangeText={setQuery}
+        placeholder="Ime, telefon ali IBAN"
+        autoCorrect={false}
+        autoCapitalize="none"
+        clearButtonMode="while-editing"
+      />
+
       <FlatList
-        data={filteredUsers}
+        data={results ?? filteredUsers}
         renderItem={userRenderer}
         keyboardShouldPersistTaps="always"
         keyExtractor={(item) => item.id.toString()}
@@ -58,7 +93,7 @@ const ContactsScreen = ({
         contentContainerStyle={{ paddingBottom: 50 }}
         ListEmptyComponent={() => (
           <View style={styles.emptyContainer || { padding: 16 }}>
-            <Text style={styles.emptyText}>No other users found.</Text>
+            <Text style={styles.emptyText}>{results ? 'No matching users.' : 'No other users found.'}</Text>
           </View>
         )}
       />
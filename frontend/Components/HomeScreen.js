@@ -5,14 +5,14 @@ import styles from '../Styles';
 const HomeScreen = ({ 
   currentUser, 
   handleLogout, 
-  pendingRequests, 
+  pendingCount, 
   setCurrentScreen, 
   setIsRequestFlow,
   setSplitSelectedIds,
   setShares,
   btnImages
 }) => {
-  const hasPending = pendingRequests.length > 0;
+  const hasPending = pendingCount > 0;
   const chatIconSource = hasPending ? btnImages.chatUnread : btnImages.chat;
 
   return (
@@ -99,8 +99,11 @@ const ReceiveQrScreen = ({
   amountInput: initialAmountInput, 
   currentUser,
   setCurrentScreen,
+  createQr,
 }) => {
   const [showQr, setShowQr] = useState(false);
+  const [qrToken, setQrToken] = useState(null);
+  const [qrTtl, setQrTtl] = useState(INITIAL_TIMEOUT_SECONDS);
   const [localAmount, setLocalAmount] = useState(initialAmountInput);
   const [timeLeft, setTimeLeft] = useState(INITIAL_TIMEOUT_SECONDS);
   const timerRef = useRef(null);
@@ -136,14 +139,22 @@ const ReceiveQrScreen = ({
     }
   }, [showQr, setCurrentScreen]);
 
-  const handleGenerateQr = () => {
+  const handleGenerateQr = async () => {
     const amount = parseFloat(String(localAmount).replace(',', '.')) || 0;
     if (amount <= 0 || isNaN(amount)) {
       console.error('ERROR: Enter a positive amount.');
       return;
     }
-    setTimeLeft(INITIAL_TIMEOUT_SECONDS);
-    setShowQr(true);
+    try {
+      // The server signs the code and decides how long it stays valid
+      const qr = await createQr(Math.round(amount * 100));
+      setQrToken(qr.token);
+      setQrTtl(qr.ttl);
+      setTimeLeft(qr.ttl);
+      setShowQr(true);
+    } catch (error) {
+      console.error('QR create error:', error);
+    }
   };
 
   const titleMarginTop = showQr ? (Platform.OS === 'web' ? 20 : 50) : (Platform.OS === 'web' ? 50 : 80);
@@ -218,11 +229,14 @@ const ReceiveQrScreen = ({
             style={{ width: 300, height: 300, marginVertical: 20 }} 
             resizeMode="contain" 
           />
+          <Text selectable style={{ fontFamily: Platform.OS === 'ios' ? 'Menlo' : 'monospace', fontSize: 12, marginBottom: 20 }}>
+            {qrToken}
+          </Text>
           
           {/* Smooth animated circle — pass isActive so it starts/stops when QR is shown */}
           <CountdownCircle 
             timeLeft={timeLeft} 
-            totalTime={INITIAL_TIMEOUT_SECONDS}
+            totalTime={qrTtl}
             isActive={showQr}
           />
         </View>
@@ -6,7 +6,8 @@ const RequestsScreen = ({
   pendingRequests,
   setCurrentScreen,
   setSelectedRequest,
-  
+  handleApproveAll,
+  loading,
 }) => {
   const renderRequestItem = ({ item }) => (
     <TouchableOpacity
@@ -52,6 +53,16 @@ const RequestsScreen = ({
         ListEmptyComponent={<Text style={styles.emptyText}>Ni zahtev.</Text>}
         contentContainerStyle={{ paddingBottom: 50 }}
       />
+      {pendingRequests.length > 1 && (
+        <TouchableOpacity
+          style={[styles.confirmButton, { alignSelf: 'center', marginBottom: 30 }, loading && styles.confirmButtonDisabled]}
+          onPress={handleApproveAll}
+          disabled={loading}
+          activeOpacity={0.7}
+        >
+          <Text style={styles.confirmButtonText}>Plačaj vse ({pendingRequests.length})</Text>
+        </TouchableOpacity>
+      )}
     </View>
   );
 };
@@ -38,7 +38,7 @@ const SplitSelectionScreen = ({
       return (
         <TouchableOpacity
           style={[styles.row, styles.groupRow]}
-          onPress={() => handleGroupSelection(item.member_ids)}
+          onPress={() => handleGroupSelection(item.member_ids, item.id)}
           activeOpacity={0.7}
         >
           <View style={styles.userInfo}>
@@ -1,5 +1,5 @@
 import React, { useMemo } from 'react';
-import { View, Text, FlatList, TouchableOpacity, Image } from 'react-native';
+import { View, Text, FlatList, TouchableOpacity, Image, ActivityIndicator } from 'react-native';
 import styles from '../Styles';
 
 // Utility to format transaction data for display
@@ -100,7 +100,10 @@ const TransactionItem = ({ item }) => (
 const TransactionsScreen = ({
   currentUser,
   transactions,
+  statement,
   fetchTransactions,
+  fetchMoreTransactions,
+  loadingMore,
   refreshing,
   setCurrentScreen,
 }) => {
@@ -122,6 +125,14 @@ const TransactionsScreen = ({
       </TouchableOpacity>
       
       <Text style={styles.title}>Zgodovina transakcij</Text>
+
+      {statement ? (
+        <View style={styles.transactionSummary}>
+          <Text style={styles.summaryText}>
+            Ta mesec: +€{(statement.income_cents / 100).toFixed(2)} / -€{(statement.spending_cents / 100).toFixed(2)}
+          </Text>
+        </View>
+      ) : null}
       
       <FlatList
         data={formattedTransactions}
@@ -129,6 +140,9 @@ const TransactionsScreen = ({
         keyExtractor={(item) => item.id.toString()}
         refreshing={refreshing}
         onRefresh={fetchTransactions}
+        onEndReached={fetchMoreTransactions} // Lazily load older pages
+        onEndReachedThreshold={0.5}
+        ListFooterComponent={loadingMore ? <ActivityIndicator size="small" color="#61dafb" /> : null}
         style={styles.list}
         contentContainerStyle={{ paddingBottom: 50 }}
         ListEmptyComponent={<Text style={styles.emptyText}>No transactions recorded.</Text>}
@@ -279,6 +279,15 @@ const styles = StyleSheet.create({
     color: '#000',
     textAlign: 'center', 
   },
+  searchInput: {
+    backgroundColor: 'white',
+    padding: 12,
+    borderRadius: 8,
+    fontSize: 16,
+    color: '#000',
+    marginHorizontal: 10,
+    marginTop: 10,
+  },
   amountContainer: {
     alignSelf: 'center',
   },